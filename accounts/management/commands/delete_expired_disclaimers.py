@@ -49,16 +49,19 @@ class Command(BaseCommand):
 
         if online_disclaimer_users:
             ActivityLog.objects.create(
+                action="disclaimers_deleted",
                 log="Online disclaimers more than 6 yrs old deleted for "
-                "users: {}".format(", ".join(online_disclaimer_users))
+                "users: {}".format(", ".join(online_disclaimer_users)),
             )
         if archive_disclaimer_users:
             ActivityLog.objects.create(
+                action="disclaimers_deleted",
                 log="Archived disclaimers more than 6 yrs old deleted for "
-                "users: {}".format(", ".join(archive_disclaimer_users))
+                "users: {}".format(", ".join(archive_disclaimer_users)),
             )
         if not (online_disclaimer_users or archive_disclaimer_users):
             self.stdout.write("No disclaimers to delete")
             ActivityLog.objects.create(
-                log="Delete disclaimers job run; no expired disclaimers"
+                action="empty_job_run",
+                log="Delete disclaimers job run; no expired disclaimers",
             )
@@ -94,7 +94,9 @@ class CookiePolicy(models.Model):
             self.version = floor((CookiePolicy.current_version() + 1))
         super().save(**kwargs)
         ActivityLog.objects.create(
-            log="CookiePolicy version {} created".format(self.version)
+            action="cookie_policy_created",
+            obj=self,
+            log="CookiePolicy version {} created".format(self.version),
         )
 
 
@@ -134,7 +136,9 @@ class DataPrivacyPolicy(models.Model):
             self.version = floor((DataPrivacyPolicy.current_version() + 1))
         super().save(**kwargs)
         ActivityLog.objects.create(
-            log="Data Privacy Policy version {} created".format(self.version)
+            action="data_privacy_policy_created",
+            obj=self,
+            log="Data Privacy Policy version {} created".format(self.version),
         )
 
 
@@ -163,9 +167,11 @@ class SignedDataPrivacy(models.Model):
         cache.delete(active_data_privacy_cache_key(self.user))
         if not self.id:
             ActivityLog.objects.create(
+                action="data_privacy_signed",
+                actor=self.user,
                 log="Signed data privacy policy agreement created: {}".format(
                     self.__str__()
-                )
+                ),
             )
         super().save(**kwargs)
 
@@ -222,7 +228,9 @@ class DisclaimerContent(models.Model):
             self.issue_date = timezone.now()
         super().save(**kwargs)
         ActivityLog.objects.create(
-            log="Disclaimer Terms & PARQ version {} created".format(self.version)
+            action="disclaimer_content_created",
+            obj=self,
+            log="Disclaimer Terms & PARQ version {} created".format(self.version),
         )
 
 
@@ -289,13 +297,21 @@ class OnlineDisclaimer(BaseOnlineDisclaimer):
                     f"{self.user} aleady has active disclaimer, not creating another"
                 )
                 return
-            ActivityLog.objects.create(log=f"Online disclaimer created: {self}")
+            ActivityLog.objects.create(
+                action="disclaimer_created",
+                actor=self.user,
+                log=f"Online disclaimer created: {self}",
+            )
             # delete the cache keys to force re-cache on next retrieval
             cache.delete(active_disclaimer_cache_key(self.user))
             cache.delete(expired_disclaimer_cache_key(self.user))
         else:
             self.date_updated = timezone.now()
-            ActivityLog.objects.create(log=f"Online disclaimer updated: {self}")
+            ActivityLog.objects.create(
+                action="disclaimer_updated",
+                obj=self,
+                log=f"Online disclaimer updated: {self}",
+            )
         super().save(**kwargs)
 
 
@@ -23,11 +23,14 @@ def user_post_save(sender, instance, created, *args, **kwargs):
     # Log when new user created
     if created:
         ActivityLog.objects.create(
+            action="user_registered",
+            actor=instance,
+            obj=instance,
             log="New user registered: {} {}, username {}".format(
                 instance.first_name,
                 instance.last_name,
                 instance.username,
-            )
+            ),
         )
 
         # Email info to user (skip if no email address, or if we're running tests)
@@ -55,11 +58,13 @@ def archive_disclaimer_and_update_cache(sender, instance, **kwargs):
             if key not in ignore_fields and not key.endswith("_oldval")
         }
         fields["name"] = f"{instance.user.first_name} {instance.user.last_name}"
-        ArchivedDisclaimer.objects.create(**fields)
+        archived_disclaimer = ArchivedDisclaimer.objects.create(**fields)
         ActivityLog.objects.create(
+            action="disclaimer_archived",
+            obj=archived_disclaimer,
             log="Online disclaimer deleted; archive created for user {} {}".format(
                 instance.user.first_name, instance.user.last_name
-            )
+            ),
         )
     # set cache to False
     cache.set(active_disclaimer_cache_key(instance.user), False, None)
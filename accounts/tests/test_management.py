@@ -102,3 +102,4 @@ class DeleteExpiredDisclaimersTests(TestCase):
         management.call_command("delete_expired_disclaimers")
         self.assertEqual(OnlineDisclaimer.objects.count(), 2)
         self.assertEqual(ArchivedDisclaimer.objects.count(), 1)
+        self.assertTrue(ActivityLog.objects.filter(action="empty_job_run").exists())
@@ -1,14 +1,70 @@
 # -*- coding: utf-8 -*-
+import re
+
 from django.contrib import admin
-from activitylog.models import ActivityLog
+from django.contrib.contenttypes.models import ContentType
+
+from activitylog.models import ACTIONS, ActivityLog
+
+
+# "<type>:<id>" searches, e.g. booking:1234, event:12 or actor:5
+STRUCTURED_SEARCH = re.compile(r"(\w+):(\d+)")
+
+
+class ActionFilter(admin.SimpleListFilter):
+    """
+    Filter on the known actions; the default filter would query the table for
+    the distinct actions on every page load
+    """
+
+    title = "action"
+    parameter_name = "action"
+
+    def lookups(self, request, model_admin):
+        return [(action, action.replace("_", " ")) for action in ACTIONS]
+
+    def queryset(self, request, queryset):
+        if self.value():
+            return queryset.filter(action=self.value())
+        return queryset
 
 
 class ActivityLogAdmin(admin.ModelAdmin):
-    list_display = ("timestamp_formatted", "log")
+    list_display = ("timestamp_formatted", "action", "actor_id", "object", "log")
+    list_filter = (ActionFilter, "content_type")
+    list_select_related = ("content_type",)
     search_fields = ("log",)
+    search_help_text = (
+        "Search the log text, or find the logs for a user, event or object with "
+        "actor:<user id>, event:<event id> or <type>:<id> (e.g. booking:1234)"
+    )
 
     def timestamp_formatted(self, obj):
         return obj.timestamp.strftime("%d-%b-%Y %H:%M:%S (%Z)")
 
+    def object(self, obj):
+        if obj.content_type is None:
+            return ""
+        return f"{obj.content_type.model} {obj.object_id}"
+
+    def get_search_results(self, request, queryset, search_term):
+        # structured searches use the indexed columns instead of searching the text
+        match = STRUCTURED_SEARCH.fullmatch(search_term.strip().lower())
+        if match is not None:
+            name, pk = match.group(1), int(match.group(2))
+            if name == "actor":
+                return queryset.filter(actor_id=pk), False
+            if name == "event":
+                return queryset.filter(event_id=pk), False
+            content_type_ids = list(
+                ContentType.objects.filter(model=name).values_list("id", flat=True)
+            )
+            if content_type_ids:
+                return (
+                    queryset.filter(content_type_id__in=content_type_ids, object_id=pk),
+                    False,
+                )
+        return super().get_search_results(request, queryset, search_term)
+
 
 admin.site.register(ActivityLog, ActivityLogAdmin)
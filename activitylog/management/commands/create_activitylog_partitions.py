@@ -0,0 +1,30 @@
+"""
+Create the ActivityLog table's monthly partitions for the coming months (see
+activitylog/partitions.py).  Run it regularly (e.g. daily); logs for months without
+a partition go to the default partition, and are moved into their month's
+partition when it's created.
+"""
+
+from django.core.management.base import BaseCommand
+
+from activitylog.partitions import create_future_partitions, partition_name
+
+
+class Command(BaseCommand):
+    help = "Create monthly ActivityLog partitions for this month and the next months"
+
+    def add_arguments(self, parser):
+        parser.add_argument(
+            "--months-ahead",
+            default=3,
+            type=int,
+            help="Number of months after this one to create partitions for",
+        )
+
+    def handle(self, *args, **options):
+        created = create_future_partitions(options["months_ahead"])
+        if created:
+            for month in created:
+                self.stdout.write(f"Created partition {partition_name(month)}")
+        else:
+            self.stdout.write("No partitions to create")
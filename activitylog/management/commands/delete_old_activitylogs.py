@@ -1,17 +1,45 @@
+"""
+Back up and delete old ActivityLogs.
+
+Logs are streamed from a server-side cursor, in chunks of --batch-size, into a
+gzipped CSV which is saved to the "activitylog_backups" storage (S3 in
+production).
+
+Monthly partitions (see activitylog/partitions.py) that are entirely older than
+the cutoff are backed up to a file each, then detached and dropped.  Any other
+logs older than the cutoff (in the default partition, or the first days of the
+cutoff's month) are backed up together and then deleted in batches of
+--batch-size, in id order, pausing for --pause seconds between batches so the
+purge doesn't hold locks on the table for long.
+"""
+
 import csv
-import os
-from pathlib import Path
-import subprocess
+import gzip
+from tempfile import TemporaryFile
+import time
 
 from dateutil.relativedelta import relativedelta
 
 from django.conf import settings
 from django.core import management
+from django.core.files import File
+from django.core.files.storage import storages
 from django.core.management.base import BaseCommand
 from django.utils import timezone
-from django.utils.encoding import smart_str
 
 from ...models import ActivityLog
+from ...partitions import drop_partition, next_month, partitions
+
+
+EXPORT_FIELDS = {
+    "Timestamp": "timestamp",
+    "Log": "log",
+    "Action": "action",
+    "Actor id": "actor_id",
+    "Object type": "content_type__model",
+    "Object id": "object_id",
+    "Event id": "event_id",
+}
 
 
 class Command(BaseCommand):
@@ -24,6 +52,18 @@ class Command(BaseCommand):
             type=int,
             help="Age (in years) of logs to delete.  Defaults to 1 yr, i.e. will delete all logs older than 1 year old",
         )
+        parser.add_argument(
+            "--batch-size",
+            default=5000,
+            type=int,
+            help="Number of logs to read (for the backup) or delete at a time",
+        )
+        parser.add_argument(
+            "--pause",
+            default=0.5,
+            type=float,
+            help="Seconds to wait between each batch of deletes",
+        )
 
     def handle(self, *args, **options):
         age = options.get("age")
@@ -32,33 +72,86 @@ class Command(BaseCommand):
         cutoff = (now - relativedelta(years=age)).replace(
             hour=0, minute=0, second=0, microsecond=0
         )
-        filename = f"{settings.S3_LOG_BACKUP_ROOT_FILENAME}_{cutoff.strftime('%Y-%m-%d')}_{now.strftime('%Y%m%d%H%M%S')}.csv"
-        local_filepath = Path(settings.LOG_FOLDER) / "activitylogs_backup" / filename
-        local_filepath.parent.mkdir(exist_ok=True)
-        s3_upload_path = os.path.join(settings.S3_LOG_BACKUP_PATH, filename)
+        timestamp = now.strftime("%Y%m%d%H%M%S")
+        filename = f"{settings.S3_LOG_BACKUP_ROOT_FILENAME}_{cutoff.strftime('%Y-%m-%d')}_{timestamp}.csv.gz"
         # Delete the empty logs first
         management.call_command("delete_empty_job_logs", cutoff.strftime("%Y%m%d"))
 
+        for month in partitions():
+            if next_month(month) > cutoff:
+                break
+            self.drop_partition(month, timestamp, options["batch_size"])
+
         old_logs = ActivityLog.objects.filter(timestamp__lt=cutoff)
-        old_logs_count = old_logs.count()
-        if old_logs_count > 0:
-            with open(local_filepath, "w") as outfile:
-                wr = csv.writer(outfile)
-                wr.writerow([smart_str("Timestamp"), smart_str("Log")])
-                for activitylog in old_logs:
-                    wr.writerow(
-                        [
-                            smart_str(activitylog.timestamp.isoformat()),
-                            smart_str(activitylog.log),
-                        ]
-                    )
-
-            subprocess.run(
-                ["aws", "s3", "cp", str(local_filepath), s3_upload_path], check=True
+        if not old_logs.exists():
+            return
+
+        backup_name, backed_up_count = self.backup(
+            old_logs, filename, options["batch_size"]
+        )
+        deleted_count = self.delete(old_logs, options["batch_size"], options["pause"])
+        message = (
+            f"{backed_up_count} activitylogs older than {cutoff.strftime('%Y-%m-%d')} "
+            f"backed up to {backup_name} and {deleted_count} deleted"
+        )
+        self.stdout.write(message)
+        ActivityLog.objects.create(action="activitylogs_deleted", log=message)
+
+    def drop_partition(self, month, timestamp, batch_size):
+        """Back up a month's partition, then drop it"""
+        logs = ActivityLog.objects.filter(
+            timestamp__gte=month, timestamp__lt=next_month(month)
+        )
+        if logs.exists():
+            filename = f"{settings.S3_LOG_BACKUP_ROOT_FILENAME}_{month.strftime('%Y-%m')}_{timestamp}.csv.gz"
+            backup_name, count = self.backup(logs, filename, batch_size)
+            message = (
+                f"{count} activitylogs for {month.strftime('%B %Y')} backed up to "
+                f"{backup_name} and their partition dropped"
+            )
+        else:
+            message = (
+                f"Empty activitylog partition for {month.strftime('%B %Y')} dropped"
             )
-            os.unlink(local_filepath)
+        drop_partition(month)
+        self.stdout.write(message)
+        ActivityLog.objects.create(action="activitylogs_deleted", log=message)
 
-            old_logs.delete()
-            message = f"{old_logs_count} activitylogs older than {cutoff.strftime('%Y-%m-%d')} backed up to s3 and deleted"
-            self.stdout.write(message)
-            ActivityLog.objects.create(log=message)
+    def backup(self, logs, filename, batch_size):
+        """
+        Write the logs to a gzipped CSV and save it to the backup storage.  Returns
+        the name the backup was saved as, and the number of logs in it.
+        """
+        count = 0
+        with TemporaryFile() as backup:
+            with gzip.open(backup, "wt", newline="") as outfile:
+                writer = csv.writer(outfile)
+                writer.writerow(EXPORT_FIELDS)
+                for row in (
+                    logs.order_by("id")
+                    .values_list(*EXPORT_FIELDS.values())
+                    .iterator(chunk_size=batch_size)
+                ):
+                    timestamp, *values = row
+                    writer.writerow([timestamp.isoformat(), *values])
+                    count += 1
+            backup.seek(0)
+            name = storages["activitylog_backups"].save(filename, File(backup))
+        return name, count
+
+    def delete(self, logs, batch_size, pause):
+        """Delete the logs a batch at a time, in id order; returns the number deleted"""
+        deleted = 0
+        last_id = 0
+        while True:
+            ids = list(
+                logs.filter(id__gt=last_id)
+                .order_by("id")
+                .values_list("id", flat=True)[:batch_size]
+            )
+            if not ids:
+                return deleted
+            deleted += ActivityLog.objects.filter(id__in=ids).delete()[0]
+            last_id = ids[-1]
+            if len(ids) == batch_size:
+                time.sleep(pause)
@@ -0,0 +1,12 @@
+from activitylog.models import buffered_activity_logs
+
+
+class ActivityLogBufferMiddleware:
+    """Write the ActivityLogs created during a request in one go, at the end"""
+
+    def __init__(self, get_response):
+        self.get_response = get_response
+
+    def __call__(self, request):
+        with buffered_activity_logs():
+            return self.get_response(request)
@@ -0,0 +1,80 @@
+# Generated by Django 6.1 on 2026-10-18 08:30
+
+import django.db.models.deletion
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+    dependencies = [
+        ("activitylog", "0001_initial"),
+        ("contenttypes", "0002_remove_content_type_name"),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name="activitylog",
+            name="action",
+            field=models.CharField(blank=True, default="", max_length=50),
+        ),
+        migrations.AddField(
+            model_name="activitylog",
+            name="actor_id",
+            field=models.IntegerField(
+                blank=True, help_text="Id of the user who did it", null=True
+            ),
+        ),
+        migrations.AddField(
+            model_name="activitylog",
+            name="content_type",
+            field=models.ForeignKey(
+                blank=True,
+                db_index=False,
+                null=True,
+                on_delete=django.db.models.deletion.SET_NULL,
+                related_name="+",
+                to="contenttypes.contenttype",
+            ),
+        ),
+        migrations.AddField(
+            model_name="activitylog",
+            name="event_id",
+            field=models.IntegerField(blank=True, null=True),
+        ),
+        migrations.AddField(
+            model_name="activitylog",
+            name="object_id",
+            field=models.IntegerField(blank=True, null=True),
+        ),
+        migrations.AddIndex(
+            model_name="activitylog",
+            index=models.Index(
+                condition=models.Q(("actor_id__isnull", False)),
+                fields=["actor_id", "-timestamp"],
+                name="activitylog_actor_idx",
+            ),
+        ),
+        migrations.AddIndex(
+            model_name="activitylog",
+            index=models.Index(
+                condition=models.Q(("object_id__isnull", False)),
+                fields=["content_type", "object_id", "-timestamp"],
+                name="activitylog_object_idx",
+            ),
+        ),
+        migrations.AddIndex(
+            model_name="activitylog",
+            index=models.Index(
+                condition=models.Q(("event_id__isnull", False)),
+                fields=["event_id", "-timestamp"],
+                name="activitylog_event_idx",
+            ),
+        ),
+        migrations.AddIndex(
+            model_name="activitylog",
+            index=models.Index(
+                condition=models.Q(("action", ""), _negated=True),
+                fields=["action", "-timestamp"],
+                name="activitylog_action_idx",
+            ),
+        ),
+    ]
@@ -0,0 +1,135 @@
+"""
+Partition the ActivityLog table by month of timestamp.
+
+This rebuilds the table: every row is copied into the new partitioned table while
+an exclusive lock is held on the old one, so nothing can read or write the logs
+(and anything that logs will wait) until it's done.  Run it during a maintenance
+window; on a large table, delete old logs first (delete_old_activitylogs) to keep
+the copy short.
+
+The DDL is copied here from activitylog/partitions.py as it was when this
+migration was written, so that later changes to that module don't change what
+this migration does.
+"""
+
+from datetime import datetime
+from datetime import timezone as dt_timezone
+
+from dateutil.relativedelta import relativedelta
+
+from django.db import migrations
+from django.utils import timezone
+
+
+TABLE = "activitylog_activitylog"
+DEFAULT_PARTITION = f"{TABLE}_default"
+COLUMNS = (
+    '"id", "timestamp", "log", "actor_id", "action", "content_type_id", '
+    '"object_id", "event_id"'
+)
+UNPARTITIONED_TABLE = f"{TABLE}_unpartitioned"
+PARTITIONED_TABLE = f"{TABLE}_partitioned"
+# partitions for the months after the migration is run
+MONTHS_AHEAD = 3
+
+
+def month_start(dt):
+    dt = dt.astimezone(dt_timezone.utc)
+    return datetime(dt.year, dt.month, 1, tzinfo=dt_timezone.utc)
+
+
+def next_month(month):
+    return month + relativedelta(months=1)
+
+
+def create_partition(month, schema_editor):
+    name = schema_editor.quote_name(f"{TABLE}_p{month.strftime('%Y%m')}")
+    start, end = month.isoformat(), next_month(month).isoformat()
+    schema_editor.execute(f"CREATE TABLE {name} (LIKE {TABLE} INCLUDING DEFAULTS)")
+    schema_editor.execute(
+        f"ALTER TABLE {TABLE} ATTACH PARTITION {name} "
+        f"FOR VALUES FROM ('{start}') TO ('{end}')"
+    )
+
+
+def _reset_sequence(schema_editor):
+    schema_editor.execute(
+        f"SELECT setval(pg_get_serial_sequence('{TABLE}', 'id'), "
+        f"coalesce(max(id), 0) + 1, false) FROM {TABLE}"
+    )
+
+
+def partition_activitylog(apps, schema_editor):
+    """
+    Replace the table with one partitioned by month of timestamp; the primary key
+    of a partitioned table has to include the timestamp, so it's (id, timestamp)
+    """
+    ActivityLog = apps.get_model("activitylog", "ActivityLog")
+    connection = schema_editor.connection
+    for index in ActivityLog._meta.indexes:
+        schema_editor.remove_index(ActivityLog, index)
+    schema_editor.execute(f"ALTER TABLE {TABLE} RENAME TO {UNPARTITIONED_TABLE}")
+    schema_editor.execute(
+        f"CREATE TABLE {TABLE} ("
+        '"id" integer NOT NULL GENERATED BY DEFAULT AS IDENTITY, '
+        '"timestamp" timestamp with time zone NOT NULL, '
+        '"log" text NOT NULL, '
+        '"actor_id" integer NULL, '
+        '"action" varchar(50) NOT NULL, '
+        '"content_type_id" integer NULL '
+        "REFERENCES django_content_type (id) DEFERRABLE INITIALLY DEFERRED, "
+        '"object_id" integer NULL, '
+        '"event_id" integer NULL, '
+        'PRIMARY KEY ("id", "timestamp")'
+        ') PARTITION BY RANGE ("timestamp")'
+    )
+    schema_editor.execute(
+        f"CREATE TABLE {DEFAULT_PARTITION} PARTITION OF {TABLE} DEFAULT"
+    )
+
+    with connection.cursor() as cursor:
+        cursor.execute(f"SELECT min(timestamp) FROM {UNPARTITIONED_TABLE}")
+        oldest = cursor.fetchone()[0]
+    month = month_start(oldest or timezone.now())
+    last_month = month_start(timezone.now())
+    for _ in range(MONTHS_AHEAD):
+        last_month = next_month(last_month)
+    while month <= last_month:
+        create_partition(month, schema_editor)
+        month = next_month(month)
+
+    schema_editor.execute(
+        f"INSERT INTO {TABLE} ({COLUMNS}) SELECT {COLUMNS} FROM {UNPARTITIONED_TABLE}"
+    )
+    # check the copied rows' content types now, as the table can't be indexed with
+    # checks pending
+    schema_editor.execute("SET CONSTRAINTS ALL IMMEDIATE")
+    schema_editor.execute(f"DROP TABLE {UNPARTITIONED_TABLE}")
+    _reset_sequence(schema_editor)
+    for index in ActivityLog._meta.indexes:
+        schema_editor.add_index(ActivityLog, index)
+
+
+def unpartition_activitylog(apps, schema_editor):
+    ActivityLog = apps.get_model("activitylog", "ActivityLog")
+    for index in ActivityLog._meta.indexes:
+        schema_editor.remove_index(ActivityLog, index)
+    schema_editor.execute(f"ALTER TABLE {TABLE} RENAME TO {PARTITIONED_TABLE}")
+    schema_editor.create_model(ActivityLog)
+    schema_editor.execute(
+        f"INSERT INTO {TABLE} ({COLUMNS}) SELECT {COLUMNS} FROM {PARTITIONED_TABLE}"
+    )
+    schema_editor.execute("SET CONSTRAINTS ALL IMMEDIATE")
+    # drops the partitions too
+    schema_editor.execute(f"DROP TABLE {PARTITIONED_TABLE}")
+    _reset_sequence(schema_editor)
+
+
+class Migration(migrations.Migration):
+    dependencies = [
+        ("activitylog", "0002_activitylog_structured_details"),
+    ]
+
+    operations = [
+        migrations.RunPython(partition_activitylog, unpartition_activitylog),
+    ]
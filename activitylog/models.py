@@ -1,8 +1,156 @@
 # -*- coding: utf-8 -*-
-from django.db import models
+from contextlib import contextmanager
+from contextvars import ContextVar
+
+from django.conf import settings
+from django.contrib.contenttypes.models import ContentType
+from django.db import models, transaction
 from django.utils import timezone
 
 
+# the ActivityLogs collected by buffered_activity_logs, if it's active
+_buffer = ContextVar("activity_log_buffer", default=None)
+
+
+@contextmanager
+def buffered_activity_logs():
+    """
+    Collect the ActivityLogs created in a request or job, and write them with one
+    bulk_create when it ends (see ActivityLogBufferMiddleware).  Logs created in a
+    transaction are only collected when it commits, and the buffer is written when
+    any transaction the block ends in commits, so rolled back logs are dropped just
+    as they would have been if written straight away.  Timestamps are set when a
+    log is created, and logs are written in the order they were created.
+    Does nothing if settings.ACTIVITYLOG_BUFFERED is off, or a buffer is already
+    active.
+    """
+    if not settings.ACTIVITYLOG_BUFFERED or _buffer.get() is not None:
+        yield
+        return
+    buffer = []
+    token = _buffer.set(buffer)
+    try:
+        yield
+    finally:
+        _buffer.reset(token)
+        transaction.on_commit(lambda: ActivityLog.objects.bulk_create(buffer))
+
+
+# The actions logged across the site, which the admin can filter on; listed here
+# so that the filter doesn't have to find them in the (large) table
+ACTIONS = (
+    "activitylogs_deleted",
+    "attendance_marked",
+    "booking_autocreated",
+    "booking_cancelled",
+    "booking_created",
+    "booking_no_show",
+    "booking_refunded",
+    "booking_reopened",
+    "bookings_expired",
+    "cancellation_fee_added",
+    "cancellation_fee_incurred",
+    "cancellation_fee_paid",
+    "cancellation_fee_removed",
+    "cancellation_fee_rescinded",
+    "cancellation_fee_unpaid",
+    "cookie_policy_created",
+    "data_privacy_policy_created",
+    "data_privacy_signed",
+    "disclaimer_archived",
+    "disclaimer_content_created",
+    "disclaimer_created",
+    "disclaimer_updated",
+    "disclaimers_deleted",
+    "empty_job_run",
+    "event_cancellation_finished",
+    "event_cancelled",
+    "event_deleted",
+    "event_uncancelled",
+    "invoice_paid",
+    "invoices_deleted",
+    "reminder_sent",
+    "stripe_account_connected",
+    "stripe_account_disconnected",
+    "timetable_uploaded",
+    "user_registered",
+    "waiting_list_email_sent",
+    "waiting_list_removed",
+)
+
+
+class ActivityLogManager(models.Manager):
+    def build(self, *, actor=None, obj=None, event=None, **kwargs):
+        """
+        An unsaved ActivityLog.  actor (the user who did it), obj (what it was done
+        to) and event fill in the structured columns; an obj with an event_id (e.g.
+        a Booking) sets the event too.
+        """
+        if actor is not None:
+            kwargs["actor_id"] = actor.id
+        if obj is not None:
+            kwargs["content_type"] = ContentType.objects.get_for_model(obj)
+            kwargs["object_id"] = obj.pk
+            kwargs.setdefault("event_id", getattr(obj, "event_id", None))
+        if event is not None:
+            kwargs["event_id"] = event.id
+        return self.model(**kwargs)
+
+    def create(self, **kwargs):
+        activity_log = self.build(**kwargs)
+        buffer = _buffer.get()
+        if buffer is None:
+            activity_log.save(force_insert=True, using=self.db)
+        else:
+            transaction.on_commit(lambda: buffer.append(activity_log))
+        return activity_log
+
+
 class ActivityLog(models.Model):
     timestamp = models.DateTimeField(default=timezone.now)
     log = models.TextField()
+    # optional structured details, for finding the logs for a user, object or event
+    # without searching the log text
+    actor_id = models.IntegerField(
+        null=True, blank=True, help_text="Id of the user who did it"
+    )
+    action = models.CharField(max_length=50, blank=True, default="")
+    content_type = models.ForeignKey(
+        ContentType,
+        null=True,
+        blank=True,
+        on_delete=models.SET_NULL,
+        related_name="+",
+        db_index=False,  # covered by activitylog_object_idx
+    )
+    object_id = models.IntegerField(null=True, blank=True)
+    event_id = models.IntegerField(null=True, blank=True)
+
+    objects = ActivityLogManager()
+
+    class Meta:
+        # The table is partitioned by month of timestamp (see partitions.py), with
+        # (id, timestamp) as its primary key in the database.  The indexes are
+        # partial, as most logs only have some (or none) of the details.
+        indexes = [
+            models.Index(
+                fields=["actor_id", "-timestamp"],
+                condition=models.Q(actor_id__isnull=False),
+                name="activitylog_actor_idx",
+            ),
+            models.Index(
+                fields=["content_type", "object_id", "-timestamp"],
+                condition=models.Q(object_id__isnull=False),
+                name="activitylog_object_idx",
+            ),
+            models.Index(
+                fields=["event_id", "-timestamp"],
+                condition=models.Q(event_id__isnull=False),
+                name="activitylog_event_idx",
+            ),
+            models.Index(
+                fields=["action", "-timestamp"],
+                condition=~models.Q(action=""),
+                name="activitylog_action_idx",
+            ),
+        ]
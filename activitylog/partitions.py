@@ -0,0 +1,103 @@
+"""
+Monthly partitions of the ActivityLog table.
+
+The activitylog_activitylog table is partitioned by range of timestamp (see
+migration 0003), with a partition per (UTC) month, named
+activitylog_activitylog_pYYYYMM, and a default partition for logs in months that
+don't have one yet.  The create_activitylog_partitions command creates the
+partitions for the coming months, and delete_old_activitylogs drops whole
+partitions once they're older than the retention cutoff.
+"""
+
+from datetime import datetime
+from datetime import timezone as dt_timezone
+import re
+
+from dateutil.relativedelta import relativedelta
+
+from django.db import connection as default_connection, transaction
+from django.utils import timezone
+
+
+TABLE = "activitylog_activitylog"
+DEFAULT_PARTITION = f"{TABLE}_default"
+PARTITION_NAME = re.compile(rf"{TABLE}_p(\d{{4}})(\d{{2}})")
+
+
+def month_start(dt):
+    dt = dt.astimezone(dt_timezone.utc)
+    return datetime(dt.year, dt.month, 1, tzinfo=dt_timezone.utc)
+
+
+def next_month(month):
+    return month + relativedelta(months=1)
+
+
+def partition_name(month):
+    return f"{TABLE}_p{month.strftime('%Y%m')}"
+
+
+def partitions(connection=default_connection):
+    """The months that have a partition, in order"""
+    with connection.cursor() as cursor:
+        cursor.execute(
+            "SELECT child.relname FROM pg_inherits "
+            "JOIN pg_class child ON child.oid = pg_inherits.inhrelid "
+            "WHERE pg_inherits.inhparent = %s::regclass",
+            [TABLE],
+        )
+        names = [row[0] for row in cursor.fetchall()]
+    months = []
+    for name in names:
+        match = PARTITION_NAME.fullmatch(name)
+        if match is not None:
+            year, month = match.groups()
+            months.append(datetime(int(year), int(month), 1, tzinfo=dt_timezone.utc))
+    return sorted(months)
+
+
+def create_partition(month, connection=default_connection):
+    """
+    Create the partition for a month.  Any of the month's logs already in the
+    default partition are moved into it.
+    """
+    quote_name = connection.ops.quote_name
+    name = quote_name(partition_name(month))
+    start, end = month.isoformat(), next_month(month).isoformat()
+    with transaction.atomic(using=connection.alias), connection.cursor() as cursor:
+        cursor.execute(f"CREATE TABLE {name} (LIKE {TABLE} INCLUDING DEFAULTS)")
+        cursor.execute(
+            f"WITH moved AS ("
+            f"DELETE FROM {quote_name(DEFAULT_PARTITION)} "
+            f"WHERE timestamp >= %s AND timestamp < %s RETURNING *"
+            f") INSERT INTO {name} SELECT * FROM moved",
+            [start, end],
+        )
+        cursor.execute(
+            f"ALTER TABLE {TABLE} ATTACH PARTITION {name} "
+            f"FOR VALUES FROM ('{start}') TO ('{end}')"
+        )
+
+
+def create_future_partitions(months_ahead, connection=default_connection):
+    """
+    Create any missing partitions for this month and the next months_ahead months.
+    Returns the months created.
+    """
+    existing = set(partitions(connection))
+    month = month_start(timezone.now())
+    created = []
+    for _ in range(months_ahead + 1):
+        if month not in existing:
+            create_partition(month, connection)
+            created.append(month)
+        month = next_month(month)
+    return created
+
+
+def drop_partition(month, connection=default_connection):
+    """Detach a month's partition from the table, and drop it"""
+    name = connection.ops.quote_name(partition_name(month))
+    with transaction.atomic(using=connection.alias), connection.cursor() as cursor:
+        cursor.execute(f"ALTER TABLE {TABLE} DETACH PARTITION {name}")
+        cursor.execute(f"DROP TABLE {name}")
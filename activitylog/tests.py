@@ -1,5 +1,7 @@
 from datetime import datetime, timedelta
 from datetime import timezone as dt_timezone
+import csv
+import gzip
 import os
 import sys
 from tempfile import TemporaryDirectory
@@ -13,11 +15,24 @@ from model_bakery import baker
 from django.conf import settings
 from django.contrib.admin.sites import AdminSite
 from django.core import management
+from django.db import connection, transaction
 from django.test import TestCase, override_settings
+from django.test.utils import CaptureQueriesContext
+from django.urls import reverse
 from django.utils import timezone
 
 from activitylog import admin
-from activitylog.models import ActivityLog
+from activitylog.middleware import ActivityLogBufferMiddleware
+from activitylog.models import ActivityLog, buffered_activity_logs
+from activitylog.partitions import (
+    DEFAULT_PARTITION,
+    TABLE,
+    create_partition,
+    month_start,
+    next_month,
+    partition_name,
+    partitions,
+)
 
 
 pytestmark = pytest.mark.django_db
@@ -33,6 +48,223 @@ def test_activity_log_admin_timestamp_display():
     )
 
 
+def test_activity_log_structured_details():
+    user = baker.make_recipe("booking.user")
+    booking = baker.make_recipe("booking.booking")
+    activity_log = ActivityLog.objects.create(
+        log="Booking cancelled", action="booking_cancelled", actor=user, obj=booking
+    )
+    activity_log.refresh_from_db()
+    assert activity_log.actor_id == user.id
+    assert activity_log.content_type.model == "booking"
+    assert activity_log.object_id == booking.id
+    # a booking's event is filled in from the booking
+    assert activity_log.event_id == booking.event_id
+
+    event_log = ActivityLog.objects.create(log="Event cancelled", event=booking.event)
+    assert event_log.event_id == booking.event_id
+    assert event_log.content_type is None
+
+
+def test_activity_log_admin_structured_search():
+    booking = baker.make_recipe("booking.booking")
+    user = baker.make_recipe("booking.user")
+    booking_log = ActivityLog.objects.create(log="Booking", actor=user, obj=booking)
+    event_log = ActivityLog.objects.create(log="Event", event=booking.event)
+    # the same id for a different object type
+    other_log = ActivityLog.objects.create(
+        log=f"Not booking:{booking.id}", obj=booking.event, actor=booking.user
+    )
+
+    log_admin = admin.ActivityLogAdmin(ActivityLog, AdminSite())
+    # ignore the logs from creating the booking and users
+    queryset = ActivityLog.objects.filter(
+        id__in=[booking_log.id, event_log.id, other_log.id]
+    )
+
+    def search(term):
+        results, _ = log_admin.get_search_results(None, queryset, term)
+        return set(results)
+
+    assert search(f"Booking:{booking.id}") == {booking_log}
+    assert search(f"event:{booking.event_id}") == {booking_log, event_log}
+    assert search(f"actor:{user.id}") == {booking_log}
+    # anything else searches the log text
+    assert search("Not booking") == {other_log}
+    assert search(f"unknown:{booking.id}") == set()
+
+    assert log_admin.object(booking_log) == f"booking {booking.id}"
+    assert log_admin.object(event_log) == ""
+
+
+def test_activity_log_admin_action_filter(client, superuser):
+    ActivityLog.objects.create(log="Cancelled", action="booking_cancelled")
+    ActivityLog.objects.create(log="Expired", action="bookings_expired")
+    client.force_login(superuser)
+    url = reverse("admin:activitylog_activitylog_changelist")
+
+    with CaptureQueriesContext(connection) as queries:
+        resp = client.get(url)
+    # the actions listed in the filter are the known ones, not looked up in the table
+    assert not [
+        query
+        for query in queries
+        if "DISTINCT" in query["sql"] and TABLE in query["sql"]
+    ]
+    assert "booking cancelled" in resp.content.decode()
+
+    resp = client.get(url, {"action": "bookings_expired"})
+    assert [log.log for log in resp.context["cl"].result_list] == ["Expired"]
+
+
+def test_activity_log_lookups_use_indexes():
+    booking = baker.make_recipe("booking.booking")
+    lookups = [
+        ActivityLog.objects.filter(actor_id=1),
+        ActivityLog.objects.filter(event_id=1),
+        ActivityLog.objects.filter(content_type__model="booking", object_id=booking.id),
+        ActivityLog.objects.filter(action="event_cancelled"),
+    ]
+    with connection.cursor() as cursor:
+        # the test table is tiny, so make sure the planner considers the indexes
+        cursor.execute("SET LOCAL enable_seqscan = off")
+        for queryset in lookups:
+            plan = queryset.order_by("-timestamp").explain()
+            assert "Index Cond" in plan
+            # none of the partitions are scanned
+            assert f"Seq Scan on {TABLE}" not in plan
+
+
+def _insert_count(queries):
+    return len([q for q in queries if q["sql"].startswith("INSERT")])
+
+
+def test_buffered_activity_logs_written_in_one_query(
+    django_capture_on_commit_callbacks,
+):
+    with CaptureQueriesContext(connection) as queries:
+        with django_capture_on_commit_callbacks(execute=True):
+            with buffered_activity_logs():
+                first = ActivityLog.objects.create(log="First")
+                for i in range(5):
+                    ActivityLog.objects.create(log=f"Log {i}")
+                assert not ActivityLog.objects.exists()
+
+    assert _insert_count(queries) == 1
+    logs = list(ActivityLog.objects.order_by("id"))
+    assert [log.log for log in logs] == ["First"] + [f"Log {i}" for i in range(5)]
+    # timestamps are from when the logs were created, not written
+    assert logs[0].timestamp == first.timestamp
+    assert logs == sorted(logs, key=lambda log: log.timestamp)
+
+
+def test_buffered_activity_logs_rolled_back(django_capture_on_commit_callbacks):
+    with django_capture_on_commit_callbacks(execute=True):
+        with buffered_activity_logs():
+            ActivityLog.objects.create(log="Kept")
+            try:
+                with transaction.atomic():
+                    ActivityLog.objects.create(log="Rolled back")
+                    raise ValueError
+            except ValueError:
+                pass
+    assert list(ActivityLog.objects.values_list("log", flat=True)) == ["Kept"]
+
+
+def test_nested_buffered_activity_logs_written_once(django_capture_on_commit_callbacks):
+    with CaptureQueriesContext(connection) as queries:
+        with django_capture_on_commit_callbacks(execute=True):
+            with buffered_activity_logs():
+                ActivityLog.objects.create(log="Outer")
+                with buffered_activity_logs():
+                    ActivityLog.objects.create(log="Inner")
+    assert _insert_count(queries) == 1
+    assert ActivityLog.objects.count() == 2
+
+
+def test_activity_logs_not_buffered(settings):
+    settings.ACTIVITYLOG_BUFFERED = False
+    with buffered_activity_logs():
+        activity_log = ActivityLog.objects.create(log="Log")
+    assert activity_log.id is not None
+    # and outside a buffer, logs are always written straight away
+    settings.ACTIVITYLOG_BUFFERED = True
+    ActivityLog.objects.create(log="Another log")
+    assert ActivityLog.objects.count() == 2
+
+
+def test_activity_log_buffer_middleware(django_capture_on_commit_callbacks):
+    def get_response(request):
+        ActivityLog.objects.create(log="Log 1")
+        ActivityLog.objects.create(log="Log 2")
+        return "response"
+
+    middleware = ActivityLogBufferMiddleware(get_response)
+    with CaptureQueriesContext(connection) as queries:
+        with django_capture_on_commit_callbacks(execute=True):
+            assert middleware(None) == "response"
+    assert _insert_count(queries) == 1
+    assert ActivityLog.objects.count() == 2
+
+
+def _partition_of(activity_log):
+    with connection.cursor() as cursor:
+        cursor.execute(
+            f"SELECT tableoid::regclass::text FROM {TABLE} WHERE id = %s",
+            [activity_log.id],
+        )
+        return cursor.fetchone()[0]
+
+
+def test_logs_stored_in_monthly_partitions():
+    this_month = month_start(timezone.now())
+    recent_log = ActivityLog.objects.create(log="Recent")
+    old_log = ActivityLog.objects.create(
+        log="Old", timestamp=datetime(2001, 2, 3, tzinfo=dt_timezone.utc)
+    )
+    assert _partition_of(recent_log) == partition_name(this_month)
+    # no partition for the month, so it goes in the default partition
+    assert _partition_of(old_log) == DEFAULT_PARTITION
+
+    # recent logs only touch recent partitions
+    plan = ActivityLog.objects.filter(
+        timestamp__gte=this_month, timestamp__lt=next_month(this_month)
+    ).explain()
+    assert partition_name(this_month) in plan
+    assert DEFAULT_PARTITION not in plan
+
+
+def test_create_partition_moves_logs_from_default():
+    old_log = ActivityLog.objects.create(
+        log="Old", timestamp=datetime(2001, 2, 3, tzinfo=dt_timezone.utc)
+    )
+    other_month_log = ActivityLog.objects.create(
+        log="Old", timestamp=datetime(2001, 3, 1, tzinfo=dt_timezone.utc)
+    )
+    create_partition(datetime(2001, 2, 1, tzinfo=dt_timezone.utc))
+
+    assert _partition_of(old_log) == f"{TABLE}_p200102"
+    assert _partition_of(other_month_log) == DEFAULT_PARTITION
+    assert ActivityLog.objects.get(id=old_log.id).log == "Old"
+
+
+def test_create_activitylog_partitions_command():
+    output = StringIO()
+    management.call_command(
+        "create_activitylog_partitions", months_ahead=5, stdout=output
+    )
+    month = month_start(timezone.now())
+    for _ in range(6):
+        assert month in partitions()
+        month = next_month(month)
+
+    output = StringIO()
+    management.call_command(
+        "create_activitylog_partitions", months_ahead=5, stdout=output
+    )
+    assert output.getvalue() == "No partitions to create\n"
+
+
 class DeleteEmptyJobActivityLogsTests(TestCase):
     def setUp(self):
         # logs 10, 20, 60 days ago, one for each empty job text msg, one other
@@ -149,69 +381,161 @@ class DeleteOldActivityLogsTests(TestCase):
         )
         self.log_37monthsold = baker.make(
             ActivityLog,
-            log="message",
+            log="message, with a comma",
+            action="booking_cancelled",
+            event_id=12,
             timestamp=self.mock_now - relativedelta(months=37),
         )
+        self.tmpdir = TemporaryDirectory()
+        self.addCleanup(self.tmpdir.cleanup)
+        backup_storage = {
+            "BACKEND": "django.core.files.storage.FileSystemStorage",
+            "OPTIONS": {"location": self.tmpdir.name},
+        }
+        storages_override = override_settings(
+            STORAGES={**settings.STORAGES, "activitylog_backups": backup_storage}
+        )
+        storages_override.enable()
+        self.addCleanup(storages_override.disable)
+
+    def read_backup(self, age):
+        cutoff = (self.mock_now - relativedelta(years=age)).strftime("%Y-%m-%d")
+        filename = f"{settings.S3_LOG_BACKUP_ROOT_FILENAME}_{cutoff}_{self.mock_now.strftime('%Y%m%d%H%M%S')}.csv.gz"
+        assert os.listdir(self.tmpdir.name) == [filename]
+        with gzip.open(
+            os.path.join(self.tmpdir.name, filename), "rt", newline=""
+        ) as backup:
+            return list(csv.reader(backup))
 
-    @patch("activitylog.management.commands.delete_old_activitylogs.subprocess.run")
     @patch("activitylog.management.commands.delete_old_activitylogs.timezone.now")
-    def test_delete_default_old_logs(self, mock_now, mock_run):
+    def test_delete_default_old_logs(self, mock_now):
         mock_now.return_value = self.mock_now
         self.assertEqual(ActivityLog.objects.count(), 3)
-        with TemporaryDirectory() as tmpdir:
-            with override_settings(LOG_FOLDER=tmpdir):
-                # no age, defaults to 1 yr
-                management.call_command("delete_old_activitylogs")
-                # 2 logs left - the one that's < 1 yrs old plus the new one to log this activity
-                self.assertEqual(ActivityLog.objects.count(), 2)
-                all_log_ids = ActivityLog.objects.values_list("id", flat=True)
-                for log in [self.log_25monthsold, self.log_37monthsold]:
-                    self.assertNotIn(log.id, all_log_ids)
-                self.assertIn(self.log_11monthsold.id, all_log_ids)
-
-                self.assertEqual(mock_run.call_count, 1)
-                cutoff = (self.mock_now - relativedelta(years=1)).strftime("%Y-%m-%d")
-                filename = f"{settings.S3_LOG_BACKUP_ROOT_FILENAME}_{cutoff}_{self.mock_now.strftime('%Y%m%d%H%M%S')}.csv"
-                local_filepath = os.path.join(tmpdir, "activitylogs_backup", filename)
-                mock_run.assert_called_once_with(
-                    [
-                        "aws",
-                        "s3",
-                        "cp",
-                        str(local_filepath),
-                        os.path.join(settings.S3_LOG_BACKUP_PATH, filename),
-                    ],
-                    check=True,
-                )
-                assert not os.path.exists(local_filepath)
+        # no age, defaults to 1 yr
+        management.call_command("delete_old_activitylogs", stdout=StringIO())
+        # 2 logs left - the one that's < 1 yrs old plus the new one to log this activity
+        self.assertEqual(ActivityLog.objects.count(), 2)
+        all_log_ids = ActivityLog.objects.values_list("id", flat=True)
+        for log in [self.log_25monthsold, self.log_37monthsold]:
+            self.assertNotIn(log.id, all_log_ids)
+        self.assertIn(self.log_11monthsold.id, all_log_ids)
+
+        assert self.read_backup(age=1) == [
+            [
+                "Timestamp",
+                "Log",
+                "Action",
+                "Actor id",
+                "Object type",
+                "Object id",
+                "Event id",
+            ],
+            # in id order
+            [self.log_25monthsold.timestamp.isoformat(), "message", "", "", "", "", ""],
+            [
+                self.log_37monthsold.timestamp.isoformat(),
+                "message, with a comma",
+                "booking_cancelled",
+                "",
+                "",
+                "",
+                "12",
+            ],
+        ]
+        assert "2 activitylogs older than 2018-10-01 backed up" in (
+            ActivityLog.objects.latest("id").log
+        )
 
-    @patch("activitylog.management.commands.delete_old_activitylogs.subprocess.run")
     @patch("activitylog.management.commands.delete_old_activitylogs.timezone.now")
-    def test_delete_old_logs_with_args(self, mock_now, mock_run):
+    def test_delete_old_logs_with_args(self, mock_now):
         mock_now.return_value = self.mock_now
         self.assertEqual(ActivityLog.objects.count(), 3)
-        with TemporaryDirectory() as tmpdir:
-            with override_settings(LOG_FOLDER=tmpdir):
-                management.call_command("delete_old_activitylogs", age=3)
-                # 3 logs left - the 2 that are < 3 yrs old plus the new one to log this activity
-                self.assertEqual(ActivityLog.objects.count(), 3)
-                all_log_ids = ActivityLog.objects.values_list("id", flat=True)
-                for log in [self.log_11monthsold, self.log_25monthsold]:
-                    self.assertIn(log.id, all_log_ids)
-                self.assertNotIn(self.log_37monthsold.id, all_log_ids)
-
-                self.assertEqual(mock_run.call_count, 1)
-                cutoff = (self.mock_now - relativedelta(years=3)).strftime("%Y-%m-%d")
-                filename = f"{settings.S3_LOG_BACKUP_ROOT_FILENAME}_{cutoff}_{self.mock_now.strftime('%Y%m%d%H%M%S')}.csv"
-                local_filepath = os.path.join(tmpdir, "activitylogs_backup", filename)
-                mock_run.assert_called_once_with(
-                    [
-                        "aws",
-                        "s3",
-                        "cp",
-                        str(local_filepath),
-                        os.path.join(settings.S3_LOG_BACKUP_PATH, filename),
-                    ],
-                    check=True,
-                )
-                assert not os.path.exists(local_filepath)
+        management.call_command("delete_old_activitylogs", age=3, stdout=StringIO())
+        # 3 logs left - the 2 that are < 3 yrs old plus the new one to log this activity
+        self.assertEqual(ActivityLog.objects.count(), 3)
+        all_log_ids = ActivityLog.objects.values_list("id", flat=True)
+        for log in [self.log_11monthsold, self.log_25monthsold]:
+            self.assertIn(log.id, all_log_ids)
+        self.assertNotIn(self.log_37monthsold.id, all_log_ids)
+        assert len(self.read_backup(age=3)) == 2
+
+    @patch("activitylog.management.commands.delete_old_activitylogs.time.sleep")
+    @patch("activitylog.management.commands.delete_old_activitylogs.timezone.now")
+    def test_delete_old_logs_in_batches(self, mock_now, mock_sleep):
+        mock_now.return_value = self.mock_now
+        baker.make(
+            ActivityLog,
+            log="message",
+            timestamp=self.mock_now - relativedelta(months=30),
+            _quantity=3,
+        )
+        with CaptureQueriesContext(connection) as queries:
+            management.call_command(
+                "delete_old_activitylogs", batch_size=2, pause=2, stdout=StringIO()
+            )
+        # 5 logs in batches of 2
+        deletes = [
+            query
+            for query in queries
+            if query["sql"].startswith('DELETE FROM "activitylog_activitylog"')
+            and '"id" IN' in query["sql"]
+        ]
+        assert len(deletes) == 3
+        # paused after each full batch
+        assert [call.args for call in mock_sleep.call_args_list] == [(2,), (2,)]
+        assert len(self.read_backup(age=1)) == 6
+        assert ActivityLog.objects.count() == 2
+
+    @patch("activitylog.management.commands.delete_old_activitylogs.timezone.now")
+    def test_old_partitions_backed_up_and_dropped(self, mock_now):
+        mock_now.return_value = self.mock_now
+        months = [
+            datetime(2016, 9, 1, tzinfo=dt_timezone.utc),  # log_37monthsold
+            datetime(2017, 9, 1, tzinfo=dt_timezone.utc),  # log_25monthsold
+            datetime(2018, 1, 1, tzinfo=dt_timezone.utc),  # empty
+            # the cutoff's month, which has newer logs
+            datetime(2018, 10, 1, tzinfo=dt_timezone.utc),
+        ]
+        for month in months:
+            create_partition(month)
+
+        management.call_command("delete_old_activitylogs", stdout=StringIO())
+
+        remaining_partitions = partitions()
+        for month in months[:3]:
+            assert month not in remaining_partitions
+        assert months[3] in remaining_partitions
+
+        # a backup per partition with logs
+        timestamp = self.mock_now.strftime("%Y%m%d%H%M%S")
+        root = settings.S3_LOG_BACKUP_ROOT_FILENAME
+        assert sorted(os.listdir(self.tmpdir.name)) == [
+            f"{root}_2016-09_{timestamp}.csv.gz",
+            f"{root}_2017-09_{timestamp}.csv.gz",
+        ]
+        with gzip.open(
+            os.path.join(self.tmpdir.name, f"{root}_2016-09_{timestamp}.csv.gz"),
+            "rt",
+            newline="",
+        ) as backup:
+            rows = list(csv.reader(backup))
+        assert [row[:2] for row in rows[1:]] == [
+            [self.log_37monthsold.timestamp.isoformat(), "message, with a comma"]
+        ]
+
+        assert list(
+            ActivityLog.objects.exclude(id=self.log_11monthsold.id)
+            .order_by("id")
+            .values_list("log", flat=True)
+        ) == [
+            f"1 activitylogs for September 2016 backed up to {root}_2016-09_{timestamp}.csv.gz and their partition dropped",
+            f"1 activitylogs for September 2017 backed up to {root}_2017-09_{timestamp}.csv.gz and their partition dropped",
+            "Empty activitylog partition for January 2018 dropped",
+        ]
+
+    @patch("activitylog.management.commands.delete_old_activitylogs.timezone.now")
+    def test_nothing_to_delete(self, mock_now):
+        mock_now.return_value = self.mock_now
+        management.call_command("delete_old_activitylogs", age=5, stdout=StringIO())
+        assert ActivityLog.objects.count() == 3
+        assert os.listdir(self.tmpdir.name) == []
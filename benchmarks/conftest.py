@@ -0,0 +1,323 @@
+"""
+Fixtures for the performance benchmarks.
+
+The benchmarks seed a large dataset once per session, then measure the number of
+queries and the wall time of requests to key views, and compare them with the
+baselines stored in baselines.json.
+
+Run with:
+    pytest benchmarks -n0
+
+To record new baselines (e.g. after an intentional change), run with
+UPDATE_BENCHMARK_BASELINES=1.  Timings vary between machines, so they are compared
+with a tolerance, set with BENCHMARK_TIME_TOLERANCE (default 3, i.e. a view fails if
+it is more than 3 times slower than its baseline); query counts must not increase.
+"""
+
+import json
+import os
+import random
+import statistics
+import time
+from datetime import timedelta
+from decimal import Decimal
+from pathlib import Path
+
+import pytest
+from model_bakery import baker
+
+from django.contrib.auth.models import User
+from django.contrib.sites.models import Site
+from django.db import connection
+from django.test.utils import CaptureQueriesContext
+from django.utils import timezone
+
+from activitylog.models import ActivityLog
+from booking.models import (
+    Booking,
+    Event,
+    GiftVoucher,
+    GiftVoucherType,
+    ItemVoucher,
+    Membership,
+    MembershipType,
+    TotalVoucher,
+    WaitingListUser,
+)
+from stripe_payments.models import (
+    Invoice,
+    Seller,
+    StripePaymentIntent,
+    StripeWebhookEvent,
+)
+from timetable.models import Venue
+
+
+BASELINES_PATH = Path(__file__).parent / "baselines.json"
+TIMED_RUNS = 5
+# allow for timer noise on very fast views
+TIME_SLACK_SECONDS = 0.05
+
+USER_COUNT = 1000
+EVENT_COUNT = 3000
+MEMBERSHIP_COUNT = 2000
+INVOICE_COUNT = 5000
+VOUCHER_COUNT = 200
+CART_BOOKING_COUNT = 3
+
+
+def _seed_benchmark_data():
+    rng = random.Random(1234)
+    now = timezone.now()
+    venue = baker.make_recipe("booking.venue")
+    membership_type = MembershipType.objects.create(
+        name="Benchmark membership", cost=40, number_of_classes=4
+    )
+
+    users = User.objects.bulk_create(
+        User(
+            username=f"benchmark_{i}",
+            email=f"benchmark_{i}@test.com",
+            first_name="Benchmark",
+            last_name=str(i),
+        )
+        for i in range(USER_COUNT)
+    )
+    student = User.objects.create_user(
+        username="benchmark_student",
+        email="benchmark_student@test.com",
+        password="test",
+    )
+    staff_user = User.objects.create_user(
+        username="benchmark_staff",
+        email="benchmark_staff@test.com",
+        password="test",
+        is_staff=True,
+    )
+    seller = Seller.objects.create(
+        user=staff_user,
+        site=Site.objects.get_current(),
+        stripe_user_id="benchmark-seller",
+    )
+
+    # events over the past and next year; mostly classes
+    event_types = ["regular_session"] * 16 + ["workshop"] * 3 + ["private"]
+    events = Event.objects.bulk_create(
+        Event(
+            name=f"Benchmark event {i}",
+            event_type=rng.choice(event_types),
+            date=now + timedelta(hours=rng.randint(-365 * 24, 365 * 24)),
+            venue=venue,
+            max_participants=rng.randint(8, 20),
+            cost=Decimal(rng.choice([8, 10, 12, 25])),
+        )
+        for i in range(EVENT_COUNT)
+    )
+
+    bookings = []
+    for event in events:
+        for user in rng.sample(users, rng.randint(0, event.max_participants)):
+            status = "CANCELLED" if rng.random() < 0.1 else "OPEN"
+            bookings.append(
+                Booking(
+                    user=user,
+                    event=event,
+                    status=status,
+                    paid=status == "OPEN",
+                    attended=event.date < now and rng.random() < 0.8,
+                    booking_reference=f"benchmark{len(bookings)}",
+                    date_booked=event.date - timedelta(days=rng.randint(1, 30)),
+                )
+            )
+    Booking.objects.bulk_create(bookings, batch_size=5000)
+
+    Membership.objects.bulk_create(
+        Membership(
+            user=rng.choice(users),
+            membership_type=membership_type,
+            month=rng.randint(1, 12),
+            year=now.year,
+            paid=True,
+        )
+        for _ in range(MEMBERSHIP_COUNT)
+    )
+
+    Invoice.objects.bulk_create(
+        Invoice(
+            username=rng.choice(users).email,
+            invoice_id=f"benchmark-{i}",
+            amount=Decimal(rng.randint(8, 80)),
+            paid=True,
+            stripe_payment_intent_id=f"pi_benchmark_{i}",
+        )
+        for i in range(INVOICE_COUNT)
+    )
+
+    # vouchers are multi-table models, so they can't be bulk created
+    for i in range(VOUCHER_COUNT):
+        item_voucher = ItemVoucher.objects.create(
+            code=f"benchmark-item-{i}", discount=10, event_types=["regular_session"]
+        )
+        item_voucher.membership_types.add(membership_type)
+        TotalVoucher.objects.create(code=f"benchmark-total-{i}", discount_amount=5)
+    gift_voucher_type = GiftVoucherType.objects.create(discount_amount=25)
+
+    # the student's cart: unpaid bookings for future classes, a membership and a
+    # gift voucher
+    future_classes = [
+        event
+        for event in events
+        if event.event_type == "regular_session" and event.date > now
+    ]
+    student_bookings = Booking.objects.bulk_create(
+        Booking(
+            user=student,
+            event=event,
+            paid=index >= CART_BOOKING_COUNT,
+            booking_reference=f"benchmark-student-{index}",
+        )
+        for index, event in enumerate(future_classes[:20])
+    )
+    Membership.objects.create(
+        user=student,
+        membership_type=membership_type,
+        month=now.month,
+        year=now.year,
+        paid=False,
+    )
+    gift_voucher = GiftVoucher.objects.create(gift_voucher_type=gift_voucher_type)
+    gift_voucher.voucher.purchaser_email = student.email
+    gift_voucher.voucher.save()
+
+    # a full class with a waiting list, for the register views
+    register_event = Event.objects.create(
+        name="Benchmark register class",
+        event_type="regular_session",
+        date=now + timedelta(days=2),
+        venue=venue,
+        max_participants=40,
+        cost=10,
+    )
+    register_bookings = Booking.objects.bulk_create(
+        Booking(
+            user=user,
+            event=register_event,
+            paid=True,
+            booking_reference=f"benchmark-register-{index}",
+        )
+        for index, user in enumerate(users[:40])
+    )
+    WaitingListUser.objects.bulk_create(
+        WaitingListUser(user=user, event=register_event) for user in users[40:50]
+    )
+
+    return {
+        "student": student,
+        "staff_user": staff_user,
+        "seller": seller,
+        "membership_type": membership_type,
+        "register_event": register_event,
+        "register_booking": register_bookings[0],
+        "student_bookings": student_bookings,
+    }
+
+
+def _delete_benchmark_data():
+    # delete in dependency order; the test db is reused between runs
+    for model in [
+        StripeWebhookEvent,
+        StripePaymentIntent,
+        Booking,
+        WaitingListUser,
+        Membership,
+        GiftVoucher,
+        GiftVoucherType,
+        ItemVoucher,
+        TotalVoucher,
+        Invoice,
+        Event,
+        MembershipType,
+        Seller,
+        Venue,
+        ActivityLog,
+        User,
+    ]:
+        model.objects.all().delete()
+
+
+@pytest.fixture(scope="session")
+def benchmark_data(django_db_setup, django_db_blocker):
+    with django_db_blocker.unblock():
+        _delete_benchmark_data()
+        data = _seed_benchmark_data()
+    yield data
+    with django_db_blocker.unblock():
+        _delete_benchmark_data()
+
+
+@pytest.fixture(scope="session")
+def benchmark_results():
+    baselines = (
+        json.loads(BASELINES_PATH.read_text()) if BASELINES_PATH.exists() else {}
+    )
+    results = {}
+    yield baselines, results
+    update = os.environ.get("UPDATE_BENCHMARK_BASELINES")
+    new_results = {
+        name: result
+        for name, result in results.items()
+        if update or name not in baselines
+    }
+    if new_results:
+        BASELINES_PATH.write_text(
+            json.dumps({**baselines, **new_results}, indent=2, sort_keys=True) + "\n"
+        )
+
+
+@pytest.fixture
+def benchmark(benchmark_results):
+    """
+    Returns a function that measures a view request and checks it against its
+    baseline:
+        benchmark(name, make_request, setup=None)
+    make_request is called once to warm up (caches etc), then TIMED_RUNS times;
+    setup, if given, is called before each request and isn't measured.
+    """
+    baselines, results = benchmark_results
+    tolerance = float(os.environ.get("BENCHMARK_TIME_TOLERANCE", 3))
+
+    def _benchmark(name, make_request, setup=None):
+        if setup:
+            setup()
+        make_request()
+
+        query_counts = []
+        timings = []
+        for _ in range(TIMED_RUNS):
+            if setup:
+                setup()
+            with CaptureQueriesContext(connection) as queries:
+                start = time.perf_counter()
+                response = make_request()
+                timings.append(time.perf_counter() - start)
+            query_counts.append(len(queries))
+
+        result = {
+            "queries": max(query_counts),
+            "seconds": round(statistics.median(timings), 4),
+        }
+        results[name] = result
+
+        baseline = baselines.get(name)
+        if baseline is not None and not os.environ.get("UPDATE_BENCHMARK_BASELINES"):
+            assert result["queries"] <= baseline["queries"], (
+                f"{name}: {result['queries']} queries, baseline {baseline['queries']}"
+            )
+            max_seconds = baseline["seconds"] * tolerance + TIME_SLACK_SECONDS
+            assert result["seconds"] <= max_seconds, (
+                f"{name}: {result['seconds']}s, baseline {baseline['seconds']}s "
+                f"(tolerance x{tolerance})"
+            )
+        return response
+
+    return _benchmark
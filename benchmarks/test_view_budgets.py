@@ -0,0 +1,269 @@
+import json
+import os
+from unittest.mock import patch
+
+import pytest
+import stripe
+
+from django.urls import reverse
+
+from booking.views.cart_utils import PricedCart
+from booking.views.views_utils import (
+    get_unpaid_bookings,
+    get_unpaid_gift_vouchers,
+    get_unpaid_memberships,
+)
+from stripe_payments.fake_stripe import FakeStripeClient
+from stripe_payments.models import Invoice
+from stripe_payments.utils import process_due_webhook_events
+
+
+pytestmark = pytest.mark.django_db
+
+
+@pytest.fixture
+def student_client(client, benchmark_data):
+    client.force_login(benchmark_data["student"])
+    return client
+
+
+@pytest.fixture
+def staff_client(client, benchmark_data):
+    client.force_login(benchmark_data["staff_user"])
+    return client
+
+
+@pytest.fixture
+def fake_stripe(settings, monkeypatch):
+    """
+    Answer Stripe API requests with the offline fake, and sign webhooks for real.
+    Set STRIPE_FAKE_LATENCY to simulate the round trip to Stripe.
+    """
+    settings.STRIPE_SECRET_KEY = "sk_test_benchmark"
+    settings.STRIPE_ENDPOINT_SECRET = "whsec_benchmark"
+    client = FakeStripeClient(latency=float(os.environ.get("STRIPE_FAKE_LATENCY", 0)))
+    monkeypatch.setattr(stripe, "default_http_client", client)
+    return client
+
+
+def test_event_list(benchmark, student_client):
+    url = reverse("booking:regular_session_list")
+    resp = benchmark("event_list", lambda: student_client.get(url))
+    assert resp.status_code == 200
+
+
+def test_shopping_basket(benchmark, student_client):
+    url = reverse("booking:shopping_basket")
+    resp = benchmark("shopping_basket", lambda: student_client.get(url))
+    assert resp.status_code == 200
+    assert resp.context_data["unpaid_items"]
+
+
+@patch("booking.views.shopping_basket.stripe.PaymentIntent")
+def test_stripe_checkout(
+    mock_payment_intent,
+    benchmark,
+    student_client,
+    benchmark_data,
+    get_mock_payment_intent,
+):
+    # the first checkout creates the payment intent, later ones modify it
+    mock_payment_intent.create.return_value = get_mock_payment_intent(
+        id="pi_benchmark_checkout"
+    )
+    mock_payment_intent.modify.return_value = get_mock_payment_intent(
+        id="pi_benchmark_checkout"
+    )
+    student = benchmark_data["student"]
+    total = PricedCart(
+        memberships=get_unpaid_memberships(student),
+        bookings=get_unpaid_bookings(student),
+        gift_vouchers=get_unpaid_gift_vouchers(student),
+    ).total
+    url = reverse("booking:stripe_checkout")
+    resp = benchmark(
+        "stripe_checkout", lambda: student_client.post(url, {"cart_total": total})
+    )
+    assert resp.status_code == 200
+    assert resp.context_data["cart_total"] == total
+
+
+@patch("stripe.WebhookSignature.verify_header")
+def test_stripe_webhook(mock_verify_header, benchmark, client, benchmark_data):
+    student = benchmark_data["student"]
+    seller = benchmark_data["seller"]
+    booking = benchmark_data["student_bookings"][0]
+    booking.event.cost = 10
+    booking.event.save()
+    invoices = []
+
+    def new_unpaid_invoice():
+        # each run pays a new invoice for the student's unpaid booking
+        booking.refresh_from_db()
+        booking.paid = False
+        invoice = Invoice.objects.create(
+            invoice_id=f"benchmark-webhook-{len(invoices)}",
+            username=student.email,
+            amount=10,
+            stripe_payment_intent_id="pi_benchmark_webhook",
+        )
+        booking.invoice = invoice
+        booking.save()
+        invoices.append(invoice)
+
+    def post_to_webhook():
+        invoice = invoices[-1]
+        payload = {
+            "id": f"evt_benchmark_{len(invoices)}",
+            "object": "event",
+            "type": "payment_intent.succeeded",
+            "account": seller.stripe_user_id,
+            "data": {
+                "object": {
+                    "id": "pi_benchmark_webhook",
+                    "object": "payment_intent",
+                    "amount": 1000,
+                    "currency": "gbp",
+                    "status": "succeeded",
+                    "description": "",
+                    "client_secret": "secret",
+                    "charges": {
+                        "data": [{"billing_details": {"email": student.email}}]
+                    },
+                    "metadata": {
+                        "invoice_id": invoice.invoice_id,
+                        "invoice_signature": invoice.signature(),
+                        **invoice.items_metadata(),
+                    },
+                }
+            },
+        }
+        return client.post(
+            reverse("stripe_payments:stripe_webhook"),
+            data=json.dumps(payload),
+            content_type="application/json",
+            HTTP_STRIPE_SIGNATURE="t=1234,v1=benchmark",
+        )
+
+    resp = benchmark("stripe_webhook", post_to_webhook, setup=new_unpaid_invoice)
+    assert resp.status_code == 200
+    # the webhook only stores the event; the worker processes it
+    process_due_webhook_events()
+    invoices[-1].refresh_from_db()
+    assert invoices[-1].paid
+
+
+def test_stripe_checkout_fake_stripe(
+    benchmark, student_client, benchmark_data, fake_stripe
+):
+    student = benchmark_data["student"]
+    # start with a new payment intent, created by the fake; later checkouts modify it
+    Invoice.objects.filter(username=student.email, paid=False).update(
+        stripe_payment_intent_id=None
+    )
+    total = PricedCart(
+        memberships=get_unpaid_memberships(student),
+        bookings=get_unpaid_bookings(student),
+        gift_vouchers=get_unpaid_gift_vouchers(student),
+    ).total
+    url = reverse("booking:stripe_checkout")
+    resp = benchmark(
+        "stripe_checkout_fake_stripe",
+        lambda: student_client.post(url, {"cart_total": total}),
+    )
+    assert resp.status_code == 200
+    invoice = Invoice.objects.get(username=student.email, paid=False)
+    payment_intent = stripe.PaymentIntent.retrieve(invoice.stripe_payment_intent_id)
+    assert payment_intent.amount == int(total * 100)
+
+
+STORM_EVENT_COUNT = 10
+STORM_DELIVERIES = 3
+
+
+def test_stripe_webhook_storm(benchmark, client, benchmark_data, fake_stripe):
+    """
+    A burst of signed payment webhooks, each delivered several times as Stripe
+    does when responses are slow
+    """
+    seller = benchmark_data["seller"]
+    student = benchmark_data["student"]
+    invoices = []
+    deliveries = []
+
+    def new_storm():
+        deliveries.clear()
+        for _ in range(STORM_EVENT_COUNT):
+            invoice = Invoice.objects.create(
+                invoice_id=f"benchmark-storm-{len(invoices)}",
+                username=student.email,
+                amount=10,
+            )
+            invoices.append(invoice)
+            payment_intent = stripe.PaymentIntent.create(
+                amount=1000,
+                currency="gbp",
+                metadata={
+                    "invoice_id": invoice.invoice_id,
+                    "invoice_signature": invoice.signature(),
+                },
+                stripe_account=seller.stripe_user_id,
+            )
+            stripe.PaymentIntent.confirm(payment_intent.id)
+            deliveries.extend(
+                [
+                    fake_stripe.signed_webhook(
+                        "payment_intent.succeeded",
+                        "payment_intent",
+                        payment_intent.id,
+                        account=seller.stripe_user_id,
+                    )
+                ]
+                * STORM_DELIVERIES
+            )
+
+    def post_storm():
+        for payload, signature in deliveries:
+            resp = client.post(
+                reverse("stripe_payments:stripe_webhook"),
+                data=payload,
+                content_type="application/json",
+                HTTP_STRIPE_SIGNATURE=signature,
+            )
+        return resp
+
+    resp = benchmark("stripe_webhook_storm", post_storm, setup=new_storm)
+    assert resp.status_code == 200
+    # each event is processed once
+    assert process_due_webhook_events() == len(invoices)
+    assert all(
+        Invoice.objects.filter(id__in=[invoice.id for invoice in invoices]).values_list(
+            "paid", flat=True
+        )
+    )
+
+
+def test_register_view(benchmark, staff_client, benchmark_data):
+    url = reverse(
+        "studioadmin:event_register", args=(benchmark_data["register_event"].slug,)
+    )
+    resp = benchmark("register_view", lambda: staff_client.get(url))
+    assert resp.status_code == 200
+
+
+def test_ajax_toggle_attended(benchmark, staff_client, benchmark_data):
+    url = reverse(
+        "studioadmin:ajax_toggle_attended",
+        args=(benchmark_data["register_booking"].id,),
+    )
+    attendance = ["no-show"]
+
+    def toggle_attendance():
+        attendance[0] = "attended" if attendance[0] == "no-show" else "no-show"
+
+    resp = benchmark(
+        "ajax_toggle_attended",
+        lambda: staff_client.post(url, {"attendance": attendance[0]}),
+        setup=toggle_attendance,
+    )
+    assert resp.status_code == 200
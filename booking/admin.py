@@ -4,29 +4,38 @@ from datetime import timedelta
 from django.contrib import admin
 from django.contrib.auth.models import User
 from django.contrib import messages
+from django.db import transaction
+from django.http import JsonResponse
+from django.shortcuts import get_object_or_404
+from django.urls import path, reverse
 from django.utils import timezone
+from django.utils.html import format_html
 from django.utils.safestring import mark_safe
 
 from django_object_actions import DjangoObjectActions, takes_instance_or_queryset
 
 from activitylog.models import ActivityLog
+from booking.event_cancellation import (
+    event_type_name,
+    retry_failed_booking_cancellations,
+)
 from booking.models import (
     Booking,
+    BookingCancellation,
+    EventCancellation,
     GiftVoucher,
     GiftVoucherType,
     ItemVoucher,
     Membership,
     MembershipType,
+    OutboxEmail,
     TotalVoucher,
     WaitingListUser,
     Workshop,
     RegularClass,
     Private,
-    Event,
 )
 from booking.forms import EventForm, ItemVoucherForm
-from booking.email_helpers import send_email
-from stripe_payments.utils import process_refund
 from stripe_payments.models import StripeRefund
 
 
@@ -260,14 +269,10 @@ class EventAdmin(DjangoObjectActions, admin.ModelAdmin):
     @takes_instance_or_queryset
     def cancel_event(self, request, queryset):
         for obj in queryset:
-            event_names = dict(Event.EVENT_TYPES)
-            event_type = (
-                "class"
-                if obj.event_type == "regular_session"
-                else event_names[obj.event_type]
-            )
+            event_type = event_type_name(obj)
 
             if not obj.bookings.exists():
+                event_id = obj.id
                 obj.delete()
                 self.message_user(
                     request,
@@ -275,7 +280,10 @@ class EventAdmin(DjangoObjectActions, admin.ModelAdmin):
                     % (event_type.title(), obj),
                 )
                 ActivityLog.objects.create(
-                    log=f"{obj} was deleted by admin user {request.user.username}"
+                    action="event_deleted",
+                    actor=request.user,
+                    event_id=event_id,
+                    log=f"{obj} was deleted by admin user {request.user.username}",
                 )
             else:
                 if obj.date <= timezone.now():
@@ -285,52 +293,38 @@ class EventAdmin(DjangoObjectActions, admin.ModelAdmin):
                         level=messages.ERROR,
                     )
                 else:
-                    obj.cancelled = True
-                    obj.save()
+                    # bookings are refunded, cancelled and emailed in the background
+                    # by the process_event_cancellations worker; the event is only
+                    # cancelled if its job is queued
+                    with transaction.atomic():
+                        obj.cancelled = True
+                        obj.save()
+                        cancellation = EventCancellation.start(obj, request.user)
 
                     ActivityLog.objects.create(
-                        log=f"{obj} was cancelled by admin user {request.user.username}"
+                        action="event_cancelled",
+                        actor=request.user,
+                        event=obj,
+                        log=f"{obj} was cancelled by admin user {request.user.username}",
                     )
-                    open_bookings = obj.bookings.filter(status="OPEN", no_show=False)
-                    open_bookings_count = open_bookings.count()
-                    for booking in open_bookings:
-                        refunded = False
-                        was_booked_with_membership = booking.membership is not None
-                        booking.status = "CANCELLED"
-                        if booking.membership:
-                            booking.membership = None
-                        elif booking.paid and booking.invoice:
-                            # process refund
-                            refunded = process_refund(request, booking)
-                        booking.paid = False
-                        booking.save()
-
-                        send_email(
-                            request,
-                            subject="{} has been cancelled".format(obj),
-                            ctx={
-                                "event_type": event_type,
-                                "event": obj,
-                                "was_booked_with_membership": was_booked_with_membership,
-                                "refunded": refunded,
-                            },
-                            template_txt="booking/email/event_cancelled.txt",
-                            to_list=[booking.user.email],
-                        )
-                        ActivityLog.objects.create(
-                            log=f"Booking {booking.id} for cancelled event {obj.id}, "
-                            f"user {booking.user.username} was "
-                            f"{'refunded' if refunded else 'credited to membership' if was_booked_with_membership else 'cancelled'}"
-                        )
-
-                    if open_bookings_count == 0:
+                    if cancellation is None:
                         msg = "no open bookings"
                     else:
-                        msg = "users for {} open booking(s) have been emailed notification".format(
-                            open_bookings_count
+                        progress_url = reverse(
+                            "admin:booking_eventcancellation_change",
+                            args=(cancellation.id,),
+                        )
+                        msg = format_html(
+                            "{} open booking(s) are being cancelled and users will be "
+                            "emailed notification; <a href='{}'>view progress</a>",
+                            cancellation.booking_cancellations.count(),
+                            progress_url,
                         )
                     self.message_user(
-                        request, "%s %s cancelled; %s" % (event_type.title(), obj, msg)
+                        request,
+                        format_html(
+                            "{} {} cancelled; {}", event_type.title(), obj, msg
+                        ),
                     )
 
     @takes_instance_or_queryset
@@ -350,7 +344,10 @@ class EventAdmin(DjangoObjectActions, admin.ModelAdmin):
                 obj.cancelled = False
                 obj.save()
                 ActivityLog.objects.create(
-                    log=f"{obj} was uncancelled by admin user {request.user.username}"
+                    action="event_uncancelled",
+                    actor=request.user,
+                    event=obj,
+                    log=f"{obj} was uncancelled by admin user {request.user.username}",
                 )
                 self.message_user(
                     request,
@@ -551,6 +548,127 @@ class WaitingListUserAdmin(admin.ModelAdmin):
     )
 
 
+class BookingCancellationInline(admin.TabularInline):
+    model = BookingCancellation
+    fields = ("booking", "was_booked_with_membership", "refunded", "status", "error")
+    readonly_fields = fields
+    can_delete = False
+    extra = 0
+
+    def has_add_permission(self, request, obj=None):
+        return False
+
+
+@admin.register(EventCancellation)
+class EventCancellationAdmin(admin.ModelAdmin):
+    list_display = (
+        "event",
+        "requested_by",
+        "requested_at",
+        "status",
+        "get_progress",
+        "finished_at",
+    )
+    fields = ("event", "requested_by", "requested_at", "status", "finished_at")
+    readonly_fields = fields
+    list_filter = ("status",)
+    actions = ["retry_failed"]
+    inlines = [BookingCancellationInline]
+
+    def has_add_permission(self, request):
+        return False
+
+    def get_progress(self, obj):
+        progress = obj.progress()
+        return ", ".join(f"{count} {status}" for status, count in progress.items())
+
+    get_progress.short_description = "Bookings"
+
+    def retry_failed(self, request, queryset):
+        retried = sum(
+            retry_failed_booking_cancellations(cancellation)
+            for cancellation in queryset
+        )
+        self.message_user(
+            request, f"{retried} failed booking(s) queued to be cancelled again"
+        )
+
+    retry_failed.short_description = "Retry failed bookings"
+
+    def get_urls(self):
+        urls = super().get_urls()
+        extra_urls = [
+            path(
+                "<int:pk>/progress/",
+                self.admin_site.admin_view(self.progress_view),
+                name="booking_eventcancellation_progress",
+            ),
+        ]
+        return extra_urls + urls
+
+    def progress_view(self, request, pk):
+        """The job's status and counts of bookings by status, for polling"""
+        if not self.has_view_permission(request):
+            return JsonResponse({}, status=403)
+        cancellation = get_object_or_404(EventCancellation, pk=pk)
+        return JsonResponse(
+            {
+                "status": cancellation.status,
+                "finished_at": cancellation.finished_at,
+                **cancellation.progress(),
+            }
+        )
+
+
+@admin.register(OutboxEmail)
+class OutboxEmailAdmin(admin.ModelAdmin):
+    list_display = (
+        "subject",
+        "get_recipients",
+        "status",
+        "attempts",
+        "created_at",
+        "sent_at",
+    )
+    fields = (
+        "subject",
+        "from_email",
+        "to",
+        "cc",
+        "bcc",
+        "reply_to",
+        "status",
+        "attempts",
+        "created_at",
+        "next_attempt_at",
+        "sent_at",
+        "error",
+        "body",
+        "html_body",
+    )
+    readonly_fields = fields
+    search_fields = ("subject", "to", "bcc")
+    list_filter = ("status",)
+    actions = ["resend"]
+
+    def has_add_permission(self, request):
+        return False
+
+    def get_recipients(self, obj):
+        return ", ".join(obj.recipients())
+
+    get_recipients.short_description = "Recipients"
+
+    def resend(self, request, queryset):
+        for outbox_email in queryset:
+            outbox_email.requeue()
+        self.message_user(
+            request, f"{queryset.count()} email(s) queued to be sent again"
+        )
+
+    resend.short_description = "Resend selected emails"
+
+
 @admin.register(MembershipType)
 class MembershipTypeAdmin(admin.ModelAdmin):
     list_display = ("name", "cost", "active")
@@ -0,0 +1,88 @@
+from functools import reduce
+from operator import or_
+
+from django.db.models import Count, Q
+
+from booking.models import Booking, WaitingListUser
+
+
+class UserBookingState:
+    """
+    Booking state (bookings, waiting lists, available memberships and outstanding
+    fees) for one user and a page of events, loaded up front in a fixed number of
+    queries so that the get_booking and book_button_data template tags don't need
+    to query per event
+    """
+
+    def __init__(self, user, events):
+        self.user = user
+        self.events = {event.id: event for event in events}
+        self.bookings = {}
+        self.waiting_list_event_ids = set()
+        self.memberships = []
+        self.has_outstanding_fees = False
+
+        if user.is_anonymous or not self.events:
+            return
+
+        for booking in Booking.objects.filter(
+            user=user, event_id__in=self.events.keys()
+        ):
+            # use the event instances we already have for booking.event
+            booking.event = self.events[booking.event_id]
+            self.bookings[booking.event_id] = booking
+
+        self.waiting_list_event_ids = set(
+            WaitingListUser.objects.filter(
+                user=user, event_id__in=self.events.keys()
+            ).values_list("event_id", flat=True)
+        )
+
+        # memberships are only valid for regular classes in the same month
+        membership_months = {
+            (event.date.month, event.date.year)
+            for event in self.events.values()
+            if event.event_type == "regular_session"
+        }
+        if membership_months:
+            self.memberships = list(
+                user.memberships.filter(
+                    reduce(
+                        or_,
+                        (
+                            Q(month=month, year=year)
+                            for month, year in membership_months
+                        ),
+                    ),
+                    paid=True,
+                )
+                .select_related("membership_type")
+                .annotate(booking_count=Count("bookings"))
+                .order_by("purchase_date")
+            )
+
+        self.has_outstanding_fees = user.has_outstanding_fees()
+
+    def has_event(self, event):
+        return event.id in self.events
+
+    def get_booking(self, event):
+        return self.bookings.get(event.id)
+
+    def on_waiting_list(self, event):
+        return event.id in self.waiting_list_event_ids
+
+    def get_available_user_membership(self, event):
+        """Equivalent of Event.get_available_user_membership, using preloaded memberships"""
+        if event.event_type != "regular_session":
+            return None
+        return next(
+            (
+                membership
+                for membership in self.memberships
+                if membership.month == event.date.month
+                and membership.year == event.date.year
+                and not membership.full()
+            ),
+            None,
+        )
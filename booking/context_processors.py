@@ -1,36 +1,103 @@
 from decimal import Decimal
 from django.conf import settings
+from django.core.cache import cache
+from django.db.models import Max
 from django.utils import timezone
 
-from .models import Event, GiftVoucherType, MembershipType
+from .models import (
+    Event,
+    GiftVoucherType,
+    MembershipType,
+    booking_context_cache_key,
+    cart_item_count_cache_key,
+)
 from .views.views_utils import (
     get_unpaid_gift_vouchers_from_session,
     total_unpaid_item_count,
 )
 
+# Unpaid items also drop out of the cart when they expire, so cached counts are
+# kept short-lived as well as being cleared when the user's items change
+CART_ITEM_COUNT_CACHE_TIMEOUT = 60 * 2
+# Site-wide booking data is cleared when it changes; the timeout is a backstop in
+# case a change is ever missed
+BOOKING_CONTEXT_CACHE_TIMEOUT = 60 * 60
+
 
 def feature_flags(request):
     return {"legacy_homepage": settings.LEGACY_HOMEPAGE}
 
 
+def _latest_event_dates():
+    """Date of the last uncancelled event of each type; cached until events change"""
+    key = booking_context_cache_key("latest_event_dates")
+    latest_event_dates = cache.get(key)
+    if latest_event_dates is None:
+        latest_event_dates = dict(
+            Event.objects.filter(cancelled=False)
+            .values("event_type")
+            .annotate(latest_date=Max("date"))
+            .values_list("event_type", "latest_date")
+        )
+        cache.set(key, latest_event_dates, timeout=BOOKING_CONTEXT_CACHE_TIMEOUT)
+    return latest_event_dates
+
+
 def future_events(request):
-    future_events = Event.objects.filter(date__gt=timezone.now(), cancelled=False)
+    # Compare cached dates with now, so that the flags are still correct when
+    # the last event of a type passes without any event being changed
+    now = timezone.now()
+    latest_event_dates = _latest_event_dates()
+
+    def has_future_events(event_type):
+        latest_date = latest_event_dates.get(event_type)
+        return latest_date is not None and latest_date > now
+
     return {
         "future_events": {
-            "workshops": future_events.filter(event_type="workshop").exists(),
-            "regular_sessions": future_events.filter(
-                event_type="regular_session"
-            ).exists(),
-            "privates": future_events.filter(event_type="private").exists(),
+            "workshops": has_future_events("workshop"),
+            "regular_sessions": has_future_events("regular_session"),
+            "privates": has_future_events("private"),
         },
         "studio_email": settings.DEFAULT_STUDIO_EMAIL,
         "domain": settings.DOMAIN,
     }
 
 
+def _cart_item_count(user):
+    key = cart_item_count_cache_key(user.id)
+    cart_item_count = cache.get(key)
+    if cart_item_count is None:
+        cart_item_count = total_unpaid_item_count(user)
+        cache.set(key, cart_item_count, timeout=CART_ITEM_COUNT_CACHE_TIMEOUT)
+    return cart_item_count
+
+
+def _site_booking_data():
+    key = booking_context_cache_key("site_booking_data")
+    data = cache.get(key)
+    if data is None:
+        regular_classes = Event.objects.filter(event_type="regular_session")
+        if regular_classes.exists():
+            single_cost = regular_classes.latest("id").cost
+        else:
+            single_cost = Decimal(8)
+        data = {
+            "gift_vouchers_available": list(
+                GiftVoucherType.objects.filter(active=True).select_related(
+                    "membership_type"
+                )
+            ),
+            "membership_types": list(MembershipType.objects.filter(active=True)),
+            "single_class_cost": single_cost,
+        }
+        cache.set(key, data, timeout=BOOKING_CONTEXT_CACHE_TIMEOUT)
+    return data
+
+
 def booking(request):
     if request.user.is_authenticated:
-        cart_item_count = total_unpaid_item_count(request.user)
+        cart_item_count = _cart_item_count(request.user)
     else:
         cart_item_count = 0
         purchases = request.session.get("purchases")
@@ -38,18 +105,10 @@ def booking(request):
             gift_vouchers = get_unpaid_gift_vouchers_from_session(request)
             cart_item_count += gift_vouchers.count()
 
-    regular_classes = Event.objects.filter(event_type="regular_session")
-    if regular_classes.exists():
-        single_cost = regular_classes.latest("id").cost
-    else:
-        single_cost = Decimal(8)
-
     return {
         # 'use_cdn': not settings.DEBUG or settings.USE_CDN,
         "studio_email": settings.DEFAULT_STUDIO_EMAIL,
         "cart_item_count": cart_item_count,
-        "gift_vouchers_available": GiftVoucherType.objects.filter(active=True),
         "cart_timeout_mins": settings.CART_TIMEOUT_MINUTES,
-        "membership_types": MembershipType.objects.filter(active=True),
-        "single_class_cost": single_cost,
+        **_site_booking_data(),
     }
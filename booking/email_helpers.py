@@ -1,15 +1,62 @@
+from datetime import timedelta
+import logging
+
 from django.conf import settings
 from django.contrib.auth.models import User
 from django.contrib.sites.models import Site
 from django.core.mail.message import EmailMultiAlternatives
+from django.db import transaction
 from django.template.loader import get_template
+from django.utils import timezone
 
-from activitylog.models import ActivityLog
+from activitylog.models import ActivityLog, buffered_activity_logs
 
-from booking.models import Booking, Event, WaitingListUser
+from booking.models import Booking, Event, WaitingListNotification, WaitingListUser
 from booking.utils import host_from_request
 
 
+logger = logging.getLogger(__name__)
+
+
+def email_context(request, ctx):
+    """Add the studio email and the site's domain and host to an email's context"""
+    ctx.update({"studio_email": settings.DEFAULT_STUDIO_EMAIL})
+    if request:
+        domain = request.get_host()
+        host = host_from_request(request)
+        ctx.update({"domain": domain, "host": host})
+    else:
+        domain = Site.objects.get_current().domain
+        ctx.update({"domain": domain, "host": f"https://{domain}"})
+    return ctx
+
+
+def build_email(
+    subject,
+    body_txt,
+    body_html=None,
+    prefix=settings.ACCOUNT_EMAIL_SUBJECT_PREFIX,
+    to_list=None,
+    from_email=settings.DEFAULT_FROM_EMAIL,
+    cc_list=None,
+    bcc_list=None,
+    reply_to_list=None,
+):
+    """An email with already rendered bodies, e.g. to send the same email to many users"""
+    msg = EmailMultiAlternatives(
+        "{}{}".format("{} ".format(prefix) if prefix else "", subject),
+        body_txt,
+        from_email=from_email,
+        to=to_list or [],
+        bcc=bcc_list or [],
+        cc=cc_list,
+        reply_to=reply_to_list or [settings.DEFAULT_STUDIO_EMAIL],
+    )
+    if body_html:
+        msg.attach_alternative(body_html, "text/html")
+    return msg
+
+
 def send_email(
     request,
     subject,
@@ -23,33 +70,27 @@ def send_email(
     bcc_list=None,
     reply_to_list=None,
 ):
-    to_list = to_list or []
-    bcc_list = bcc_list or []
-    reply_to_list = reply_to_list or [settings.DEFAULT_STUDIO_EMAIL]
-    ctx.update({"studio_email": settings.DEFAULT_STUDIO_EMAIL})
-    if request:
-        domain = request.get_host()
-        host = host_from_request(request)
-        ctx.update({"domain": domain, "host": host})
-    else:
-        domain = Site.objects.get_current().domain
-        ctx.update({"domain": domain, "host": f"https://{domain}"})
-
-    msg = EmailMultiAlternatives(
-        "{}{}".format("{} ".format(prefix) if prefix else "", subject),
+    ctx = email_context(request, ctx)
+    msg = build_email(
+        subject,
         get_template(template_txt).render(ctx),
+        get_template(template_html).render(ctx) if template_html else None,
+        prefix=prefix,
+        to_list=to_list,
         from_email=from_email,
-        to=to_list,
-        bcc=bcc_list,
-        cc=cc_list,
-        reply_to=reply_to_list,
+        cc_list=cc_list,
+        bcc_list=bcc_list,
+        reply_to_list=reply_to_list,
     )
-    if template_html:
-        msg.attach_alternative(get_template(template_html).render(ctx), "text/html")
     msg.send(fail_silently=False)
 
 
-def send_waiting_list_email(event, users, host=None):
+def send_waiting_list_email(event, users, auto_book_users, host=None):
+    """
+    Auto-book the first of the waiting list users with an AUTO_BOOK_EMAILS email,
+    or else email the waiting list if the event has spaces.  auto_book_users are the
+    AUTO_BOOK_EMAILS users, by email.
+    """
     host = host or f"http://{settings.DOMAIN}"
     auto_book_user = None
     user_emails = [user.email for user in users]
@@ -57,33 +98,51 @@ def send_waiting_list_email(event, users, host=None):
     for email in settings.AUTO_BOOK_EMAILS:
         # find first matching autobook email user (who doesn't already have an open booking)
         if email in user_emails:
-            auto_book_user = User.objects.get(email=email)
-            booking, new = Booking.objects.get_or_create(
-                event=event, user=auto_book_user
-            )
+            auto_book_user = auto_book_users[email]
+            # lock the event and check capacity, as in toggle_booking, so a
+            # concurrent booking can't take the space
+            with transaction.atomic():
+                locked_event = event.lock_for_booking()
+                event.open_booking_count = locked_event.open_booking_count
+                if not locked_event.spaces_left:
+                    # the space has been taken again since it was freed
+                    auto_book_user = None
+                    break
+                booking, new = Booking.objects.get_or_create(
+                    event=locked_event, user=auto_book_user
+                )
 
-            # new or not, delete from waiting list and remove from user_emails
-            WaitingListUser.objects.filter(user=auto_book_user, event=event).delete()
-            user_emails.remove(auto_book_user.email)
+                # new or not, delete from waiting list and remove from user_emails
+                WaitingListUser.objects.filter(
+                    user=auto_book_user, event=event
+                ).delete()
+                user_emails.remove(auto_book_user.email)
 
-            if not new:  # for existing bookings, reopen if cancelled
-                if booking.status == "CANCELLED" or booking.no_show:
-                    booking.status = "OPEN"
-                    booking.no_show = False
-                    booking.save()
-                else:  # already booked and open, no need to autobook or send email
-                    auto_book_user = None
+                if not new:  # for existing bookings, reopen if cancelled
+                    if booking.status == "CANCELLED" or booking.no_show:
+                        booking.status = "OPEN"
+                        booking.no_show = False
+                        booking.save()
+                    else:  # already booked and open, no need to autobook or send email
+                        auto_book_user = None
 
             if auto_book_user is not None:
+                if getattr(event, "open_booking_count", None) is not None:
+                    # keep the annotated count in step with the space just taken
+                    event.open_booking_count += 1
                 ActivityLog.objects.create(
+                    action="booking_autocreated",
+                    obj=booking,
                     log="Booking autocreated for User {}, {}".format(
                         auto_book_user.username, event
-                    )
+                    ),
                 )
                 ActivityLog.objects.create(
+                    action="waiting_list_removed",
+                    event=event,
                     log="User {} removed from waiting list for {}".format(
                         auto_book_user.username, event
-                    )
+                    ),
                 )
                 break  # stop if we find an autobook user; we've now filled the space
 
@@ -126,24 +185,102 @@ def send_waiting_list_email(event, users, host=None):
         msg.send(fail_silently=False)
 
         ActivityLog.objects.create(
+            action="waiting_list_email_sent",
+            event=event,
             log="Waiting list email sent to user(s) {} for event {}".format(
                 ", ".join([user.username for user in users]), event
-            )
+            ),
         )
 
 
-def event_waiting_list(event_id):
-    return WaitingListUser.objects.filter(event_id=event_id)
+def send_waiting_list_emails(event_ids, host=None):
+    """
+    Notify the waiting lists of events that may have spaces.  The events, their
+    waiting list users and any auto-book users are fetched up front, rather than
+    per event.  Each event is notified in its own savepoint, so an error for one
+    event is logged and rolled back without stopping the others.
+    """
+    waiting_lists = {}
+    for waiting_list_user in WaitingListUser.objects.filter(
+        event_id__in=event_ids
+    ).select_related("user"):
+        waiting_lists.setdefault(waiting_list_user.event_id, []).append(
+            waiting_list_user.user
+        )
+    if not waiting_lists:
+        return
+
+    auto_book_users = {}
+    if settings.AUTO_BOOK_EMAILS:
+        auto_book_users = {
+            user.email: user
+            for user in User.objects.filter(email__in=settings.AUTO_BOOK_EMAILS)
+        }
+    for event in Event.objects.with_open_booking_count().filter(
+        id__in=waiting_lists, cancelled=False
+    ):
+        try:
+            with transaction.atomic():
+                send_waiting_list_email(
+                    event, waiting_lists[event.id], auto_book_users, host
+                )
+        except Exception as e:
+            logger.error(
+                "Error sending waiting list email for event %s: %s", event.id, e
+            )
 
 
 def email_waiting_lists(event_ids, host=None):
-    for event_id in event_ids:
-        waiting_list_users = event_waiting_list(event_id)
-        if waiting_list_users:
-            event = Event.objects.get(id=event_id)
-            if not event.cancelled:
-                users = [wluser.user for wluser in waiting_list_users]
-                send_waiting_list_email(event, users, host)
+    """
+    Queue notifications for the waiting lists of events that have had a space
+    freed.  They're sent by the send_waiting_list_emails worker once
+    settings.WAITING_LIST_NOTIFICATION_WINDOW seconds have passed, so an event that
+    has spaces freed again within the window is only notified once.  With no window
+    they're sent straight away.
+    """
+    event_ids = set(event_ids)
+    if not event_ids:
+        return
+    window = settings.WAITING_LIST_NOTIFICATION_WINDOW
+    if not window:
+        send_waiting_list_emails(event_ids, host)
+        return
+    notify_at = timezone.now() + timedelta(seconds=window)
+    # an event that already has a pending notification keeps it
+    WaitingListNotification.objects.bulk_create(
+        [
+            WaitingListNotification(
+                event_id=event_id, host=host or "", notify_at=notify_at
+            )
+            for event_id in event_ids
+        ],
+        ignore_conflicts=True,
+    )
+
+
+@buffered_activity_logs()
+def send_due_waiting_list_emails():
+    """
+    Send waiting list notifications that are due, and return the number sent.
+    Notifications are locked while they're sent, so concurrent workers skip them.
+    """
+    with transaction.atomic():
+        notifications = list(
+            WaitingListNotification.objects.filter(notify_at__lte=timezone.now())
+            .select_for_update(skip_locked=True)
+            .order_by("notify_at")
+        )
+        event_ids_by_host = {}
+        for notification in notifications:
+            event_ids_by_host.setdefault(notification.host, set()).add(
+                notification.event_id
+            )
+        for host, event_ids in event_ids_by_host.items():
+            send_waiting_list_emails(event_ids, host or None)
+        WaitingListNotification.objects.filter(
+            id__in=[notification.id for notification in notifications]
+        ).delete()
+    return len(notifications)
 
 
 def send_gift_voucher_email(gift_voucher, request=None):
@@ -0,0 +1,167 @@
+"""
+Queued email delivery.
+
+OutboxEmailBackend is the site's EMAIL_BACKEND, so sending an email (send_email,
+send_mail etc) only stores it as an OutboxEmail; requests don't wait on, or fail
+because of, the mail server.  Emails queued in a transaction that's rolled back are
+never sent.
+
+The send_outbox_emails worker delivers them with settings.EMAIL_DELIVERY_BACKEND,
+in batches of settings.EMAIL_OUTBOX_BATCH_SIZE over one connection, at no more
+than settings.EMAIL_OUTBOX_MAX_PER_SECOND (the provider's sending quota).  Emails
+that fail are retried with backoff, up to OutboxEmail.MAX_ATTEMPTS.
+
+Error reports are sent straight away with send_now, bypassing the outbox.
+"""
+
+import logging
+import time
+
+from django.conf import settings
+from django.core.mail.backends.base import BaseEmailBackend
+from django.core.mail.message import EmailMultiAlternatives
+from django.db import transaction
+from django.utils import timezone
+from django.utils.module_loading import import_string
+
+from booking.models import OutboxEmail
+
+
+logger = logging.getLogger(__name__)
+
+
+def _to_outbox_email(message):
+    if message.attachments:
+        raise ValueError("Emails with attachments can't be queued")
+    return OutboxEmail(
+        subject=str(message.subject),
+        body=str(message.body),
+        html_body=next(
+            (
+                str(content)
+                for content, mimetype in getattr(message, "alternatives", [])
+                if mimetype == "text/html"
+            ),
+            "",
+        ),
+        from_email=message.from_email,
+        to=list(message.to),
+        cc=list(message.cc),
+        bcc=list(message.bcc),
+        reply_to=list(message.reply_to),
+        headers=dict(message.extra_headers),
+    )
+
+
+def _to_email_message(outbox_email):
+    message = EmailMultiAlternatives(
+        subject=outbox_email.subject,
+        body=outbox_email.body,
+        from_email=outbox_email.from_email,
+        to=outbox_email.to,
+        cc=outbox_email.cc,
+        bcc=outbox_email.bcc,
+        reply_to=outbox_email.reply_to,
+        headers=outbox_email.headers,
+    )
+    if outbox_email.html_body:
+        message.attach_alternative(outbox_email.html_body, "text/html")
+    return message
+
+
+class OutboxEmailBackend(BaseEmailBackend):
+    """Queues emails in the outbox, to be sent by the send_outbox_emails worker"""
+
+    def send_messages(self, email_messages):
+        outbox_emails = [
+            _to_outbox_email(message)
+            for message in email_messages
+            if message.recipients()
+        ]
+        OutboxEmail.objects.bulk_create(outbox_emails)
+        return len(outbox_emails)
+
+
+def send_now(message):
+    """
+    Send an email straight away with settings.EMAIL_DELIVERY_BACKEND instead of
+    queueing it, e.g. for error reports, which need to get through even when the
+    database is the problem
+    """
+    return import_string(settings.EMAIL_DELIVERY_BACKEND)().send_messages([message])
+
+
+def _record_failed_attempt(outbox_email, error):
+    outbox_email.error = str(error)
+    outbox_email.schedule_retry()
+    if outbox_email.status == "failed":
+        logger.error("Email %s failed to send: %s", outbox_email.id, error)
+    else:
+        logger.warning(
+            "Error sending email %s (attempt %s), will retry: %s",
+            outbox_email.id,
+            outbox_email.attempts,
+            error,
+        )
+
+
+def _send_batch(batch, throttle):
+    connection = import_string(settings.EMAIL_DELIVERY_BACKEND)()
+    for outbox_email in batch:
+        outbox_email.attempts += 1
+    try:
+        connection.open()
+    except Exception as e:
+        for outbox_email in batch:
+            _record_failed_attempt(outbox_email, e)
+        return
+    try:
+        for outbox_email in batch:
+            throttle()
+            try:
+                # one message at a time, so each email's failure is recorded;
+                # the connection stays open for the whole batch
+                connection.send_messages([_to_email_message(outbox_email)])
+            except Exception as e:
+                _record_failed_attempt(outbox_email, e)
+            else:
+                outbox_email.status = "sent"
+                outbox_email.sent_at = timezone.now()
+                outbox_email.error = ""
+    finally:
+        connection.close()
+
+
+def send_due_emails(limit=None):
+    """
+    Send pending emails that are due, oldest first.  Each batch is locked while
+    it's sent, so concurrent workers skip it; if a worker dies mid batch, the batch
+    is sent again by the next run.  Returns the number of emails attempted.
+    """
+    min_interval = 1 / settings.EMAIL_OUTBOX_MAX_PER_SECOND
+    last_sent_at = 0
+
+    def throttle():
+        nonlocal last_sent_at
+        wait = last_sent_at + min_interval - time.monotonic()
+        if wait > 0:
+            time.sleep(wait)
+        last_sent_at = time.monotonic()
+
+    attempted = 0
+    while limit is None or attempted < limit:
+        batch_size = settings.EMAIL_OUTBOX_BATCH_SIZE
+        if limit is not None:
+            batch_size = min(batch_size, limit - attempted)
+        with transaction.atomic():
+            batch = list(
+                OutboxEmail.due().select_for_update(skip_locked=True)[:batch_size]
+            )
+            if not batch:
+                break
+            _send_batch(batch, throttle)
+            OutboxEmail.objects.bulk_update(
+                batch, ["status", "attempts", "next_attempt_at", "sent_at", "error"]
+            )
+        attempted += len(batch)
+    return attempted
@@ -0,0 +1,216 @@
+"""
+Background cancellation of a cancelled event's open bookings.
+
+Cancelling an event in the admin queues an EventCancellation, and the
+process_event_cancellations worker runs it here: each booking is refunded (or
+credited back to its membership), cancelled and its user emailed, with bookings
+fanned out over a pool of settings.EVENT_CANCELLATION_THREADS threads.
+
+Each booking's progress is saved as it goes, so a job that's interrupted (e.g.
+the worker is restarted) is resumed by the next run without refunding or
+cancelling anything twice.
+"""
+
+from concurrent.futures import ThreadPoolExecutor
+from contextlib import contextmanager
+import logging
+
+from django.conf import settings
+from django.db import connection, transaction
+from django.utils import timezone
+
+from activitylog.models import ActivityLog
+from booking.email_helpers import send_email
+from booking.models import Event, EventCancellation
+from stripe_payments.models import StripeRefund
+from stripe_payments.utils import process_refund
+
+
+logger = logging.getLogger(__name__)
+
+# arbitrary key for the postgres advisory locks held while running a job
+EVENT_CANCELLATION_LOCK_ID = 7314002
+
+
+def event_type_name(event):
+    return (
+        "class"
+        if event.event_type == "regular_session"
+        else dict(Event.EVENT_TYPES)[event.event_type]
+    )
+
+
+def cancel_booking(booking_cancellation):
+    """
+    Refund or credit, cancel and email one booking, and mark it as cancelled.  The
+    refund is recorded as soon as it's made, and everything else is saved in one
+    transaction (with the email queued in the outbox), so it's safe to run again
+    for a booking that was interrupted part way through.
+    """
+    booking = booking_cancellation.booking
+    event = booking.event
+    cancellation = booking_cancellation.cancellation
+    refunded = booking_cancellation.refunded
+
+    if (
+        booking.status == "OPEN"
+        and not booking.membership_id
+        and booking.paid
+        and booking.invoice_id
+        and not refunded
+    ):
+        # a refund for an earlier payment (the booking was cancelled and then paid
+        # for again) doesn't count
+        if StripeRefund.objects.filter(
+            booking_id=booking.id, invoice_id=booking.invoice_id
+        ).exists():
+            refunded = True
+        else:
+            refunded = process_refund(
+                None,
+                booking,
+                cancelled_by=getattr(cancellation.requested_by, "email", ""),
+            )
+        # save straight away, so a resumed job never refunds twice
+        booking_cancellation.refunded = refunded
+        booking_cancellation.save(update_fields=["refunded"])
+
+    with transaction.atomic():
+        if booking.status == "OPEN":
+            booking.membership = None
+            booking.status = "CANCELLED"
+            booking.paid = False
+            booking.save()
+
+        send_email(
+            None,
+            subject="{} has been cancelled".format(event),
+            ctx={
+                "event_type": event_type_name(event),
+                "event": event,
+                "was_booked_with_membership": booking_cancellation.was_booked_with_membership,
+                "refunded": refunded,
+            },
+            template_txt="booking/email/event_cancelled.txt",
+            to_list=[booking.user.email],
+        )
+        ActivityLog.objects.create(
+            action="booking_cancelled",
+            actor=cancellation.requested_by,
+            obj=booking,
+            log=f"Booking {booking.id} for cancelled event {event.id}, "
+            f"user {booking.user.username} was "
+            f"{'refunded' if refunded else 'credited to membership' if booking_cancellation.was_booked_with_membership else 'cancelled'}",
+        )
+        booking_cancellation.status = "cancelled"
+        booking_cancellation.error = ""
+        booking_cancellation.save(update_fields=["status", "error"])
+
+
+def _cancel_booking_and_record_progress(booking_cancellation):
+    try:
+        cancel_booking(booking_cancellation)
+    except Exception as e:
+        logger.error(
+            "Error cancelling booking %s: %s", booking_cancellation.booking_id, e
+        )
+        booking_cancellation.status = "failed"
+        booking_cancellation.error = str(e)
+        booking_cancellation.save(update_fields=["status", "error"])
+
+
+def _cancel_booking_in_thread(booking_cancellation):
+    try:
+        _cancel_booking_and_record_progress(booking_cancellation)
+    finally:
+        # each thread opens its own database connection
+        connection.close()
+
+
+def run_event_cancellation(cancellation):
+    """
+    Cancel the job's pending bookings, and mark the job as done.  ActivityLogs
+    aren't buffered for the job, so each booking's log is committed with its
+    cancellation and isn't lost if the worker is stopped part way through.
+    """
+    pending = list(
+        cancellation.booking_cancellations.filter(status="pending").select_related(
+            "cancellation__requested_by",
+            "booking__event",
+            "booking__user",
+            "booking__invoice",
+        )
+    )
+    threads = min(settings.EVENT_CANCELLATION_THREADS, len(pending))
+    if threads > 1:
+        with ThreadPoolExecutor(max_workers=threads) as executor:
+            # consume the results to re-raise anything unexpected
+            list(executor.map(_cancel_booking_in_thread, pending))
+    else:
+        for booking_cancellation in pending:
+            _cancel_booking_and_record_progress(booking_cancellation)
+
+    cancellation.status = "done"
+    cancellation.finished_at = timezone.now()
+    cancellation.save(update_fields=["status", "finished_at"])
+    progress = cancellation.progress()
+    ActivityLog.objects.create(
+        action="event_cancellation_finished",
+        actor=cancellation.requested_by,
+        event=cancellation.event,
+        log=f"Cancellation of {cancellation.event} finished: {progress['cancelled']} "
+        f"booking(s) cancelled, {progress['failed']} failed",
+    )
+
+
+@contextmanager
+def cancellation_lock(cancellation):
+    """
+    A session lock on the job, so concurrent workers don't run it twice; it's
+    released if the worker dies, so an interrupted job can be picked up again
+    """
+    with connection.cursor() as cursor:
+        cursor.execute(
+            "SELECT pg_try_advisory_lock(%s, %s)",
+            [EVENT_CANCELLATION_LOCK_ID, cancellation.id],
+        )
+        locked = cursor.fetchone()[0]
+    try:
+        yield locked
+    finally:
+        if locked:
+            with connection.cursor() as cursor:
+                cursor.execute(
+                    "SELECT pg_advisory_unlock(%s, %s)",
+                    [EVENT_CANCELLATION_LOCK_ID, cancellation.id],
+                )
+
+
+def process_pending_event_cancellations():
+    """Run pending cancellation jobs, oldest first.  Returns the number run."""
+    processed = 0
+    for cancellation in EventCancellation.objects.filter(status="pending").order_by(
+        "requested_at"
+    ):
+        with cancellation_lock(cancellation) as locked:
+            if not locked:
+                # another worker is running it
+                continue
+            cancellation.refresh_from_db()
+            if cancellation.status != "pending":
+                continue
+            run_event_cancellation(cancellation)
+            processed += 1
+    return processed
+
+
+def retry_failed_booking_cancellations(cancellation):
+    """Queue a job's failed bookings to be tried again"""
+    retried = cancellation.booking_cancellations.filter(status="failed").update(
+        status="pending", error=""
+    )
+    if retried:
+        cancellation.status = "pending"
+        cancellation.finished_at = None
+        cancellation.save(update_fields=["status", "finished_at"])
+    return retried
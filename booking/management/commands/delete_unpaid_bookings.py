@@ -12,14 +12,20 @@ BUT excluding bookings with a checkout_time in the past 5 mins
 (checkout_time is set when user clicks button to pay with stripe)
 
 If any bookings for events are cancelled, and the event has a waiting list, send emails
+
+Run with --interval to keep running as a worker process, sweeping expired bookings
+every <interval> seconds.  Concurrent runs are throttled and locked so the same
+bookings aren't processed twice.
 """
 
 import logging
+import time
+
 from django.core.management.base import BaseCommand
 
 from booking.models import Booking
 from booking.email_helpers import email_waiting_lists
-from activitylog.models import ActivityLog
+from activitylog.models import ActivityLog, buffered_activity_logs
 
 
 logger = logging.getLogger(__name__)
@@ -28,12 +34,36 @@ logger = logging.getLogger(__name__)
 class Command(BaseCommand):
     help = "Cleanup unpaid bookings that have expired"
 
+    def add_arguments(self, parser):
+        parser.add_argument(
+            "--interval",
+            type=int,
+            help="Keep running, cleaning up expired bookings every INTERVAL seconds",
+        )
+
     def handle(self, *args, **options):
+        interval = options.get("interval")
+        if not interval:
+            self.cleanup()
+            return
+
+        while True:
+            try:
+                self.cleanup(use_cache=True)
+            except Exception as e:
+                # keep the worker running; expired bookings will be cleaned up next time
+                logger.error(e)
+            time.sleep(interval)
+
+    @buffered_activity_logs()
+    def cleanup(self, use_cache=False):
         # delete old nothing-to-cancel logs
         cron_log_msg = "CRON: booking cleanup run; nothing to delete"
         ActivityLog.objects.filter(log=cron_log_msg).delete()
-        event_ids_from_expired_bookings = Booking.cleanup_expired_bookings()
+        event_ids_from_expired_bookings = Booking.cleanup_expired_bookings(
+            use_cache=use_cache
+        )
         email_waiting_lists(event_ids_from_expired_bookings)
 
         if not event_ids_from_expired_bookings:
-            ActivityLog.objects.create(log=cron_log_msg)
+            ActivityLog.objects.create(action="empty_job_run", log=cron_log_msg)
@@ -4,77 +4,134 @@ Check for events with date within 48 hrs, but not ones booked/rebooked within th
 Assume that if you just booked, you don't need a reminder immediately
 Email all users on event.bookings where booking.status == 'OPEN' and paid=True
 Add reminder_sent flag to booking model so we don't keep sending
+
+Reminders for an event are the same for every user, so each event's email is
+rendered once; emails are sent over one mail connection in chunks of --chunk-size,
+and each chunk's bookings are marked as reminded in the same transaction as its
+emails are queued, so a chunk is never reminded twice.  Use --dry-run to list the
+reminders that would be sent.
 """
 
 from datetime import timedelta
+from itertools import batched, groupby
+import time
+
 from django.utils import timezone
 from django.conf import settings
+from django.core.mail import mailers
 from django.core.management.base import BaseCommand
-from django.db.models import Q
-from booking.email_helpers import send_email
-from booking.models import Booking, Event
+from django.db import transaction
+from django.template.loader import get_template
+from booking.email_helpers import build_email, email_context
+from booking.models import Booking
 from activitylog.models import ActivityLog
 
 
 class Command(BaseCommand):
     help = "email reminders for upcoming (paid) bookings"
 
-    def handle(self, *args, **options):
-        target_time = timezone.now() + timedelta(hours=48)
-        events = Event.objects.filter(
-            Q(cancelled=False) & Q(date__gte=timezone.now()) & Q(date__lte=target_time)
+    def add_arguments(self, parser):
+        parser.add_argument(
+            "--dry-run",
+            action="store_true",
+            help="List the reminders that would be sent, without sending them",
+        )
+        parser.add_argument(
+            "--chunk-size",
+            type=int,
+            default=500,
+            help="Number of emails to send (and bookings to update) at a time",
         )
 
-        upcoming_bookings = Booking.objects.filter(
-            event__in=events,
-            status="OPEN",
-            no_show=False,
-            reminder_sent=False,
-            paid=True,
-            date_booked__lt=timezone.now() - timedelta(hours=6),
+    def handle(self, *args, **options):
+        started_at = time.monotonic()
+        now = timezone.now()
+        upcoming_bookings = (
+            Booking.objects.filter(
+                event__cancelled=False,
+                event__date__gte=now,
+                event__date__lte=now + timedelta(hours=48),
+                status="OPEN",
+                no_show=False,
+                reminder_sent=False,
+                paid=True,
+                date_booked__lt=now - timedelta(hours=6),
+            )
+            .exclude(date_rebooked__gt=now - timedelta(hours=6))
+            .select_related("event", "user")
+            .order_by("event__date", "event_id", "id")
         )
 
-        reminded_bookings = []
-        for booking in upcoming_bookings:
-            if booking.date_rebooked and booking.date_rebooked > (
-                timezone.now() - timedelta(hours=6)
-            ):
-                continue
-            reminded_bookings.append(booking.id)
-            ctx = {
-                "booking": booking,
-                "event": booking.event,
-                "date": booking.event.date.strftime("%A %d %B"),
-                "time": booking.event.date.strftime("%I:%M %p"),
-                "ev_type": "workshop"
-                if booking.event.event_type == "workshop"
-                else "class",
-                "domain": settings.DOMAIN,
+        reminders = []
+        ctx = email_context(None, {})
+        for event, bookings in groupby(upcoming_bookings, key=lambda b: b.event):
+            event_ctx = {
+                **ctx,
+                "event": event,
+                "date": event.date.strftime("%A %d %B"),
+                "time": event.date.strftime("%I:%M %p"),
+                "ev_type": "workshop" if event.event_type == "workshop" else "class",
             }
-            send_email(
-                None,
-                f"Reminder: your booking for {booking.event}",
-                ctx,
-                template_txt="booking/email/booking_reminder.txt",
-                template_html="booking/email/booking_reminder.html",
-                prefix=settings.ACCOUNT_EMAIL_SUBJECT_PREFIX,
-                from_email=settings.DEFAULT_FROM_EMAIL,
-                to_list=[booking.user.email],
+            body_txt = get_template("booking/email/booking_reminder.txt").render(
+                event_ctx
             )
-            booking.reminder_sent = True
-            booking.save()
-
-            ActivityLog.objects.create(
-                log="Reminder email sent for booking id {} for event {}, "
-                "user {}".format(booking.id, booking.event, booking.user.username)
+            body_html = get_template("booking/email/booking_reminder.html").render(
+                event_ctx
             )
-
-        if upcoming_bookings:
-            self.stdout.write(
-                "Reminder emails sent for booking ids {}".format(
-                    ", ".join([str(id) for id in reminded_bookings])
+            for booking in bookings:
+                reminders.append(
+                    (
+                        booking,
+                        build_email(
+                            f"Reminder: your booking for {event}",
+                            body_txt,
+                            body_html,
+                            prefix=settings.ACCOUNT_EMAIL_SUBJECT_PREFIX,
+                            from_email=settings.DEFAULT_FROM_EMAIL,
+                            to_list=[booking.user.email],
+                        ),
+                    )
                 )
-            )
 
-        else:
+        if not reminders:
             self.stdout.write("No reminders to send")
+            return
+
+        if options["dry_run"]:
+            for booking, email in reminders:
+                self.stdout.write(
+                    f"Would send reminder for booking id {booking.id} for event "
+                    f"{booking.event} to {booking.user.email}"
+                )
+            self.stdout.write(f"{len(reminders)} reminder(s) would be sent (dry run)")
+            return
+
+        with mailers.default as connection:
+            for chunk in batched(reminders, options["chunk_size"]):
+                with transaction.atomic():
+                    connection.send_messages([email for _, email in chunk])
+                    Booking.objects.filter(
+                        id__in=[booking.id for booking, _ in chunk]
+                    ).update(reminder_sent=True)
+                    ActivityLog.objects.bulk_create(
+                        ActivityLog.objects.build(
+                            action="reminder_sent",
+                            obj=booking,
+                            log="Reminder email sent for booking id {} for event "
+                            "{}, user {}".format(
+                                booking.id, booking.event, booking.user.username
+                            ),
+                        )
+                        for booking, _ in chunk
+                    )
+
+        elapsed = max(time.monotonic() - started_at, 0.001)
+        self.stdout.write(
+            "Reminder emails sent for booking ids {}".format(
+                ", ".join([str(booking.id) for booking, _ in reminders])
+            )
+        )
+        self.stdout.write(
+            f"{len(reminders)} reminder(s) sent in {elapsed:.2f}s "
+            f"({len(reminders) / elapsed:.0f}/s)"
+        )
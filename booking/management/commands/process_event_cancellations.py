@@ -0,0 +1,50 @@
+"""
+Cancel the open bookings of events cancelled in the admin.
+
+Each booking is refunded (or credited back to its membership), cancelled and its
+user emailed; see booking/event_cancellation.py.  Jobs interrupted part way through
+are resumed, and bookings that fail are left for an admin to retry.
+
+Run with --interval to keep running as a worker process, checking for new jobs
+every <interval> seconds.
+"""
+
+import logging
+import time
+
+from django.core.management.base import BaseCommand
+
+from booking.event_cancellation import process_pending_event_cancellations
+
+
+logger = logging.getLogger(__name__)
+
+
+class Command(BaseCommand):
+    help = "Cancel the bookings of cancelled events"
+
+    def add_arguments(self, parser):
+        parser.add_argument(
+            "--interval",
+            type=int,
+            help="Keep running, checking for new jobs every INTERVAL seconds",
+        )
+
+    def handle(self, *args, **options):
+        interval = options.get("interval")
+        if not interval:
+            self.process()
+            return
+
+        while True:
+            try:
+                self.process()
+            except Exception as e:
+                # keep the worker running; unfinished jobs will be picked up again
+                logger.error(e)
+            time.sleep(interval)
+
+    def process(self):
+        processed = process_pending_event_cancellations()
+        if processed:
+            self.stdout.write(f"{processed} event cancellation(s) processed")
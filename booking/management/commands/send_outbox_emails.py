@@ -0,0 +1,57 @@
+"""
+Send emails queued in the outbox (see booking/email_outbox.py).
+
+Run with --interval to keep running as a worker process, checking for new emails
+every <interval> seconds.  Use --resend-failed to queue failed emails to be sent
+again (e.g. after fixing the mail server settings).
+"""
+
+import logging
+import time
+
+from django.core.management.base import BaseCommand
+
+from booking.email_outbox import send_due_emails
+from booking.models import OutboxEmail
+
+
+logger = logging.getLogger(__name__)
+
+
+class Command(BaseCommand):
+    help = "Send queued emails"
+
+    def add_arguments(self, parser):
+        parser.add_argument(
+            "--interval",
+            type=int,
+            help="Keep running, sending new emails every INTERVAL seconds",
+        )
+        parser.add_argument(
+            "--resend-failed",
+            action="store_true",
+            help="Send all failed emails again",
+        )
+
+    def handle(self, *args, **options):
+        if options.get("resend_failed"):
+            for outbox_email in OutboxEmail.objects.filter(status="failed"):
+                outbox_email.requeue()
+
+        interval = options.get("interval")
+        if not interval:
+            self.process()
+            return
+
+        while True:
+            try:
+                self.process()
+            except Exception as e:
+                # keep the worker running; unsent emails will be picked up again
+                logger.error(e)
+            time.sleep(interval)
+
+    def process(self):
+        attempted = send_due_emails()
+        if attempted:
+            self.stdout.write(f"{attempted} queued email(s) processed")
@@ -0,0 +1,47 @@
+"""
+Send queued waiting list notifications for events that have had spaces freed
+(see email_waiting_lists in booking/email_helpers.py).
+
+Run with --interval to keep running as a worker process, checking for due
+notifications every <interval> seconds.
+"""
+
+import logging
+import time
+
+from django.core.management.base import BaseCommand
+
+from booking.email_helpers import send_due_waiting_list_emails
+
+
+logger = logging.getLogger(__name__)
+
+
+class Command(BaseCommand):
+    help = "Send queued waiting list emails"
+
+    def add_arguments(self, parser):
+        parser.add_argument(
+            "--interval",
+            type=int,
+            help="Keep running, sending due notifications every INTERVAL seconds",
+        )
+
+    def handle(self, *args, **options):
+        interval = options.get("interval")
+        if not interval:
+            self.process()
+            return
+
+        while True:
+            try:
+                self.process()
+            except Exception as e:
+                # keep the worker running; unsent notifications will be picked up again
+                logger.error(e)
+            time.sleep(interval)
+
+    def process(self):
+        sent = send_due_waiting_list_emails()
+        if sent:
+            self.stdout.write(f"{sent} waiting list notification(s) sent")
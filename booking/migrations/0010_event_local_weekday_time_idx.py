@@ -0,0 +1,31 @@
+# Generated by Django 6.1 on 2026-10-18 04:42
+
+import django.db.models.functions.datetime
+import zoneinfo
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+    dependencies = [
+        ("booking", "0009_alter_event_cancellation_period"),
+        ("timetable", "0013_remove_venue_address_remove_venue_postcode_and_more"),
+    ]
+
+    operations = [
+        migrations.AddIndex(
+            model_name="event",
+            index=models.Index(
+                models.F("event_type"),
+                django.db.models.functions.datetime.ExtractIsoWeekDay(
+                    "date", tzinfo=zoneinfo.ZoneInfo(key="Europe/London")
+                ),
+                django.db.models.functions.datetime.ExtractHour(
+                    "date", tzinfo=zoneinfo.ZoneInfo(key="Europe/London")
+                ),
+                django.db.models.functions.datetime.ExtractMinute(
+                    "date", tzinfo=zoneinfo.ZoneInfo(key="Europe/London")
+                ),
+                name="event_local_weekday_time_idx",
+            ),
+        ),
+    ]
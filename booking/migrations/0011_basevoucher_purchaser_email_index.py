@@ -0,0 +1,19 @@
+# Generated by Django 6.1 on 2026-10-18 05:54
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+    dependencies = [
+        ("booking", "0010_event_local_weekday_time_idx"),
+    ]
+
+    operations = [
+        migrations.AlterField(
+            model_name="basevoucher",
+            name="purchaser_email",
+            field=models.EmailField(
+                blank=True, db_index=True, max_length=254, null=True
+            ),
+        ),
+    ]
@@ -0,0 +1,109 @@
+# Generated by Django 6.1 on 2026-10-18 06:04
+
+from collections import Counter
+
+import django.db.models.deletion
+from django.conf import settings
+from django.db import migrations, models
+
+
+def add_voucher_usage(apps, schema_editor):
+    # as VoucherUsage.recalculate
+    BaseVoucher = apps.get_model("booking", "BaseVoucher")
+    Booking = apps.get_model("booking", "Booking")
+    Membership = apps.get_model("booking", "Membership")
+    VoucherUsage = apps.get_model("booking", "VoucherUsage")
+    Invoice = apps.get_model("stripe_payments", "Invoice")
+    User = apps.get_model(settings.AUTH_USER_MODEL)
+
+    usage = Counter()
+
+    def add_use(voucher_id, user_id, paid, count):
+        field = "paid_uses" if paid else "reserved_uses"
+        for usage_user_id in {None, user_id}:
+            usage[(voucher_id, usage_user_id, field)] += count
+
+    for model in [Membership, Booking]:
+        for voucher_id, user_id, paid, count in (
+            model.objects.filter(voucher__isnull=False)
+            .values_list("voucher_id", "user_id", "paid")
+            .annotate(count=models.Count("id"))
+            .order_by()
+        ):
+            add_use(voucher_id, user_id, paid, count)
+
+    total_voucher_ids = dict(
+        BaseVoucher.objects.filter(totalvoucher__isnull=False).values_list("code", "id")
+    )
+    user_ids = dict(User.objects.values_list("email", "id"))
+    for code, username, count in (
+        Invoice.objects.filter(paid=True, total_voucher_code__in=total_voucher_ids)
+        .values_list("total_voucher_code", "username")
+        .annotate(count=models.Count("id"))
+        .order_by()
+    ):
+        add_use(total_voucher_ids[code], user_ids.get(username), True, count)
+
+    usages = {}
+    for (voucher_id, user_id, field), count in usage.items():
+        voucher_usage = usages.setdefault(
+            (voucher_id, user_id),
+            VoucherUsage(voucher_id=voucher_id, user_id=user_id),
+        )
+        setattr(voucher_usage, field, count)
+    VoucherUsage.objects.bulk_create(usages.values(), batch_size=1000)
+
+
+class Migration(migrations.Migration):
+    dependencies = [
+        ("booking", "0011_basevoucher_purchaser_email_index"),
+        ("stripe_payments", "0003_invoice_cart_fingerprint"),
+        migrations.swappable_dependency(settings.AUTH_USER_MODEL),
+    ]
+
+    operations = [
+        migrations.CreateModel(
+            name="VoucherUsage",
+            fields=[
+                (
+                    "id",
+                    models.AutoField(
+                        auto_created=True,
+                        primary_key=True,
+                        serialize=False,
+                        verbose_name="ID",
+                    ),
+                ),
+                ("paid_uses", models.PositiveIntegerField(default=0)),
+                ("reserved_uses", models.PositiveIntegerField(default=0)),
+                (
+                    "user",
+                    models.ForeignKey(
+                        blank=True,
+                        null=True,
+                        on_delete=django.db.models.deletion.CASCADE,
+                        related_name="voucher_usages",
+                        to=settings.AUTH_USER_MODEL,
+                    ),
+                ),
+                (
+                    "voucher",
+                    models.ForeignKey(
+                        on_delete=django.db.models.deletion.CASCADE,
+                        related_name="usages",
+                        to="booking.basevoucher",
+                    ),
+                ),
+            ],
+            options={
+                "constraints": [
+                    models.UniqueConstraint(
+                        fields=("voucher", "user"),
+                        name="unique_voucher_usage",
+                        nulls_distinct=False,
+                    )
+                ],
+            },
+        ),
+        migrations.RunPython(add_voucher_usage, migrations.RunPython.noop),
+    ]
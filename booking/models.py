@@ -1,17 +1,25 @@
 # -*- coding: utf-8 -*-
 from calendar import monthrange, month_name, month_abbr
+from collections import Counter, namedtuple
 from datetime import datetime, timedelta
 from datetime import timezone as dt_timezone
 
 from dateutil.relativedelta import relativedelta
-from decimal import Decimal
 import logging
 import pytz
 import shortuuid
-
-from django.db import models
-from django.db.models import Q
-from django.db.models.signals import post_delete
+from zoneinfo import ZoneInfo
+
+from django.db import connection, models, transaction
+from django.db.models import Exists, F, OuterRef, Q
+from django.db.models.functions import (
+    Greatest,
+    Coalesce,
+    ExtractHour,
+    ExtractIsoWeekDay,
+    ExtractMinute,
+)
+from django.db.models.signals import post_delete, post_save
 from django.dispatch import receiver
 from django.conf import settings
 from django.contrib.auth.models import User
@@ -26,9 +34,10 @@ from django.utils.translation import gettext_lazy as _
 from django_extensions.db.fields import AutoSlugField
 
 from activitylog.models import ActivityLog
-from stripe_payments.models import Invoice
+from stripe_payments.models import Invoice, RetryQueueItem, invoice_paid
 from timetable.models import Venue
 from booking.utils import (
+    apply_voucher_discount,
     start_of_day_in_utc,
     end_of_day_in_utc,
     start_of_day_in_local_time,
@@ -37,6 +46,13 @@ from booking.utils import (
 logger = logging.getLogger(__name__)
 
 
+LOCAL_TZ = ZoneInfo("Europe/London")
+
+EXPIRED_BOOKINGS_CLEANED_CACHE_KEY = "expired_bookings_cleaned"
+EXPIRED_BOOKINGS_CLEANUP_THROTTLE_SECONDS = 60
+# arbitrary key for the postgres advisory lock held while cleaning up
+EXPIRED_BOOKINGS_CLEANUP_LOCK_ID = 7314001
+
 EVENT_TYPE_CHOICES = (
     ("workshop", "Workshop"),
     ("regular_session", "Regular Timetabled Session"),
@@ -49,6 +65,33 @@ GIFT_VOUCHER_EVENT_TYPES = (
 )
 
 
+class EventQuerySet(models.QuerySet):
+    def with_open_booking_count(self):
+        """
+        Annotate each event with its number of open (not no-show) bookings, so that
+        spaces_left and bookable don't need to run a count query per event
+        """
+        return self.annotate(
+            open_booking_count=models.Count(
+                "bookings", filter=Q(bookings__status="OPEN", bookings__no_show=False)
+            )
+        )
+
+    def on_local_weekday_and_time(self, weekday, hour, minute):
+        """
+        Filter to events on a weekday (0=Monday), at a time (hour, minute) in local
+        (Europe/London) time.  Uses the event_local_weekday_time_idx index.
+        """
+        return self.annotate(
+            local_weekday=ExtractIsoWeekDay("date", tzinfo=LOCAL_TZ),
+            local_hour=ExtractHour("date", tzinfo=LOCAL_TZ),
+            local_minute=ExtractMinute("date", tzinfo=LOCAL_TZ),
+        ).filter(local_weekday=weekday + 1, local_hour=hour, local_minute=minute)
+
+
+EventManager = models.Manager.from_queryset(EventQuerySet)
+
+
 class Event(models.Model):
     EVENT_TYPES = EVENT_TYPE_CHOICES
 
@@ -82,23 +125,47 @@ class Event(models.Model):
         help_text="Classes are only available to students with memberships",
     )
 
+    objects = EventManager()
+
     class Meta:
         ordering = ["-date"]
         verbose_name = "Workshop/Class"
         verbose_name_plural = "Workshops/Classes"
         indexes = [
             models.Index(fields=["date", "event_type"]),
+            # for filtering by local weekday and time (for timetable links)
+            models.Index(
+                F("event_type"),
+                ExtractIsoWeekDay("date", tzinfo=LOCAL_TZ),
+                ExtractHour("date", tzinfo=LOCAL_TZ),
+                ExtractMinute("date", tzinfo=LOCAL_TZ),
+                name="event_local_weekday_time_idx",
+            ),
         ]
 
     @property
     def spaces_left(self):
-        booked_number = (
-            Booking.objects.select_related("event", "user")
-            .filter(event__id=self.id, status="OPEN", no_show=False)
-            .count()
-        )
+        # use the open_booking_count annotation if the event was fetched with
+        # Event.objects.with_open_booking_count()
+        booked_number = getattr(self, "open_booking_count", None)
+        if booked_number is None:
+            booked_number = Booking.objects.filter(
+                event_id=self.id, status="OPEN", no_show=False
+            ).count()
         return self.max_participants - booked_number
 
+    def lock_for_booking(self):
+        """
+        Lock this event's row until the end of the current transaction and return
+        a fresh copy with its open booking count, so capacity is checked once, and
+        can't change, before a booking is saved
+        """
+        event = Event.objects.select_for_update().get(pk=self.pk)
+        event.open_booking_count = event.bookings.filter(
+            status="OPEN", no_show=False
+        ).count()
+        return event
+
     @property
     def bookable(self):
         return self.spaces_left > 0 and not self.cancelled
@@ -136,13 +203,17 @@ class Event(models.Model):
             time_until_event > cancellation_period
         )
 
-    def get_available_user_membership(self, user):
+    def get_available_user_membership(self, user, lock=False):
         if self.event_type != "regular_session":
             # memberships are only valid for regular classes
             return None
         valid_memberships = user.memberships.filter(
             month=self.date.month, year=self.date.year, paid=True
         ).order_by("purchase_date")
+        if lock:
+            # when booking, lock the memberships until the transaction ends so
+            # concurrent bookings can't both use the last class on one
+            valid_memberships = valid_memberships.select_for_update()
         available = next(
             (membership for membership in valid_memberships if not membership.full()),
             None,
@@ -223,7 +294,7 @@ class BaseVoucher(models.Model):
     message = models.TextField(
         null=True, blank=True, max_length=500, help_text="Message (max 500 characters)"
     )
-    purchaser_email = models.EmailField(null=True, blank=True)
+    purchaser_email = models.EmailField(null=True, blank=True, db_index=True)
 
     @property
     def has_expired(self):
@@ -248,6 +319,14 @@ class BaseVoucher(models.Model):
     def _generate_code(self):
         return slugify(shortuuid.ShortUUID().random(length=12))
 
+    def usage(self, user=None):
+        """The voucher's usage counts, across all users or for one user"""
+        usage = VoucherUsage.objects.filter(voucher_id=self.pk, user=user).first()
+        return usage or VoucherUsage(voucher_id=self.pk, user=user)
+
+    def uses(self, user=None):
+        return self.usage(user).paid_uses
+
     def save(self, *args, **kwargs):
         if not self.code:
             self.code = self._generate_code()
@@ -289,39 +368,204 @@ class ItemVoucher(BaseVoucher):
             assert isinstance(item, Booking)
             return self.check_event_type(item.event.event_type)
 
-    def paid_and_unpaid_items(self, user=None):
-        all_items = {
-            "membership": self.memberships.all(),
-            "booking": self.bookings.all(),
-        }
-        if user is not None:
-            return {k: v.filter(user=user) for k, v in all_items.items()}
-        return all_items
-
     def valid_for(self):
         event_type_readable = dict(GIFT_VOUCHER_EVENT_TYPES)
         return list(
             f"Membership - {mem.name}" for mem in self.membership_types.all()
         ) + [f"{event_type_readable[ev_type]} booking" for ev_type in self.event_types]
 
-    def used_items(self, user=None):
-        used_items = {
-            "membership": self.memberships.filter(paid=True),
-            "booking": self.bookings.filter(paid=True),
-        }
-        if user is not None:
-            return {k: v.filter(user=user) for k, v in used_items.items()}
-        return used_items
-
-    def uses(self, user=None):
-        return sum([qs.count() for qs in self.used_items(user=user).values()])
-
 
 class TotalVoucher(BaseVoucher):
     """A voucher that applies to the overall checkout total, not linked to any specific membership or event type"""
 
-    def uses(self):
-        return Invoice.objects.filter(paid=True, total_voucher_code=self.code).count()
+
+# A use of a voucher by a user; paid, or reserved by an unpaid item in a cart
+VoucherUse = namedtuple("VoucherUse", ["voucher_id", "user_id", "paid"])
+
+
+class VoucherUsage(models.Model):
+    """
+    Counts of a voucher's uses, across all users (user is None) and per user.
+    For item vouchers, paid_uses are paid memberships and bookings and
+    reserved_uses are unpaid ones with the voucher applied; for total vouchers,
+    paid_uses are paid invoices.  Kept up to date by update_voucher_usage, so
+    validating a voucher doesn't need to count items.
+    """
+
+    voucher = models.ForeignKey(
+        BaseVoucher, related_name="usages", on_delete=models.CASCADE
+    )
+    user = models.ForeignKey(
+        User,
+        null=True,
+        blank=True,
+        related_name="voucher_usages",
+        on_delete=models.CASCADE,
+    )
+    paid_uses = models.PositiveIntegerField(default=0)
+    reserved_uses = models.PositiveIntegerField(default=0)
+
+    class Meta:
+        constraints = [
+            models.UniqueConstraint(
+                fields=["voucher", "user"],
+                nulls_distinct=False,
+                name="unique_voucher_usage",
+            )
+        ]
+
+    def __str__(self):
+        return f"{self.voucher.code} - {self.user or 'all users'}"
+
+    @classmethod
+    def recalculate(cls):
+        """
+        Recount all voucher usage from memberships, bookings and paid invoices,
+        e.g. after they've been bulk created
+        """
+        usage = Counter()
+
+        def add_use(voucher_id, user_id, paid, count):
+            field = "paid_uses" if paid else "reserved_uses"
+            for usage_user_id in {None, user_id}:
+                usage[(voucher_id, usage_user_id, field)] += count
+
+        for model in [Membership, Booking]:
+            for voucher_id, user_id, paid, count in (
+                model.objects.filter(voucher__isnull=False)
+                .values_list("voucher_id", "user_id", "paid")
+                .annotate(count=models.Count("id"))
+                .order_by()
+            ):
+                add_use(voucher_id, user_id, paid, count)
+
+        total_voucher_ids = dict(TotalVoucher.objects.values_list("code", "id"))
+        user_ids = dict(User.objects.values_list("email", "id"))
+        for code, username, count in (
+            Invoice.objects.filter(paid=True, total_voucher_code__in=total_voucher_ids)
+            .values_list("total_voucher_code", "username")
+            .annotate(count=models.Count("id"))
+            .order_by()
+        ):
+            add_use(total_voucher_ids[code], user_ids.get(username), True, count)
+
+        usages = {}
+        for (voucher_id, user_id, field), count in usage.items():
+            voucher_usage = usages.setdefault(
+                (voucher_id, user_id), cls(voucher_id=voucher_id, user_id=user_id)
+            )
+            setattr(voucher_usage, field, count)
+        with transaction.atomic():
+            cls.objects.all().delete()
+            cls.objects.bulk_create(usages.values(), batch_size=1000)
+
+
+def update_voucher_usage(removed=(), added=()):
+    """
+    Update voucher usage counts for VoucherUses that have been removed (items
+    deleted, or their voucher, user or paid status changed) and added
+    """
+    changes = Counter()
+    for uses, change in [(removed, -1), (added, 1)]:
+        for use in uses:
+            if use is None or use.voucher_id is None:
+                continue
+            field = "paid_uses" if use.paid else "reserved_uses"
+            for user_id in {None, use.user_id}:
+                changes[(use.voucher_id, user_id, field)] += change
+    changes = {key: change for key, change in changes.items() if change}
+    if not changes:
+        return
+
+    with transaction.atomic():
+        # counts only need creating when they're incremented; decrements can
+        # happen while a user (and their counts) is being deleted
+        VoucherUsage.objects.bulk_create(
+            [
+                VoucherUsage(voucher_id=voucher_id, user_id=user_id)
+                for voucher_id, user_id in {
+                    (voucher_id, user_id)
+                    for (voucher_id, user_id, _), change in changes.items()
+                    if change > 0
+                }
+            ],
+            ignore_conflicts=True,
+        )
+        for (voucher_id, user_id, field), change in changes.items():
+            VoucherUsage.objects.filter(voucher_id=voucher_id, user_id=user_id).update(
+                **{field: Greatest(F(field) + change, 0)}
+            )
+
+
+class LoadedValuesMixin:
+    """
+    Snapshots SNAPSHOT_FIELDS as last loaded from or saved to the db, so save()
+    can tell what's changed without fetching the instance again
+    """
+
+    SNAPSHOT_FIELDS = ()
+
+    @classmethod
+    def from_db(cls, db, field_names, values, **kwargs):
+        instance = super().from_db(db, field_names, values, **kwargs)
+        instance._loaded_values = dict(zip(field_names, values))
+        return instance
+
+    def refresh_from_db(self, using=None, fields=None, **kwargs):
+        super().refresh_from_db(using=using, fields=fields, **kwargs)
+        self._update_loaded_values(fields)
+
+    def _update_loaded_values(self, fields=None):
+        loaded_values = getattr(self, "_loaded_values", {})
+        for field_name in fields or self.SNAPSHOT_FIELDS:
+            loaded_values[field_name] = getattr(self, field_name)
+        self._loaded_values = loaded_values
+
+    def _old_value(self, field_name):
+        """The value of field_name as last loaded from or saved to the db"""
+        loaded_values = getattr(self, "_loaded_values", {})
+        if field_name not in loaded_values:
+            # instance wasn't loaded from the db, or the field was deferred
+            loaded_values.update(
+                type(self)
+                ._default_manager.filter(pk=self.pk)
+                .values(*self.SNAPSHOT_FIELDS)
+                .get()
+            )
+            self._loaded_values = loaded_values
+        return loaded_values[field_name]
+
+
+class VoucherItemMixin(LoadedValuesMixin):
+    """
+    An item (membership or booking) that item vouchers can be applied to; saving
+    it updates the vouchers' usage counts
+    """
+
+    SNAPSHOT_FIELDS = VoucherUse._fields
+
+    def voucher_use(self):
+        return VoucherUse(self.voucher_id, self.user_id, self.paid)
+
+    def saved_voucher_use(self):
+        """The item's voucher use as saved in the db, or None if it's new"""
+        if self.pk is None:
+            return None
+        return VoucherUse(*(self._old_value(field) for field in VoucherUse._fields))
+
+    def save(self, *args, **kwargs):
+        saved_voucher_use = self.saved_voucher_use()
+        voucher_use = self.voucher_use()
+        if voucher_use == saved_voucher_use or not (
+            voucher_use.voucher_id or getattr(saved_voucher_use, "voucher_id", None)
+        ):
+            # no voucher usage to update
+            super().save(*args, **kwargs)
+        else:
+            with transaction.atomic():
+                super().save(*args, **kwargs)
+                update_voucher_usage([saved_voucher_use], [voucher_use])
+        self._update_loaded_values()
 
 
 class GiftVoucherType(models.Model):
@@ -602,7 +846,7 @@ class GiftVoucher(models.Model):
         super().save(*args, **kwargs)
 
 
-class Membership(models.Model):
+class Membership(VoucherItemMixin, models.Model):
     user = models.ForeignKey(User, related_name="memberships", on_delete=models.CASCADE)
     membership_type = models.ForeignKey(
         MembershipType, related_name="memberships", on_delete=models.CASCADE
@@ -645,22 +889,18 @@ class Membership(models.Model):
         return not (self.has_expired() or self.full())
 
     def times_used(self):
-        return self.bookings.count()
+        # use the booking_count annotation if the membership was fetched with one
+        booking_count = getattr(self, "booking_count", None)
+        if booking_count is None:
+            booking_count = self.bookings.count()
+        return booking_count
 
     def full(self):
         return self.times_used() >= self.membership_type.number_of_classes
 
     @property
     def cost_with_voucher(self):
-        if not self.voucher:
-            return self.membership_type.cost
-        original_cost = Decimal(float(self.membership_type.cost))
-        if self.voucher.discount_amount:
-            if self.voucher.discount_amount > original_cost:
-                return 0
-            return original_cost - Decimal(self.voucher.discount_amount)
-        percentage_to_pay = Decimal((100 - self.voucher.discount) / 100)
-        return (original_cost * percentage_to_pay).quantize(Decimal(".01"))
+        return apply_voucher_discount(self.membership_type.cost, self.voucher)
 
     def __str__(self) -> str:
         return f"{self.membership_type.name} - {self.month_str} {self.year}"
@@ -669,8 +909,10 @@ class Membership(models.Model):
         return f"{self.membership_type.name} - {month_abbr[self.month]} {self.year}"
 
 
-class Booking(models.Model):
+class Booking(VoucherItemMixin, models.Model):
     STATUS_CHOICES = (("OPEN", "Open"), ("CANCELLED", "Cancelled"))
+    # fields used to detect changes on save
+    SNAPSHOT_FIELDS = ("status", "no_show", "event_id", *VoucherUse._fields)
 
     booking_reference = models.CharField(max_length=22)
     user = models.ForeignKey(User, related_name="bookings", on_delete=models.CASCADE)
@@ -737,84 +979,107 @@ class Booking(models.Model):
     @classmethod
     def cleanup_expired_bookings(cls, user=None, use_cache=False):
         """
-        Delete bookings that are unpaid
+        Delete bookings that are unpaid and whose cart time has expired, in a
+        single DELETE ... RETURNING query.  Returns the ids of the events that had
+        bookings deleted.
         """
         if use_cache:
             # check cache to see if we cleaned up recently
-            if cache.get("expired_bookings_cleaned"):
+            if cache.get(EXPIRED_BOOKINGS_CLEANED_CACHE_KEY):
                 logger.info(
-                    "Expired bookings cleaned up within past 2 mins; no cleanup required"
+                    "Expired bookings cleaned up within past %s seconds; no cleanup required",
+                    EXPIRED_BOOKINGS_CLEANUP_THROTTLE_SECONDS,
                 )
-                return []
+                return set()
 
+        now = timezone.now()
         # timeout defaults to 15 mins
         timeout = settings.CART_TIMEOUT_MINUTES
         checkout_buffer_seconds = 60 * 5
-        queries = Q(
-            event__date__gt=timezone.now(), status="OPEN", no_show=False, paid=False
-        ) & (
-            Q(
-                checkout_time__lt=timezone.now()
-                - timedelta(seconds=checkout_buffer_seconds)
+        # Don't delete anything that was time-checked (done at final checkout stage)
+        # within the past 5 mins, in case we delete something that's in the process
+        # of being paid
+        expired = (
+            cls.objects.annotate(created_at=Coalesce("date_rebooked", "date_booked"))
+            .filter(
+                Q(checkout_time__lt=now - timedelta(seconds=checkout_buffer_seconds))
+                | Q(checkout_time__isnull=True),
+                event__date__gt=now,
+                status="OPEN",
+                no_show=False,
+                paid=False,
+                created_at__lt=now - timedelta(minutes=timeout),
+            )
+            # bookings for a cancelled event are cancelled by its EventCancellation
+            # job, and the raw DELETE can't cascade to the job's BookingCancellations
+            .filter(event__cancelled=False)
+            .exclude(
+                Exists(BookingCancellation.objects.filter(booking_id=OuterRef("pk")))
             )
-            | Q(checkout_time__isnull=True)
+            .order_by()
         )
-        if user:
-            # If we have a user, we're at the checkout, so get all unpaid bookings for
-            # this user only
-            unpaid_bookings = user.bookings.filter(queries)
-        else:
-            # no user, doing a general cleanup.  Don't delete anything that was time-checked
-            # (done at final checkout stage) within the past 5 mins, in case we delete something
-            # that's in the process of being paid
-            unpaid_bookings = cls.objects.filter(queries)
-        created_dates = [
-            (booking, booking.date_rebooked or booking.date_booked)
-            for booking in unpaid_bookings
-        ]
-        expired_ids = [
-            booking.id
-            for booking, created_at in created_dates
-            if created_at < (timezone.now() - timedelta(minutes=timeout))
-        ]
-        expired = cls.objects.filter(id__in=expired_ids)
-        event_ids = set(expired.values_list("event_id", flat=True))
-
-        if expired:
-            if user is not None:
-                ActivityLog.objects.create(
-                    log=f"{expired.count()} bookings for user {user} expired and were deleted"
+        if user is not None:
+            # If we have a user, we're at the checkout, so only clean up this
+            # user's bookings
+            expired = expired.filter(user=user)
+        expired_sql, params = expired.values("id").query.sql_with_params()
+
+        with transaction.atomic(), connection.cursor() as cursor:
+            if user is None:
+                # stop concurrent sweepers deleting the same bookings (and
+                # emailing waiting lists twice); the lock is released on commit
+                cursor.execute(
+                    "SELECT pg_try_advisory_xact_lock(%s)",
+                    [EXPIRED_BOOKINGS_CLEANUP_LOCK_ID],
                 )
-            else:
-                ActivityLog.objects.create(
-                    log=f"{expired.count()} booking cart items expired and were deleted"
+                if not cursor.fetchone()[0]:
+                    logger.info("Expired bookings cleanup already in progress")
+                    return set()
+            table = connection.ops.quote_name(cls._meta.db_table)
+            cursor.execute(
+                f"DELETE FROM {table} WHERE id IN ({expired_sql}) "
+                "RETURNING event_id, user_id, voucher_id",
+                params,
+            )
+            deleted = cursor.fetchall()
+
+            if deleted:
+                if user is not None:
+                    ActivityLog.objects.create(
+                        action="bookings_expired",
+                        log=f"{len(deleted)} bookings for user {user} expired and were deleted",
+                    )
+                else:
+                    ActivityLog.objects.create(
+                        action="bookings_expired",
+                        log=f"{len(deleted)} booking cart items expired and were deleted",
+                    )
+                # expired bookings are all unpaid
+                update_voucher_usage(
+                    removed=[
+                        VoucherUse(voucher_id, user_id, False)
+                        for _, user_id, voucher_id in deleted
+                    ]
                 )
-        expired.delete()
+
+        # deleted in SQL, so post_delete signals aren't sent
+        invalidate_cart_item_count_cache({user_id for _, user_id, _ in deleted})
 
         if use_cache:
             logger.info("Expired bookings cleaned up")
-            # cache for 2 mins
-            cache.set("expired_bookings_cleaned", True, timeout=60 * 2)
+            cache.set(
+                EXPIRED_BOOKINGS_CLEANED_CACHE_KEY,
+                True,
+                timeout=EXPIRED_BOOKINGS_CLEANUP_THROTTLE_SECONDS,
+            )
 
         # return the event ids for bookings that were deleted, so we can check if
         # waiting list emails need to be sent
-        return event_ids
+        return {event_id for event_id, _, _ in deleted}
 
     @property
     def cost_with_voucher(self):
-        if not self.voucher:
-            return self.event.cost
-        original_cost = Decimal(float(self.event.cost))
-        if self.voucher.discount_amount:
-            if self.voucher.discount_amount > original_cost:
-                return 0
-            return original_cost - Decimal(self.voucher.discount_amount)
-        percentage_to_pay = Decimal((100 - self.voucher.discount) / 100)
-        return (original_cost * percentage_to_pay).quantize(Decimal(".01"))
-
-    def _old_booking(self):
-        if self.pk:
-            return Booking.objects.get(pk=self.pk)
+        return apply_voucher_discount(self.event.cost, self.voucher)
 
     def _is_new_booking(self):
         if not self.pk:
@@ -824,18 +1089,38 @@ class Booking(models.Model):
         if not self.pk:
             return False
         was_cancelled = (
-            self._old_booking().status == "CANCELLED" and self.status == "OPEN"
+            self._old_value("status") == "CANCELLED" and self.status == "OPEN"
         )
-        was_no_show = self._old_booking().no_show and not self.no_show
+        was_no_show = self._old_value("no_show") and not self.no_show
         return was_cancelled or was_no_show
 
     def _is_cancelling(self):
         if not self.pk:
             return False
-        cancelling = self._old_booking().status == "OPEN" and self.status == "CANCELLED"
-        setting_as_no_show = self.no_show and not self._old_booking().no_show
+        cancelling = self._old_value("status") == "OPEN" and self.status == "CANCELLED"
+        setting_as_no_show = self.no_show and not self._old_value("no_show")
         return cancelling or setting_as_no_show
 
+    def _full_clean(self):
+        """
+        full_clean, without the queries that can't fail on a normal save: foreign
+        keys are enforced by the db, and user/event uniqueness only needs checking
+        if they've changed
+        """
+        self.clean_fields(
+            exclude=[
+                field.name for field in self._meta.concrete_fields if field.is_relation
+            ]
+        )
+        self.clean()
+        if (
+            self._is_new_booking()
+            or self._old_value("user_id") != self.user_id
+            or self._old_value("event_id") != self.event_id
+        ):
+            self.validate_unique()
+        self.validate_constraints()
+
     def clean(self):
         if self._is_rebooking():
             if self.event.spaces_left == 0:
@@ -863,7 +1148,7 @@ class Booking(models.Model):
         if new_booking:
             self.booking_reference = shortuuid.ShortUUID().random(length=22)
 
-        self.full_clean()
+        self._full_clean()
 
         if rebooking:
             self.date_rebooked = timezone.now()
@@ -872,7 +1157,9 @@ class Booking(models.Model):
                 self.cancellation_fee_incurred = False
                 self.cancellation_fee_paid = False
                 ActivityLog.objects.create(
-                    log=f"Booking {self.id} re-booked; cancellation fee rescinded."
+                    action="cancellation_fee_rescinded",
+                    obj=self,
+                    log=f"Booking {self.id} re-booked; cancellation fee rescinded.",
                 )
         if cancellation:
             self.date_cancelled = timezone.now()
@@ -883,7 +1170,9 @@ class Booking(models.Model):
             ):
                 self.cancellation_fee_incurred = True
                 ActivityLog.objects.create(
-                    log=f"Booking {self.id} cancelled after cancellation period; cancellation fee cancellation_fee_incurred."
+                    action="cancellation_fee_incurred",
+                    obj=self,
+                    log=f"Booking {self.id} cancelled after cancellation period; cancellation fee cancellation_fee_incurred.",
                 )
         # we shouldn't ever set cancellation fee paid without it also being flagged as incurred
         if self.cancellation_fee_paid:
@@ -910,17 +1199,170 @@ class WaitingListUser(models.Model):
         verbose_name_plural = "waiting list"
 
 
-class WorkshopManager(models.Manager):
+class WaitingListNotification(models.Model):
+    """
+    A pending notification to an event's waiting list that a space may have been
+    freed; sent by the send_waiting_list_emails worker (see
+    booking/email_helpers.py).  There's only one per event, so an event freed
+    again before its notification is sent is only notified once.
+    """
+
+    event = models.OneToOneField(
+        Event, related_name="waiting_list_notification", on_delete=models.CASCADE
+    )
+    host = models.CharField(max_length=255, blank=True)
+    created_at = models.DateTimeField(default=timezone.now)
+    notify_at = models.DateTimeField(default=timezone.now, db_index=True)
+
+    def __str__(self):
+        return f"Waiting list notification for {self.event}"
+
+
+class EventCancellation(models.Model):
+    """
+    A background job that cancels a cancelled event's open bookings, refunding
+    and emailing each user; run by the process_event_cancellations worker (see
+    booking/event_cancellation.py).  Progress is recorded per booking, so an
+    interrupted job carries on where it left off.
+    """
+
+    STATUS_CHOICES = (("pending", "Pending"), ("done", "Done"))
+
+    event = models.ForeignKey(
+        Event, related_name="cancellations", on_delete=models.CASCADE
+    )
+    requested_by = models.ForeignKey(
+        User, null=True, blank=True, related_name="+", on_delete=models.SET_NULL
+    )
+    requested_at = models.DateTimeField(default=timezone.now)
+    finished_at = models.DateTimeField(null=True, blank=True)
+    status = models.CharField(max_length=20, choices=STATUS_CHOICES, default="pending")
+
+    class Meta:
+        ordering = ("-requested_at",)
+
+    def __str__(self):
+        return f"Cancellation of {self.event} ({self.status})"
+
+    @classmethod
+    def start(cls, event, requested_by=None):
+        """
+        Queue a job to cancel the event's open bookings.  Returns None if there
+        aren't any.
+        """
+        open_bookings = event.bookings.filter(status="OPEN", no_show=False)
+        booking_ids_and_memberships = list(
+            open_bookings.values_list("id", "membership_id")
+        )
+        if not booking_ids_and_memberships:
+            return None
+        cancellation = cls.objects.create(event=event, requested_by=requested_by)
+        BookingCancellation.objects.bulk_create(
+            BookingCancellation(
+                cancellation=cancellation,
+                booking_id=booking_id,
+                was_booked_with_membership=membership_id is not None,
+            )
+            for booking_id, membership_id in booking_ids_and_memberships
+        )
+        return cancellation
+
+    def progress(self):
+        """Counts of the job's bookings by status"""
+        counts = dict(
+            self.booking_cancellations.values_list("status")
+            .annotate(count=models.Count("id"))
+            .order_by()
+        )
+        return {
+            status: counts.get(status, 0)
+            for status, _ in BookingCancellation.STATUS_CHOICES
+        }
+
+
+class BookingCancellation(models.Model):
+    """The progress of one booking in an EventCancellation"""
+
+    STATUS_CHOICES = (
+        ("pending", "Pending"),
+        ("cancelled", "Cancelled"),
+        ("failed", "Failed"),
+    )
+
+    cancellation = models.ForeignKey(
+        EventCancellation,
+        related_name="booking_cancellations",
+        on_delete=models.CASCADE,
+    )
+    booking = models.ForeignKey(Booking, related_name="+", on_delete=models.CASCADE)
+    # recorded when the job starts, as cancelling removes the booking's membership
+    was_booked_with_membership = models.BooleanField(default=False)
+    refunded = models.BooleanField(default=False)
+    status = models.CharField(max_length=20, choices=STATUS_CHOICES, default="pending")
+    error = models.TextField(blank=True)
+
+    class Meta:
+        constraints = [
+            models.UniqueConstraint(
+                fields=["cancellation", "booking"], name="unique_booking_cancellation"
+            )
+        ]
+
+    def __str__(self):
+        return f"Booking {self.booking_id} ({self.status})"
+
+
+class OutboxEmail(RetryQueueItem):
+    """
+    An email waiting to be sent.  Emails are queued here by the outbox email
+    backend instead of being sent during a request, and delivered in batches by
+    the send_outbox_emails worker (see booking/email_outbox.py).
+    """
+
+    STATUS_CHOICES = (("pending", "Pending"), ("sent", "Sent"), ("failed", "Failed"))
+
+    subject = models.TextField()
+    body = models.TextField()
+    html_body = models.TextField(blank=True)
+    from_email = models.CharField(max_length=255)
+    to = models.JSONField(default=list)
+    cc = models.JSONField(default=list)
+    bcc = models.JSONField(default=list)
+    reply_to = models.JSONField(default=list)
+    headers = models.JSONField(default=dict)
+    status = models.CharField(max_length=20, choices=STATUS_CHOICES, default="pending")
+    created_at = models.DateTimeField(default=timezone.now)
+    sent_at = models.DateTimeField(null=True, blank=True)
+    error = models.TextField(blank=True)
+
+    class Meta:
+        ordering = ("-created_at",)
+        indexes = [
+            models.Index(
+                fields=["next_attempt_at"],
+                condition=models.Q(status="pending"),
+                name="pending_outbox_email_idx",
+            )
+        ]
+
+    def __str__(self):
+        return f"{self.subject} to {', '.join(self.recipients())} ({self.status})"
+
+    def recipients(self):
+        return [*self.to, *self.cc, *self.bcc]
+
+
+class WorkshopManager(EventManager):
     def get_queryset(self):
         return super().get_queryset().filter(event_type="workshop")
 
 
-class RegularSessionManager(models.Manager):
+class RegularSessionManager(EventManager):
     def get_queryset(self):
         return super().get_queryset().filter(event_type="regular_session")
 
 
-class PrivateManager(models.Manager):
+class PrivateManager(EventManager):
     def get_queryset(self):
         return super().get_queryset().filter(event_type="private")
 
@@ -954,12 +1396,11 @@ def user_str_patch(self):
 
 
 def has_outstanding_fees(self):
-    return any(
-        booking.cancellation_fee_incurred
-        and not booking.cancellation_fee_paid
-        and booking.event.cancellation_fee > 0
-        for booking in self.bookings.all()
-    )
+    return self.bookings.filter(
+        cancellation_fee_incurred=True,
+        cancellation_fee_paid=False,
+        event__cancellation_fee__gt=0,
+    ).exists()
 
 
 def outstanding_fees_total(self):
@@ -980,3 +1421,117 @@ def delete_related_voucher(sender, instance, **kwargs):
         if instance.voucher.basevoucher_ptr_id is None:  # pragma: no cover
             instance.voucher.basevoucher_ptr_id = instance.voucher.id
         instance.voucher.delete()
+
+
+@receiver(post_delete, sender=Booking)
+@receiver(post_delete, sender=Membership)
+def voucher_item_deleted(sender, instance, **kwargs):
+    # the row has gone, so use the loaded values (or current ones if not loaded)
+    loaded_values = getattr(instance, "_loaded_values", {})
+    update_voucher_usage(
+        removed=[
+            VoucherUse(
+                *(
+                    loaded_values.get(field, getattr(instance, field))
+                    for field in VoucherUse._fields
+                )
+            )
+        ]
+    )
+
+
+def _total_voucher_use(invoice):
+    """The paid use of a total voucher by an invoice, if it has one"""
+    if not (invoice.paid and invoice.total_voucher_code):
+        return None
+    voucher_id = (
+        TotalVoucher.objects.filter(code=invoice.total_voucher_code)
+        .values_list("id", flat=True)
+        .first()
+    )
+    user_id = (
+        User.objects.filter(email=invoice.username).values_list("id", flat=True).first()
+    )
+    return VoucherUse(voucher_id, user_id, True)
+
+
+@receiver(invoice_paid, sender=Invoice)
+def total_voucher_used(sender, invoice, **kwargs):
+    update_voucher_usage(added=[_total_voucher_use(invoice)])
+
+
+@receiver(post_delete, sender=Invoice)
+def total_voucher_invoice_deleted(sender, instance, **kwargs):
+    update_voucher_usage(removed=[_total_voucher_use(instance)])
+
+
+# CACHING
+
+BOOKING_CONTEXT_VERSION_KEY = "booking_context_version"
+
+
+def booking_context_cache_key(name):
+    """
+    Cache key for site-wide booking data used by the context processors; keys
+    include a version that is bumped whenever events, membership types or gift
+    voucher types change, so stale values are never read
+    """
+    version = cache.get(BOOKING_CONTEXT_VERSION_KEY)
+    if version is None:
+        version = 1
+        cache.set(BOOKING_CONTEXT_VERSION_KEY, version, None)
+    return f"booking_context_{name}_v{version}"
+
+
+def invalidate_booking_context_cache():
+    try:
+        cache.incr(BOOKING_CONTEXT_VERSION_KEY)
+    except ValueError:
+        cache.set(BOOKING_CONTEXT_VERSION_KEY, 1, None)
+
+
+def cart_item_count_cache_key(user_id):
+    return f"user_{user_id}_cart_item_count"
+
+
+def invalidate_cart_item_count_cache(user_ids):
+    cache.delete_many([cart_item_count_cache_key(user_id) for user_id in user_ids])
+
+
+# The caches are cleared once the change is committed; clearing them straight away
+# would let a request that reads the old data before the commit cache it again
+
+
+def booking_context_changed(sender, instance, **kwargs):
+    transaction.on_commit(invalidate_booking_context_cache)
+
+
+def user_cart_changed(sender, instance, **kwargs):
+    user_ids = [instance.user_id]
+    transaction.on_commit(lambda: invalidate_cart_item_count_cache(user_ids))
+
+
+def voucher_cart_changed(sender, instance, **kwargs):
+    # gift vouchers are linked to users by purchaser email only
+    if instance.purchaser_email:
+        user_ids = list(
+            User.objects.filter(email=instance.purchaser_email).values_list(
+                "id", flat=True
+            )
+        )
+        transaction.on_commit(lambda: invalidate_cart_item_count_cache(user_ids))
+
+
+# Proxy models send signals with the proxy class as sender, so each one is
+# connected separately
+for model in [Event, Workshop, RegularClass, Private, MembershipType, GiftVoucherType]:
+    post_save.connect(booking_context_changed, sender=model)
+    post_delete.connect(booking_context_changed, sender=model)
+
+for model in [Booking, Membership]:
+    post_save.connect(user_cart_changed, sender=model)
+    post_delete.connect(user_cart_changed, sender=model)
+
+for model in [GiftVoucher, ItemVoucher, TotalVoucher]:
+    post_save.connect(voucher_cart_changed, sender=model)
+    post_delete.connect(voucher_cart_changed, sender=model)
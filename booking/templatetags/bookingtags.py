@@ -48,8 +48,10 @@ def plural_format(value):
 
 
 @register.simple_tag
-def get_booking(event, user):
+def get_booking(event, user, booking_state=None):
     if user.is_authenticated:
+        if booking_state and booking_state.has_event(event):
+            return booking_state.get_booking(event)
         return Booking.objects.filter(event=event, user=user).first()
     return None
 
@@ -61,15 +63,23 @@ def get_range(value, start=0):
 
 
 @register.simple_tag
-def book_button_data(event, user, booking, ref):
+def book_button_data(event, user, booking, ref, booking_state=None):
     if user.is_anonymous:
         has_available_membership = False
         on_waiting_list = False
+        has_outstanding_fees = False
+    elif booking_state and booking_state.has_event(event):
+        has_available_membership = bool(
+            booking_state.get_available_user_membership(event)
+        )
+        on_waiting_list = booking_state.on_waiting_list(event)
+        has_outstanding_fees = booking_state.has_outstanding_fees
     else:
         has_available_membership = bool(event.get_available_user_membership(user))
         on_waiting_list = WaitingListUser.objects.filter(
             user=user, event=event
         ).exists()
+        has_outstanding_fees = user.has_outstanding_fees()
 
     if booking:
         is_booked = booking.status == "OPEN" and not booking.no_show
@@ -104,4 +114,5 @@ def book_button_data(event, user, booking, ref):
             can_cancel and not event.can_cancel() and event.cancellation_fee > 0
         ),
         "on_waiting_list": on_waiting_list,
+        "has_outstanding_fees": has_outstanding_fees,
     }
@@ -14,6 +14,7 @@ from django.urls import reverse
 
 from activitylog.models import ActivityLog
 import booking.admin as admin
+from booking.event_cancellation import process_pending_event_cancellations
 from booking.models import (
     Event,
     Booking,
@@ -29,6 +30,10 @@ from booking.models import (
 from stripe_payments.models import Invoice, StripeRefund
 
 
+def _admin_request():
+    return Mock(user=baker.make(User, is_superuser=True, email="admin@test.test"))
+
+
 class EventAdminTests(TestCase):
     def test_event_date_list_filter(self):
         baker.make_recipe("booking.past_event", name="past")
@@ -105,8 +110,9 @@ class EventAdminTests(TestCase):
         assert event.bookings.filter(status="OPEN").count() == 3
 
         ev_admin = admin.EventAdmin(Event, AdminSite())
-        request = Mock()
+        request = _admin_request()
         ev_admin.cancel_event(request, Event.objects.filter(id=event.id))
+        process_pending_event_cancellations()
         event.refresh_from_db()
         assert event.cancelled
         for booking in event.bookings.all():
@@ -115,6 +121,18 @@ class EventAdminTests(TestCase):
         # emails sent to 3 open bookings
         assert len(mail.outbox) == 3
 
+    @patch("booking.admin.EventCancellation.start")
+    def test_cancel_event_action_not_cancelled_if_job_not_queued(self, mock_start):
+        mock_start.side_effect = Exception("Error")
+        event = baker.make_recipe("booking.future_EV", max_participants=5)
+        baker.make_recipe("booking.booking", event=event)
+
+        ev_admin = admin.EventAdmin(Event, AdminSite())
+        with pytest.raises(Exception, match="Error"):
+            ev_admin.cancel_event(_admin_request(), Event.objects.filter(id=event.id))
+        event.refresh_from_db()
+        assert not event.cancelled
+
     def test_cancel_event_action_booking_with_membership(self):
         event = baker.make_recipe("booking.future_EV", max_participants=5)
         membership = baker.make_recipe(
@@ -131,8 +149,9 @@ class EventAdminTests(TestCase):
         assert event.bookings.filter(status="OPEN").count() == 1
 
         ev_admin = admin.EventAdmin(Event, AdminSite())
-        request = Mock()
+        request = _admin_request()
         ev_admin.cancel_event(request, Event.objects.filter(id=event.id))
+        process_pending_event_cancellations()
         event.refresh_from_db()
         assert event.cancelled
 
@@ -149,7 +168,7 @@ class EventAdminTests(TestCase):
         assert not membership_booking.paid
         assert membership_booking.membership is None
 
-    @patch("booking.admin.process_refund")
+    @patch("booking.event_cancellation.process_refund")
     def test_cancel_event_action_booking_with_stripe(self, mock_process_refund):
         mock_process_refund.return_value = True
 
@@ -171,8 +190,9 @@ class EventAdminTests(TestCase):
         assert event.bookings.filter(status="OPEN").count() == 1
 
         ev_admin = admin.EventAdmin(Event, AdminSite())
-        request = Mock()
+        request = _admin_request()
         ev_admin.cancel_event(request, Event.objects.filter(id=event.id))
+        process_pending_event_cancellations()
         event.refresh_from_db()
         assert event.cancelled
 
@@ -188,7 +208,9 @@ class EventAdminTests(TestCase):
 
         # test that the process_refund function was called as expected
         mock_process_refund.assert_called_once()
-        mock_process_refund.assert_called_with(request, booking)
+        mock_process_refund.assert_called_with(
+            None, booking, cancelled_by=request.user.email
+        )
 
     def test_cancel_event_action_cancelled_bookings(self):
         event = baker.make_recipe("booking.future_EV", max_participants=5)
@@ -207,8 +229,9 @@ class EventAdminTests(TestCase):
         )
 
         ev_admin = admin.EventAdmin(Event, AdminSite())
-        request = Mock()
+        request = _admin_request()
         ev_admin.cancel_event(request, Event.objects.filter(id=event.id))
+        process_pending_event_cancellations()
         event.refresh_from_db()
         assert event.cancelled
 
@@ -232,8 +255,9 @@ class EventAdminTests(TestCase):
         assert event.bookings.filter(status="OPEN", no_show=False).count() == 0
 
         ev_admin = admin.EventAdmin(Event, AdminSite())
-        request = Mock()
+        request = _admin_request()
         ev_admin.cancel_event(request, Event.objects.filter(id=event.id))
+        process_pending_event_cancellations()
         event.refresh_from_db()
         assert event.cancelled
 
@@ -245,8 +269,9 @@ class EventAdminTests(TestCase):
         assert event.bookings.filter(status="OPEN").count() == 0
 
         ev_admin = admin.EventAdmin(Event, AdminSite())
-        request = Mock()
+        request = _admin_request()
         ev_admin.cancel_event(request, Event.objects.filter(id=event.id))
+        process_pending_event_cancellations()
         assert not Event.objects.exists()
 
         # no emails sent
@@ -257,8 +282,9 @@ class EventAdminTests(TestCase):
         baker.make_recipe("booking.booking", event=event, user__email="test@test.test")
 
         ev_admin = admin.EventAdmin(Event, AdminSite())
-        request = Mock()
+        request = _admin_request()
         ev_admin.cancel_event(request, Event.objects.filter(id=event.id))
+        process_pending_event_cancellations()
         event.refresh_from_db()
         assert not event.cancelled
 
@@ -281,7 +307,7 @@ class EventAdminTests(TestCase):
         assert event.bookings.filter(status="CANCELLED").count() == 3
 
         ev_admin = admin.EventAdmin(Event, AdminSite())
-        request = Mock()
+        request = _admin_request()
         ev_admin.uncancel_event(request, Event.objects.filter(id=event.id))
         event.refresh_from_db()
         assert not event.cancelled
@@ -290,7 +316,11 @@ class EventAdminTests(TestCase):
 
         # emails sent to 3 open bookings
         assert len(mail.outbox) == 0
-        assert "was uncancelled by admin user" in ActivityLog.objects.latest("id").log
+        activity_log = ActivityLog.objects.latest("id")
+        assert "was uncancelled by admin user" in activity_log.log
+        assert activity_log.action == "event_uncancelled"
+        assert activity_log.actor_id == request.user.id
+        assert activity_log.event_id == event.id
 
     def test_cannot_uncancel_past_event_with_cancelled_booking(self):
         assert not ActivityLog.objects.exists()
@@ -322,8 +352,9 @@ class EventAdminTests(TestCase):
         )
 
         ev_admin = admin.EventAdmin(Event, AdminSite())
-        request = Mock()
+        request = _admin_request()
         ev_admin.cancel_event(request, Event.objects.filter(id=event.id))
+        process_pending_event_cancellations()
         event.refresh_from_db()
         assert not event.cancelled
 
@@ -438,8 +469,9 @@ class EventProxyAdminTests(TestCase):
         assert event.bookings.filter(status="OPEN").count() == 3
 
         ev_admin = admin.WorkshopAdmin(Workshop, AdminSite())
-        request = Mock()
+        request = _admin_request()
         ev_admin.cancel_event(request, Workshop.objects.filter(id=event.id))
+        process_pending_event_cancellations()
         event.refresh_from_db()
         assert event.cancelled
         for booking in event.bookings.all():
@@ -466,8 +498,9 @@ class EventProxyAdminTests(TestCase):
         assert event.bookings.filter(status="OPEN").count() == 3
 
         ev_admin = admin.RegularClassAdmin(RegularClass, AdminSite())
-        request = Mock()
+        request = _admin_request()
         ev_admin.cancel_event(request, RegularClass.objects.filter(id=event.id))
+        process_pending_event_cancellations()
         event.refresh_from_db()
         assert event.cancelled
         for booking in event.bookings.all():
@@ -485,8 +518,9 @@ class EventProxyAdminTests(TestCase):
         assert event.bookings.filter(status="OPEN").count() == 3
 
         ev_admin = admin.PrivateAdmin(Private, AdminSite())
-        request = Mock()
+        request = _admin_request()
         ev_admin.cancel_event(request, Private.objects.filter(id=event.id))
+        process_pending_event_cancellations()
         event.refresh_from_db()
         assert event.cancelled
         for booking in event.bookings.all():
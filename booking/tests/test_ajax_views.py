@@ -1,5 +1,7 @@
 # -*- coding: utf-8 -*-
 import json
+import threading
+import time
 from datetime import datetime, timedelta
 from datetime import timezone as dt_timezone
 
@@ -10,7 +12,8 @@ from django.conf import settings
 from django.core import mail
 from django.core.handlers.wsgi import WSGIRequest
 from django.urls import reverse
-from django.test import override_settings, TestCase
+from django.db import connection
+from django.test import Client, override_settings, TestCase, TransactionTestCase
 from django.utils import timezone
 
 from conftest import make_data_privacy_agreement
@@ -953,6 +956,50 @@ class BookingToggleHtmxViewTests(TestCase):
         )
 
 
+class BookingToggleConcurrencyTests(TransactionTestCase):
+    def test_concurrent_bookings_for_last_space(self):
+        """
+        Two users booking the last space at the same time; the event row is locked
+        while capacity is checked, so only one booking is made
+        """
+        event = baker.make_recipe("booking.future_PC", max_participants=1)
+        url = reverse("booking:toggle_booking", args=[event.id])
+        users = baker.make_recipe("booking.user", _quantity=2)
+        for user in users:
+            make_data_privacy_agreement(user)
+
+        in_critical_section = threading.Event()
+        get_available_user_membership = Event.get_available_user_membership
+
+        def slow_get_available_user_membership(self, user, lock=False):
+            # hold the lock long enough for the other request to try to book
+            in_critical_section.set()
+            time.sleep(0.5)
+            return get_available_user_membership(self, user, lock=lock)
+
+        responses = []
+
+        def book(user):
+            client = Client()
+            client.force_login(user)
+            responses.append(client.post(url))
+            connection.close()
+
+        with patch.object(
+            Event, "get_available_user_membership", slow_get_available_user_membership
+        ):
+            first = threading.Thread(target=book, args=(users[0],))
+            first.start()
+            in_critical_section.wait(timeout=5)
+            second = threading.Thread(target=book, args=(users[1],))
+            second.start()
+            first.join()
+            second.join()
+
+        assert Booking.objects.filter(event=event).count() == 1
+        assert sorted(resp.status_code for resp in responses) == [200, 400]
+
+
 class AjaxTests(TestCase):
     @classmethod
     def setUpTestData(cls):
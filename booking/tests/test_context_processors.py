@@ -0,0 +1,129 @@
+from datetime import timedelta
+
+from model_bakery import baker
+import pytest
+
+from django.utils import timezone
+
+from booking.context_processors import booking, future_events
+from booking.models import GiftVoucher, MembershipType
+
+
+pytestmark = pytest.mark.django_db
+
+
+def test_future_events_cached(rf, django_assert_num_queries):
+    baker.make_recipe("booking.future_EV")
+    request = rf.get("/")
+    assert future_events(request)["future_events"] == {
+        "workshops": True,
+        "regular_sessions": False,
+        "privates": False,
+    }
+    with django_assert_num_queries(0):
+        future_events(request)
+
+
+def test_future_events_cache_invalidated_on_event_change(
+    rf, django_capture_on_commit_callbacks
+):
+    request = rf.get("/")
+    with django_capture_on_commit_callbacks(execute=True):
+        workshop = baker.make_recipe("booking.future_EV")
+    assert future_events(request)["future_events"]["workshops"]
+
+    # saving via a proxy model also invalidates the cache
+    with django_capture_on_commit_callbacks(execute=True):
+        baker.make_recipe("booking.future_PC")
+    assert future_events(request)["future_events"]["regular_sessions"]
+
+    with django_capture_on_commit_callbacks(execute=True):
+        workshop.cancelled = True
+        workshop.save()
+    assert not future_events(request)["future_events"]["workshops"]
+
+
+def test_future_events_cache_invalidated_on_commit(
+    rf, django_capture_on_commit_callbacks
+):
+    request = rf.get("/")
+    workshop = baker.make_recipe("booking.future_EV")
+    assert future_events(request)["future_events"]["workshops"]
+
+    with django_capture_on_commit_callbacks() as callbacks:
+        workshop.cancelled = True
+        workshop.save()
+    # a request before the change is committed still gets the cached value, and
+    # doesn't cache the old data after the change is committed
+    assert future_events(request)["future_events"]["workshops"]
+    for callback in callbacks:
+        callback()
+    assert not future_events(request)["future_events"]["workshops"]
+
+
+def test_future_events_ignores_past_events(rf):
+    request = rf.get("/")
+    baker.make_recipe("booking.past_event", event_type="private")
+    assert not future_events(request)["future_events"]["privates"]
+
+
+def test_booking_context_cached(rf, configured_user, django_assert_num_queries):
+    baker.make_recipe("booking.future_PC", cost=12)
+    request = rf.get("/")
+    request.user = configured_user
+    request.session = {}
+    context = booking(request)
+    assert context["cart_item_count"] == 0
+    assert context["single_class_cost"] == 12
+    with django_assert_num_queries(0):
+        booking(request)
+
+
+def test_booking_context_cart_count_invalidated(
+    rf, configured_user, django_capture_on_commit_callbacks
+):
+    request = rf.get("/")
+    request.user = configured_user
+    request.session = {}
+    assert booking(request)["cart_item_count"] == 0
+
+    with django_capture_on_commit_callbacks(execute=True):
+        booking_obj = baker.make_recipe(
+            "booking.booking",
+            user=configured_user,
+            event__date=timezone.now() + timedelta(2),
+        )
+    assert booking(request)["cart_item_count"] == 1
+
+    with django_capture_on_commit_callbacks(execute=True):
+        baker.make_recipe("booking.membership", user=configured_user)
+    assert booking(request)["cart_item_count"] == 2
+
+    gift_voucher = baker.make(GiftVoucher, gift_voucher_type__discount_amount=10)
+    with django_capture_on_commit_callbacks(execute=True):
+        gift_voucher.voucher.purchaser_email = configured_user.email
+        gift_voucher.voucher.save()
+    assert booking(request)["cart_item_count"] == 3
+
+    with django_capture_on_commit_callbacks(execute=True):
+        booking_obj.delete()
+    assert booking(request)["cart_item_count"] == 2
+
+
+def test_booking_context_invalidated_on_type_change(
+    rf, user, gift_voucher_types, django_capture_on_commit_callbacks
+):
+    request = rf.get("/")
+    request.user = user
+    request.session = {}
+    context = booking(request)
+    assert len(context["membership_types"]) == 2
+    assert len(context["gift_vouchers_available"]) == 5
+
+    with django_capture_on_commit_callbacks(execute=True):
+        MembershipType.objects.create(name="new", cost=10, number_of_classes=1)
+        gift_voucher_types["total"].active = False
+        gift_voucher_types["total"].save()
+    context = booking(request)
+    assert len(context["membership_types"]) == 3
+    assert len(context["gift_vouchers_available"]) == 4
@@ -0,0 +1,206 @@
+from datetime import timedelta
+from unittest.mock import Mock, patch
+
+from django.contrib.admin import AdminSite
+from django.core import mail
+from django.core.mail import EmailMessage, send_mail
+from django.core.management import call_command
+from django.utils import timezone
+
+import pytest
+
+from booking.admin import OutboxEmailAdmin
+from booking.email_helpers import send_email
+from booking.email_outbox import send_due_emails
+from booking.models import OutboxEmail
+from stripe_payments.emails import send_failed_payment_emails
+
+
+pytestmark = pytest.mark.django_db
+
+
+@pytest.fixture(autouse=True)
+def outbox_backend(settings):
+    settings.EMAIL_BACKEND = "booking.email_outbox.OutboxEmailBackend"
+    settings.EMAIL_DELIVERY_BACKEND = "django.core.mail.backends.locmem.EmailBackend"
+    settings.EMAIL_OUTBOX_MAX_PER_SECOND = 1000
+
+
+def test_send_email_is_queued():
+    send_email(
+        None,
+        subject="Test",
+        ctx={},
+        template_txt="booking/email/waiting_list_email.txt",
+        template_html="booking/email/waiting_list_email.html",
+        to_list=["test@test.test"],
+        bcc_list=["bcc@test.test"],
+    )
+    assert len(mail.outbox) == 0
+    outbox_email = OutboxEmail.objects.get()
+    assert outbox_email.status == "pending"
+    assert outbox_email.subject.endswith("Test")
+    assert outbox_email.recipients() == ["test@test.test", "bcc@test.test"]
+    assert outbox_email.html_body
+
+    assert send_due_emails() == 1
+    assert len(mail.outbox) == 1
+    email = mail.outbox[0]
+    assert email.subject == outbox_email.subject
+    assert email.to == ["test@test.test"]
+    assert email.bcc == ["bcc@test.test"]
+    assert email.alternatives[0].mimetype == "text/html"
+
+    outbox_email.refresh_from_db()
+    assert outbox_email.status == "sent"
+    assert outbox_email.sent_at is not None
+    assert outbox_email.attempts == 1
+
+    # nothing left to send
+    assert send_due_emails() == 0
+    assert len(mail.outbox) == 1
+
+
+def test_emails_sent_in_batches_over_one_connection(settings):
+    settings.EMAIL_OUTBOX_BATCH_SIZE = 3
+    for i in range(7):
+        send_mail("Test", "Body", None, [f"test{i}@test.test"])
+
+    with patch(
+        "django.core.mail.backends.locmem.EmailBackend.open", autospec=True
+    ) as mock_open:
+        assert send_due_emails() == 7
+    assert mock_open.call_count == 3
+    assert len(mail.outbox) == 7
+    assert not OutboxEmail.objects.exclude(status="sent").exists()
+
+
+def test_failed_email_is_retried_with_backoff():
+    send_mail("Test", "Body", None, ["fail@test.test"])
+    send_mail("Test", "Body", None, ["ok@test.test"])
+
+    def fail_for_some_recipients(backend, messages):
+        if messages[0].to == ["fail@test.test"]:
+            raise Exception("Mailbox unavailable")
+        mail.outbox.extend(messages)
+        return len(messages)
+
+    with patch(
+        "django.core.mail.backends.locmem.EmailBackend.send_messages",
+        autospec=True,
+        side_effect=fail_for_some_recipients,
+    ):
+        assert send_due_emails() == 2
+        # not due to be retried yet
+        assert send_due_emails() == 0
+
+    # one failure doesn't stop the rest of the batch
+    assert [email.to for email in mail.outbox] == [["ok@test.test"]]
+    failed = OutboxEmail.objects.get(status="pending")
+    assert failed.to == ["fail@test.test"]
+    assert failed.attempts == 1
+    assert failed.error == "Mailbox unavailable"
+    assert failed.next_attempt_at > timezone.now() + timedelta(seconds=50)
+
+    failed.next_attempt_at = timezone.now()
+    failed.save()
+    assert send_due_emails() == 1
+    failed.refresh_from_db()
+    assert failed.status == "sent"
+    assert len(mail.outbox) == 2
+
+
+def test_email_fails_after_max_attempts():
+    send_mail("Test", "Body", None, ["test@test.test"])
+    OutboxEmail.objects.update(attempts=OutboxEmail.MAX_ATTEMPTS - 1)
+
+    with patch(
+        "django.core.mail.backends.locmem.EmailBackend.open",
+        side_effect=Exception("Connection refused"),
+    ):
+        send_due_emails()
+
+    outbox_email = OutboxEmail.objects.get()
+    assert outbox_email.status == "failed"
+    assert outbox_email.error == "Connection refused"
+
+    call_command("send_outbox_emails", "--resend-failed")
+    outbox_email.refresh_from_db()
+    assert outbox_email.status == "sent"
+    assert len(mail.outbox) == 1
+
+
+def test_send_rate_is_limited(settings):
+    settings.EMAIL_OUTBOX_MAX_PER_SECOND = 2
+    for i in range(3):
+        send_mail("Test", "Body", None, [f"test{i}@test.test"])
+
+    with patch("booking.email_outbox.time.sleep") as mock_sleep:
+        send_due_emails()
+    # no wait before the first email, then at most 2 per second
+    assert mock_sleep.call_count == 2
+    assert all(0 < call.args[0] <= 0.5 for call in mock_sleep.call_args_list)
+
+
+def test_error_reports_are_not_queued():
+    # they're sent straight away with the delivery backend, so they don't depend
+    # on the database
+    send_failed_payment_emails(error="Error")
+    assert not OutboxEmail.objects.exists()
+    assert mail.outbox[0].subject == "WARNING: Something went wrong with a payment!"
+
+
+def test_emails_with_attachments_cannot_be_queued():
+    message = EmailMessage("Test", "Body", None, ["test@test.test"])
+    message.attach("test.txt", "attachment", "text/plain")
+    with pytest.raises(ValueError, match="attachments"):
+        message.send()
+    assert not OutboxEmail.objects.exists()
+
+
+def test_send_limit():
+    for i in range(3):
+        send_mail("Test", "Body", None, [f"test{i}@test.test"])
+    assert send_due_emails(limit=2) == 2
+    assert len(mail.outbox) == 2
+    assert OutboxEmail.objects.filter(status="pending").count() == 1
+
+
+def test_admin_resend(superuser):
+    send_mail("Test", "Body", None, ["test@test.test"], fail_silently=False)
+    outbox_email = OutboxEmail.objects.get()
+    outbox_email.status = "failed"
+    outbox_email.attempts = OutboxEmail.MAX_ATTEMPTS
+    outbox_email.save()
+    assert str(outbox_email) == "Test to test@test.test (failed)"
+
+    outbox_admin = OutboxEmailAdmin(OutboxEmail, AdminSite())
+    assert outbox_admin.get_recipients(outbox_email) == "test@test.test"
+    with patch.object(outbox_admin, "message_user") as mock_message_user:
+        outbox_admin.resend(Mock(user=superuser), OutboxEmail.objects.all())
+    assert mock_message_user.call_args.args[1] == "1 email(s) queued to be sent again"
+    outbox_email.refresh_from_db()
+    assert outbox_email.status == "pending"
+    assert outbox_email.attempts == 0
+
+
+@patch("booking.management.commands.send_outbox_emails.time.sleep")
+def test_interval_runs_until_stopped(mock_sleep):
+    send_mail("Test", "Body", None, ["test@test.test"])
+    mock_sleep.side_effect = [None, KeyboardInterrupt]
+    with pytest.raises(KeyboardInterrupt):
+        call_command("send_outbox_emails", interval=60)
+    assert mock_sleep.call_count == 2
+    assert len(mail.outbox) == 1
+
+
+@patch("booking.management.commands.send_outbox_emails.logger.error")
+@patch("booking.management.commands.send_outbox_emails.time.sleep")
+@patch("booking.management.commands.send_outbox_emails.send_due_emails")
+def test_interval_keeps_running_after_errors(mock_send, mock_sleep, mock_error):
+    mock_send.side_effect = [Exception("Error"), 1]
+    mock_sleep.side_effect = [None, KeyboardInterrupt]
+    with pytest.raises(KeyboardInterrupt):
+        call_command("send_outbox_emails", interval=60)
+    assert mock_send.call_count == 2
+    mock_error.assert_called_once()
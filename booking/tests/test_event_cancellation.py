@@ -0,0 +1,389 @@
+from contextlib import contextmanager
+from unittest.mock import Mock, patch
+
+from django.contrib.admin.sites import AdminSite
+from django.core import mail
+from django.core.management import call_command
+from django.db import connections
+from django.urls import reverse
+
+from model_bakery import baker
+import pytest
+
+from activitylog.models import ActivityLog
+from booking.admin import EventCancellationAdmin
+from booking.event_cancellation import (
+    EVENT_CANCELLATION_LOCK_ID,
+    process_pending_event_cancellations,
+    retry_failed_booking_cancellations,
+)
+from booking.models import Booking, BookingCancellation, EventCancellation
+from stripe_payments.models import Invoice, StripeRefund
+
+
+pytestmark = pytest.mark.django_db
+
+
+@pytest.fixture
+def event():
+    yield baker.make_recipe("booking.future_EV", max_participants=10)
+
+
+def _make_paid_booking(event, i=0):
+    invoice = baker.make(
+        Invoice,
+        paid=True,
+        username=f"test{i}@test.test",
+        invoice_id=f"inv{i}",
+        stripe_payment_intent_id=f"pi_{i}",
+    )
+    return baker.make_recipe(
+        "booking.booking",
+        event=event,
+        user__email=invoice.username,
+        paid=True,
+        invoice=invoice,
+    )
+
+
+def test_start_records_open_bookings(event, superuser):
+    open_booking = _make_paid_booking(event)
+    membership = baker.make_recipe("booking.membership", paid=True)
+    membership_booking = baker.make_recipe(
+        "booking.booking", event=event, user=membership.user, membership=membership
+    )
+    baker.make_recipe("booking.booking", event=event, no_show=True)
+    baker.make_recipe("booking.booking", event=event, status="CANCELLED")
+
+    cancellation = EventCancellation.start(event, superuser)
+    assert {
+        (bc.booking_id, bc.was_booked_with_membership)
+        for bc in cancellation.booking_cancellations.all()
+    } == {(open_booking.id, False), (membership_booking.id, True)}
+    assert cancellation.progress() == {"pending": 2, "cancelled": 0, "failed": 0}
+
+
+def test_start_no_open_bookings(event):
+    baker.make_recipe("booking.booking", event=event, status="CANCELLED")
+    assert EventCancellation.start(event) is None
+    assert not EventCancellation.objects.exists()
+
+
+@patch("booking.event_cancellation.process_refund")
+def test_run_cancellation(mock_process_refund, event, superuser):
+    mock_process_refund.return_value = True
+    bookings = [_make_paid_booking(event, i) for i in range(3)]
+    cancellation = EventCancellation.start(event, superuser)
+
+    assert process_pending_event_cancellations() == 1
+
+    cancellation.refresh_from_db()
+    assert cancellation.status == "done"
+    assert cancellation.finished_at is not None
+    assert cancellation.progress() == {"pending": 0, "cancelled": 3, "failed": 0}
+    assert mock_process_refund.call_count == 3
+    assert all(bc.refunded for bc in cancellation.booking_cancellations.all())
+    for booking in Booking.objects.filter(id__in=[b.id for b in bookings]):
+        assert booking.status == "CANCELLED"
+        assert not booking.paid
+    assert len(mail.outbox) == 3
+
+    # each booking's cancellation is logged against the booking, the event and the
+    # admin user who cancelled it
+    assert set(
+        ActivityLog.objects.filter(
+            action="booking_cancelled", actor_id=superuser.id, event_id=event.id
+        ).values_list("object_id", flat=True)
+    ) == {booking.id for booking in bookings}
+
+    # nothing left to run
+    assert process_pending_event_cancellations() == 0
+
+
+@patch("booking.event_cancellation.process_refund")
+def test_resume_interrupted_cancellation(mock_process_refund, event, superuser):
+    mock_process_refund.return_value = True
+    refunded_booking = _make_paid_booking(event, 0)
+    refund_recorded_booking = _make_paid_booking(event, 1)
+    cancelled_booking = _make_paid_booking(event, 2)
+    pending_booking = _make_paid_booking(event, 3)
+    cancellation = EventCancellation.start(event, superuser)
+
+    # the worker was stopped after refunding one booking, after a refund was made
+    # for another (but before it was recorded), and after cancelling a third
+    cancellation.booking_cancellations.filter(booking=refunded_booking).update(
+        refunded=True
+    )
+    baker.make(
+        StripeRefund,
+        booking_id=refund_recorded_booking.id,
+        invoice=refund_recorded_booking.invoice,
+        metadata={},
+        amount=10,
+    )
+    cancelled_booking.status = "CANCELLED"
+    cancelled_booking.save()
+
+    process_pending_event_cancellations()
+
+    # only the booking that hadn't been started is refunded
+    mock_process_refund.assert_called_once_with(
+        None, pending_booking, cancelled_by=superuser.email
+    )
+    assert cancellation.progress() == {"pending": 0, "cancelled": 4, "failed": 0}
+    assert Booking.objects.filter(event=event, status="CANCELLED").count() == 4
+    assert len(mail.outbox) == 4
+
+
+@patch("booking.event_cancellation.process_refund")
+def test_bookings_logged_before_worker_stopped(mock_process_refund, event, superuser):
+    # the worker is stopped while refunding the second booking
+    mock_process_refund.side_effect = [True, KeyboardInterrupt]
+    bookings = [_make_paid_booking(event, i) for i in range(2)]
+    EventCancellation.start(event, superuser)
+
+    with pytest.raises(KeyboardInterrupt):
+        process_pending_event_cancellations()
+
+    # the first booking's cancellation was logged as it was cancelled
+    assert list(
+        ActivityLog.objects.filter(action="booking_cancelled").values_list(
+            "object_id", flat=True
+        )
+    ) == [bookings[0].id]
+
+
+@patch("booking.event_cancellation.process_refund")
+def test_rebooked_booking_is_refunded_again(mock_process_refund, event, superuser):
+    mock_process_refund.return_value = True
+    booking = _make_paid_booking(event)
+    # the booking was cancelled and refunded, then reopened and paid for again
+    baker.make(
+        StripeRefund,
+        booking_id=booking.id,
+        invoice=booking.invoice,
+        metadata={},
+        amount=10,
+    )
+    booking.invoice = baker.make(
+        Invoice, paid=True, invoice_id="inv_rebooked", stripe_payment_intent_id="pi_2"
+    )
+    booking.save()
+    cancellation = EventCancellation.start(event, superuser)
+
+    process_pending_event_cancellations()
+
+    mock_process_refund.assert_called_once_with(
+        None, booking, cancelled_by=superuser.email
+    )
+    assert cancellation.booking_cancellations.get().refunded
+
+
+@patch("booking.event_cancellation.process_refund")
+def test_failed_booking_and_retry(mock_process_refund, event, superuser):
+    mock_process_refund.return_value = True
+    for i in range(2):
+        _make_paid_booking(event, i)
+    cancellation = EventCancellation.start(event, superuser)
+
+    with patch(
+        "booking.event_cancellation.send_email",
+        side_effect=[Exception("Mail server down"), None],
+    ):
+        process_pending_event_cancellations()
+
+    # one failure doesn't stop the rest of the job
+    cancellation.refresh_from_db()
+    assert cancellation.status == "done"
+    assert cancellation.progress() == {"pending": 0, "cancelled": 1, "failed": 1}
+    failed = cancellation.booking_cancellations.get(status="failed")
+    assert failed.error == "Mail server down"
+    # the refund was recorded before the email failed, and the booking's
+    # cancellation was rolled back with the email
+    assert failed.refunded
+    assert failed.booking.status == "OPEN"
+
+    assert retry_failed_booking_cancellations(cancellation) == 1
+    cancellation.refresh_from_db()
+    assert cancellation.status == "pending"
+    process_pending_event_cancellations()
+
+    assert cancellation.progress() == {"pending": 0, "cancelled": 2, "failed": 0}
+    assert mock_process_refund.call_count == 2
+    # the retry emails the failed booking's user
+    assert [email.to for email in mail.outbox] == [[failed.booking.user.email]]
+
+
+def test_cancellation_finished_by_another_worker_is_skipped(event):
+    baker.make_recipe("booking.booking", event=event)
+    EventCancellation.start(event)
+
+    @contextmanager
+    def finished_by_other_worker(cancellation):
+        # the other worker finished the job just before releasing its lock
+        EventCancellation.objects.filter(id=cancellation.id).update(status="done")
+        yield True
+
+    with patch(
+        "booking.event_cancellation.cancellation_lock", finished_by_other_worker
+    ):
+        assert process_pending_event_cancellations() == 0
+    assert BookingCancellation.objects.get().status == "pending"
+
+
+def test_locked_cancellation_is_skipped(event):
+    baker.make_recipe("booking.booking", event=event)
+    cancellation = EventCancellation.start(event)
+
+    # another worker is running the job; advisory locks are held per session, so
+    # take the lock from a separate connection
+    other_connection = connections.create_connection("default")
+    try:
+        with other_connection.cursor() as cursor:
+            cursor.execute(
+                "SELECT pg_advisory_lock(%s, %s)",
+                [EVENT_CANCELLATION_LOCK_ID, cancellation.id],
+            )
+        assert process_pending_event_cancellations() == 0
+        assert BookingCancellation.objects.get().status == "pending"
+    finally:
+        other_connection.close()
+
+    # the lock is released when the other worker's connection closes
+    assert process_pending_event_cancellations() == 1
+    assert BookingCancellation.objects.get().status == "cancelled"
+
+
+@pytest.mark.django_db(transaction=True)
+@patch("booking.event_cancellation.process_refund")
+def test_cancel_bookings_in_threads(mock_process_refund, settings, event, superuser):
+    settings.EVENT_CANCELLATION_THREADS = 4
+    mock_process_refund.return_value = True
+    for i in range(6):
+        _make_paid_booking(event, i)
+    cancellation = EventCancellation.start(event, superuser)
+
+    call_command("process_event_cancellations")
+
+    cancellation.refresh_from_db()
+    assert cancellation.status == "done"
+    assert cancellation.progress() == {"pending": 0, "cancelled": 6, "failed": 0}
+    assert mock_process_refund.call_count == 6
+    assert not Booking.objects.filter(event=event, status="OPEN").exists()
+    assert len(mail.outbox) == 6
+
+
+def test_progress_view(client, event, superuser):
+    baker.make_recipe("booking.booking", event=event, _quantity=2)
+    cancellation = EventCancellation.start(event, superuser)
+    url = reverse("admin:booking_eventcancellation_progress", args=(cancellation.id,))
+
+    client.force_login(superuser)
+    assert client.get(url).json() == {
+        "status": "pending",
+        "finished_at": None,
+        "pending": 2,
+        "cancelled": 0,
+        "failed": 0,
+    }
+
+    process_pending_event_cancellations()
+    resp = client.get(url).json()
+    assert resp["status"] == "done"
+    assert resp["cancelled"] == 2
+
+
+def test_progress_view_requires_admin(client, configured_user, event):
+    baker.make_recipe("booking.booking", event=event)
+    cancellation = EventCancellation.start(event)
+    client.force_login(configured_user)
+    resp = client.get(
+        reverse("admin:booking_eventcancellation_progress", args=(cancellation.id,))
+    )
+    # redirected to the admin login
+    assert resp.status_code == 302
+
+
+def test_progress_view_requires_view_permission(client, event):
+    baker.make_recipe("booking.booking", event=event)
+    cancellation = EventCancellation.start(event)
+    client.force_login(baker.make_recipe("booking.user", is_staff=True))
+    resp = client.get(
+        reverse("admin:booking_eventcancellation_progress", args=(cancellation.id,))
+    )
+    assert resp.status_code == 403
+
+
+@patch("booking.event_cancellation.process_refund")
+def test_admin_progress_and_retry_failed(mock_process_refund, event, superuser):
+    mock_process_refund.return_value = True
+    for i in range(2):
+        _make_paid_booking(event, i)
+    cancellation = EventCancellation.start(event, superuser)
+    cancellation_admin = EventCancellationAdmin(EventCancellation, AdminSite())
+    assert (
+        cancellation_admin.get_progress(cancellation)
+        == "2 pending, 0 cancelled, 0 failed"
+    )
+
+    with patch(
+        "booking.event_cancellation.send_email",
+        side_effect=[Exception("Mail server down"), None],
+    ):
+        process_pending_event_cancellations()
+    assert (
+        cancellation_admin.get_progress(cancellation)
+        == "0 pending, 1 cancelled, 1 failed"
+    )
+
+    with patch.object(cancellation_admin, "message_user") as mock_message_user:
+        cancellation_admin.retry_failed(
+            Mock(user=superuser), EventCancellation.objects.all()
+        )
+    assert mock_message_user.call_args.args[1] == (
+        "1 failed booking(s) queued to be cancelled again"
+    )
+    cancellation.refresh_from_db()
+    assert cancellation.status == "pending"
+    assert cancellation.progress() == {"pending": 1, "cancelled": 1, "failed": 0}
+
+
+@patch("booking.management.commands.process_event_cancellations.time.sleep")
+def test_interval_runs_until_stopped(mock_sleep, event):
+    baker.make_recipe("booking.booking", event=event)
+    cancellation = EventCancellation.start(event)
+
+    mock_sleep.side_effect = [None, KeyboardInterrupt]
+    with pytest.raises(KeyboardInterrupt):
+        call_command("process_event_cancellations", interval=60)
+    assert mock_sleep.call_count == 2
+    cancellation.refresh_from_db()
+    assert cancellation.status == "done"
+
+
+@patch("booking.management.commands.process_event_cancellations.logger.error")
+@patch("booking.management.commands.process_event_cancellations.time.sleep")
+@patch(
+    "booking.management.commands.process_event_cancellations."
+    "process_pending_event_cancellations"
+)
+def test_interval_keeps_running_after_errors(mock_process, mock_sleep, mock_error):
+    mock_process.side_effect = [Exception("Error"), 1]
+    mock_sleep.side_effect = [None, KeyboardInterrupt]
+    with pytest.raises(KeyboardInterrupt):
+        call_command("process_event_cancellations", interval=60)
+    assert mock_process.call_count == 2
+    mock_error.assert_called_once()
+
+
+def test_admin_change_page(client, event, superuser):
+    booking = baker.make_recipe("booking.booking", event=event)
+    cancellation = EventCancellation.start(event, superuser)
+    client.force_login(superuser)
+    resp = client.get(
+        reverse("admin:booking_eventcancellation_change", args=(cancellation.id,))
+    )
+    assert resp.status_code == 200
+    # bookings are listed, but can't be added
+    assert str(booking) in resp.content.decode()
+    assert resp.context["inline_admin_formsets"][0].has_add_permission is False
@@ -6,12 +6,13 @@ from unittest.mock import patch
 
 from model_bakery import baker
 
-from django.core.cache import cache
+from django.db import connection
+from django.test.utils import CaptureQueriesContext
 from django.urls import reverse
 from django.utils import timezone
 from django.test import TestCase
 
-from booking.models import Event, Booking, WaitingListUser, Workshop
+from booking.models import Event, Booking, Membership, WaitingListUser, Workshop
 from conftest import make_online_disclaimer
 
 
@@ -134,6 +135,46 @@ class EventListViewTests(TestCase):
         resp = self.client.get(self.workshops_url + "?page=2&tab=foo")
         assert resp.context_data["tab"] == 0
 
+    def test_event_list_annotates_open_booking_count(self):
+        baker.make_recipe("booking.booking", event=self.events[0], _quantity=2)
+        baker.make_recipe("booking.booking", event=self.events[0], status="CANCELLED")
+        resp = self.client.get(self.workshops_url)
+        events = {event.id: event for event in resp.context_data["events"]}
+        assert events[self.events[0].id].open_booking_count == 2
+        assert events[self.events[1].id].open_booking_count == 0
+        assert events[self.events[0].id].spaces_left == (
+            self.events[0].max_participants - 2
+        )
+
+    def test_event_list_booking_queries_do_not_depend_on_number_of_events(self):
+        def _booking_query_count():
+            with CaptureQueriesContext(connection) as ctx:
+                self.client.get(self.classes_url)
+            return len(
+                [
+                    query
+                    for query in ctx.captured_queries
+                    if any(
+                        table in query["sql"]
+                        for table in [
+                            '"booking_booking"',
+                            '"booking_waitinglistuser"',
+                            '"booking_membership"',
+                        ]
+                    )
+                ]
+            )
+
+        baker.make(Membership, user=self.user, paid=True, month=1, year=2030)
+        initial_count = _booking_query_count()
+
+        with self.captureOnCommitCallbacks(execute=True):
+            for event in baker.make_recipe(
+                "booking.future_PC", venue=self.reg_class1.venue, _quantity=10
+            ):
+                baker.make_recipe("booking.booking", event=event, user=self.user)
+        assert _booking_query_count() == initial_count
+
     def test_event_list_past_event(self):
         """
         Test that past events is not listed
@@ -158,7 +199,7 @@ class EventListViewTests(TestCase):
         assert "booked_events" not in resp.context
 
     def test_all_events_shown_for_staff_user(self):
-        hidden_event = Event.objects.all()[0]
+        hidden_event = self.events[0]
         hidden_event.show_on_site = False
         hidden_event.save()
 
@@ -318,6 +359,37 @@ class EventListViewTests(TestCase):
             reg_class3.id,
         ]
 
+    @patch("booking.views.event_views.timezone.now")
+    def test_event_list_with_day_and_time_uses_local_time(self, mock_now):
+        mock_now.return_value = datetime(2019, 1, 1, 18, 0, tzinfo=dt_timezone.utc)
+        self.reg_class1.date = datetime(
+            2019, 1, 23, 18, 0, tzinfo=dt_timezone.utc
+        )  # Wed 18:00 GMT
+        self.reg_class1.save()
+        self.reg_class2.date = datetime(
+            2019, 8, 14, 18, 0, tzinfo=dt_timezone.utc
+        )  # Wed 19:00 BST
+        self.reg_class2.save()
+        dst_class = baker.make_recipe(
+            "booking.future_PC",
+            name="Class 1",
+            date=datetime(2019, 8, 14, 17, 0, tzinfo=dt_timezone.utc),
+        )  # Wed 18:00 BST
+        late_class = baker.make_recipe(
+            "booking.future_PC",
+            name="Class 1",
+            date=datetime(2019, 8, 13, 23, 30, tzinfo=dt_timezone.utc),
+        )  # Wed 00:30 BST (Tues in UTC)
+
+        resp = self.client.get(self.classes_url + "?day=03WE&time=18:00")
+        assert [ev.id for ev in resp.context_data["events"]] == [
+            self.reg_class1.id,
+            dst_class.id,
+        ]
+
+        resp = self.client.get(self.classes_url + "?day=03WE&time=00:30")
+        assert [ev.id for ev in resp.context_data["events"]] == [late_class.id]
+
     def test_outstanding_fees_shows_banner(self):
         baker.make_recipe(
             "booking.booking",
@@ -351,11 +423,11 @@ class EventListViewTests(TestCase):
         )  # for the cancelled booking
         assert 'id="join_waiting_list_button_disabled"' in resp.rendered_content
 
-    def test_event_list_cleans_up_expired_bookings(self):
+    def test_event_list_does_not_clean_up_expired_bookings(self):
         """
-        Test that all events are listed (workshops and other events)
+        Expired bookings are cleaned up by the delete_unpaid_bookings sweeper,
+        not in the request
         """
-        cache.clear()
         now = timezone.now()
         # booked > 15 mins ago
         baker.make(
@@ -364,49 +436,7 @@ class EventListViewTests(TestCase):
             paid=False,
             date_booked=now - timedelta(minutes=30),
         )
-        # booked > 15 mins ago, rebooked < 15 mins ago
-        rebooking = baker.make(
-            "booking.booking",
-            event=self.reg_class1,
-            paid=False,
-            date_booked=now - timedelta(minutes=30),
-            date_rebooked=now - timedelta(minutes=10),
-        )
-        # booked > 15 mins ago, but checkout_time < 5 mins ago
-        checkedout_booking = baker.make(
-            "booking.booking",
-            event=self.reg_class2,
-            paid=False,
-            date_booked=now - timedelta(minutes=30),
-            checkout_time=now - timedelta(minutes=2),
-        )
-        self.client.get(self.workshops_url)
-        # uses cache
-        assert cache.get("expired_bookings_cleaned")
-        self.reg_class1.refresh_from_db()
-        self.reg_class2.refresh_from_db()
-
-        assert self.reg_class1.bookings.count() == 1
-        assert self.reg_class1.bookings.first().id == rebooking.id
-        assert self.reg_class2.bookings.first().id == checkedout_booking.id
-
-        # make another booking that's expired
-        baker.make(
-            "booking.booking",
-            event=self.reg_class1,
-            paid=False,
-            date_booked=now - timedelta(minutes=30),
-        )
-        assert self.reg_class1.bookings.count() == 2
-        # call events again; doesn't get cleaned up b/c cache hasn't expired yet
-        self.client.get(self.workshops_url)
-        self.reg_class1.refresh_from_db()
-        assert self.reg_class1.bookings.count() == 2
-
-        # delete cache item; now it gets cleaned up
-        cache.delete("expired_bookings_cleaned")
         self.client.get(self.workshops_url)
-        self.reg_class1.refresh_from_db()
         assert self.reg_class1.bookings.count() == 1
 
 
@@ -9,6 +9,7 @@ from booking.models import (
     ItemVoucher,
     TotalVoucher,
 )
+from booking.views.views_utils import get_unpaid_gift_vouchers
 
 
 pytestmark = pytest.mark.django_db
@@ -257,3 +258,29 @@ def test_voucher_details_view_gift_voucher_redirect(client, membership_gift_vouc
     assert resp.url == reverse(
         "booking:gift_voucher_details", args=(membership_gift_voucher.slug,)
     )
+
+
+def test_get_unpaid_gift_vouchers(
+    configured_user,
+    membership_gift_voucher,
+    total_gift_voucher,
+    django_assert_num_queries,
+):
+    # other users' unpaid vouchers and the user's paid vouchers aren't included
+    other_voucher = baker.make(
+        GiftVoucher, gift_voucher_type=membership_gift_voucher.gift_voucher_type
+    )
+    other_voucher.voucher.purchaser_email = "other@test.com"
+    other_voucher.voucher.save()
+    paid_voucher = baker.make(
+        GiftVoucher, gift_voucher_type=total_gift_voucher.gift_voucher_type, paid=True
+    )
+    paid_voucher.voucher.purchaser_email = configured_user.email
+    paid_voucher.voucher.save()
+
+    with django_assert_num_queries(1):
+        unpaid_gift_vouchers = list(get_unpaid_gift_vouchers(configured_user))
+    assert sorted(unpaid_gift_vouchers, key=lambda gift_voucher: gift_voucher.id) == [
+        membership_gift_voucher,
+        total_gift_voucher,
+    ]
@@ -2,16 +2,30 @@
 
 from datetime import datetime, timedelta
 from datetime import timezone as dt_timezone
+from io import StringIO
 
 from unittest.mock import patch
 from model_bakery import baker
+import pytest
 
-from django.test import TestCase
+from django.test import TestCase, override_settings
+from django.contrib.sites.models import Site
 from django.core import management
 from django.core import mail
+from django.core.cache import cache
+from django.db import connection, connections
+from django.test.utils import CaptureQueriesContext
 from django.utils import timezone
 
-from booking.models import Booking, Event
+from activitylog.models import ActivityLog
+from booking.models import (
+    EXPIRED_BOOKINGS_CLEANUP_LOCK_ID,
+    Booking,
+    Event,
+    EventCancellation,
+    OutboxEmail,
+    cart_item_count_cache_key,
+)
 
 
 class CancelUnpaidBookingsTests(TestCase):
@@ -58,9 +72,11 @@ class CancelUnpaidBookingsTests(TestCase):
         assert self.unpaid.status == "OPEN", self.unpaid.status
         assert self.paid.status == "OPEN", self.unpaid.status
         assert Booking.objects.count() == 2
-        management.call_command("delete_unpaid_bookings")
+        with self.captureOnCommitCallbacks(execute=True):
+            management.call_command("delete_unpaid_bookings")
 
         assert Booking.objects.count() == 2
+        assert ActivityLog.objects.filter(action="empty_job_run").exists()
 
     @patch("booking.models.timezone")
     def test_dont_cancel_for_already_cancelled(self, mock_tz):
@@ -202,6 +218,81 @@ class CancelUnpaidBookingsTests(TestCase):
         # self.unpaid was rebooked > 15 mins ago
         assert Booking.objects.count() == 1
 
+    @patch("booking.management.commands.delete_unpaid_bookings.time.sleep")
+    def test_interval_throttled_if_cleaned_up_recently(self, mock_sleep):
+        mock_sleep.side_effect = KeyboardInterrupt
+        cache.set("expired_bookings_cleaned", True)
+        with pytest.raises(KeyboardInterrupt):
+            management.call_command("delete_unpaid_bookings", interval=60)
+        assert Booking.objects.count() == 2
+
+    @patch("booking.management.commands.delete_unpaid_bookings.time.sleep")
+    def test_interval_runs_until_stopped(self, mock_sleep):
+        mock_sleep.side_effect = [None, KeyboardInterrupt]
+        with pytest.raises(KeyboardInterrupt):
+            management.call_command("delete_unpaid_bookings", interval=60)
+        assert Booking.objects.count() == 1
+        assert mock_sleep.call_count == 2
+        assert cache.get("expired_bookings_cleaned")
+
+    @patch("booking.management.commands.delete_unpaid_bookings.logger.error")
+    @patch("booking.management.commands.delete_unpaid_bookings.time.sleep")
+    @patch("booking.models.Booking.cleanup_expired_bookings")
+    def test_interval_keeps_running_after_errors(
+        self, mock_cleanup, mock_sleep, mock_error
+    ):
+        mock_cleanup.side_effect = [Exception("Error"), set()]
+        mock_sleep.side_effect = [None, KeyboardInterrupt]
+        with pytest.raises(KeyboardInterrupt):
+            management.call_command("delete_unpaid_bookings", interval=60)
+        assert mock_cleanup.call_count == 2
+        mock_error.assert_called_once()
+
+    def test_skipped_if_another_cleanup_holds_the_lock(self):
+        other_connection = connections.create_connection("default")
+        try:
+            with other_connection.cursor() as cursor:
+                cursor.execute(
+                    "SELECT pg_advisory_lock(%s)", [EXPIRED_BOOKINGS_CLEANUP_LOCK_ID]
+                )
+            management.call_command("delete_unpaid_bookings")
+            assert Booking.objects.count() == 2
+        finally:
+            other_connection.close()
+
+        management.call_command("delete_unpaid_bookings")
+        assert Booking.objects.count() == 1
+
+    def test_clears_cart_item_count_cache(self):
+        cache.set(cart_item_count_cache_key(self.unpaid.user_id), 1)
+        management.call_command("delete_unpaid_bookings")
+        assert cache.get(cart_item_count_cache_key(self.unpaid.user_id)) is None
+
+    def test_bookings_in_an_event_cancellation_are_not_deleted(self):
+        cancellation = EventCancellation.start(self.event)
+        cancellation.booking_cancellations.filter(booking=self.unpaid).update(
+            status="failed"
+        )
+        self.event.cancelled = True
+        self.event.save()
+        other_unpaid = baker.make_recipe(
+            "booking.booking",
+            event__date=self.event.date,
+            paid=False,
+            status="OPEN",
+            date_booked=self.unpaid.date_booked,
+        )
+
+        management.call_command("delete_unpaid_bookings")
+        assert Booking.objects.filter(id=self.unpaid.id).exists()
+        assert not Booking.objects.filter(id=other_unpaid.id).exists()
+
+        # nor at checkout, even if the event has been reopened since
+        self.event.cancelled = False
+        self.event.save()
+        assert Booking.cleanup_expired_bookings(user=self.unpaid.user) == set()
+        assert Booking.objects.filter(id=self.unpaid.id).exists()
+
 
 class EmailRemindersTests(TestCase):
     @classmethod
@@ -367,3 +458,87 @@ class EmailRemindersTests(TestCase):
         self.assertFalse(self.event_more_than_48_hrs.bookings.first().reminder_sent)
         self.assertFalse(self.past_event.bookings.first().reminder_sent)
         self.assertFalse(booking.reminder_sent)
+
+    def _make_reminder_bookings(self, count):
+        event = self.event_within_48_hrs
+        event.max_participants = 20
+        event.save()
+        return [
+            baker.make_recipe(
+                "booking.booking",
+                event=event,
+                user__email=f"test{i}@test.com",
+                date_booked=datetime(2015, 2, 8, 12, 0, tzinfo=dt_timezone.utc),
+                paid=True,
+            )
+            for i in range(count)
+        ]
+
+    @patch("booking.management.commands.email_reminders.timezone")
+    def test_reminders_sent_in_chunks(self, mock_tz):
+        mock_tz.now.return_value = self.mock_now
+        bookings = self._make_reminder_bookings(4)
+        out = StringIO()
+        management.call_command("email_reminders", "--chunk-size", "2", stdout=out)
+        # 5 bookings for the event, including the one from setUp
+        assert len(mail.outbox) == 5
+        assert {email.to[0] for email in mail.outbox} == {
+            "test@test.com",
+            *(booking.user.email for booking in bookings),
+        }
+        assert not self.event_within_48_hrs.bookings.filter(
+            reminder_sent=False
+        ).exists()
+        assert (
+            ActivityLog.objects.filter(log__startswith="Reminder email sent").count()
+            == 5
+        )
+        assert "5 reminder(s) sent in" in out.getvalue()
+
+    @override_settings(EMAIL_BACKEND="booking.email_outbox.OutboxEmailBackend")
+    @patch("booking.management.commands.email_reminders.timezone")
+    def test_reminder_chunk_queued_and_marked_together(self, mock_tz):
+        mock_tz.now.return_value = self.mock_now
+        self._make_reminder_bookings(3)
+        # the job stops while finishing the second chunk
+        with patch.object(
+            ActivityLog.objects, "bulk_create", side_effect=[[], Exception("Error")]
+        ):
+            with pytest.raises(Exception, match="Error"):
+                management.call_command(
+                    "email_reminders", "--chunk-size", "2", stdout=StringIO()
+                )
+        # only the first chunk's emails were queued, and its bookings marked
+        assert OutboxEmail.objects.count() == 2
+        assert self.event_within_48_hrs.bookings.filter(reminder_sent=True).count() == 2
+
+    @patch("booking.management.commands.email_reminders.timezone")
+    def test_reminders_queries_dont_increase_with_bookings(self, mock_tz):
+        mock_tz.now.return_value = self.mock_now
+        # the current site is cached after the first lookup
+        Site.objects.get_current()
+        self._make_reminder_bookings(2)
+        with CaptureQueriesContext(connection) as queries:
+            management.call_command("email_reminders", stdout=StringIO())
+        query_count = len(queries)
+        Booking.objects.update(reminder_sent=False)
+
+        self._make_reminder_bookings(10)
+        with CaptureQueriesContext(connection) as queries:
+            management.call_command("email_reminders", stdout=StringIO())
+        assert len(queries) == query_count
+
+    @patch("booking.management.commands.email_reminders.timezone")
+    def test_reminders_dry_run(self, mock_tz):
+        mock_tz.now.return_value = self.mock_now
+        out = StringIO()
+        management.call_command("email_reminders", "--dry-run", stdout=out)
+        booking = self.event_within_48_hrs.bookings.first()
+        assert f"Would send reminder for booking id {booking.id}" in out.getvalue()
+        assert "1 reminder(s) would be sent (dry run)" in out.getvalue()
+        assert len(mail.outbox) == 0
+        booking.refresh_from_db()
+        assert not booking.reminder_sent
+        assert not ActivityLog.objects.filter(
+            log__startswith="Reminder email sent"
+        ).exists()
@@ -76,7 +76,11 @@ def test_membership_purchase_login_not_required(
 
 
 def test_get_available_memberships_to_purchase(
-    client, configured_user, membership_type, membership_type_4
+    client,
+    configured_user,
+    membership_type,
+    membership_type_4,
+    django_capture_on_commit_callbacks,
 ):
     client.force_login(configured_user)
     resp = client.get(buy_url)
@@ -84,8 +88,9 @@ def test_get_available_memberships_to_purchase(
     # all membership types available
     assert len(resp.context["membership_types"]) == 2
     # only shows active
-    membership_type.active = False
-    membership_type.save()
+    with django_capture_on_commit_callbacks(execute=True):
+        membership_type.active = False
+        membership_type.save()
     resp = client.get(buy_url)
     assert len(resp.context["membership_types"]) == 1
 
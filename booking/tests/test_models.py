@@ -24,6 +24,7 @@ from booking.models import (
     Membership,
     MembershipType,
     TotalVoucher,
+    VoucherUsage,
 )
 from booking.utils import start_of_day_in_local_time
 from stripe_payments.models import Invoice
@@ -45,6 +46,26 @@ class EventTests(TestCase):
         event = Event.objects.get(id=event.id)
         self.assertFalse(event.bookable)
 
+    def test_spaces_left_with_open_booking_count(self):
+        event = baker.make_recipe("booking.future_EV", max_participants=3)
+        baker.make_recipe("booking.booking", event=event)
+        baker.make_recipe("booking.booking", event=event, status="CANCELLED")
+        baker.make_recipe("booking.booking", event=event, no_show=True)
+
+        event = Event.objects.with_open_booking_count().get(id=event.id)
+        assert event.open_booking_count == 1
+        # spaces_left uses the annotation, no count query required
+        with self.assertNumQueries(0):
+            assert event.spaces_left == 2
+            assert event.bookable
+
+    def test_spaces_left_without_open_booking_count(self):
+        event = baker.make_recipe("booking.future_EV", max_participants=3)
+        baker.make_recipe("booking.booking", event=event)
+        event = Event.objects.get(id=event.id)
+        with self.assertNumQueries(1):
+            assert event.spaces_left == 2
+
     def test_str(self):
         event = baker.make_recipe(
             "booking.past_event",
@@ -413,6 +434,29 @@ class BookingTests(TestCase):
         self.assertFalse(booking.cancellation_fee_incurred)
         self.assertFalse(booking.cancellation_fee_paid)
 
+    def test_cancel_booking_uses_loaded_state(self):
+        booking = baker.make_recipe("booking.booking", event=self.event_with_cost)
+        booking = Booking.objects.select_related("event").get(id=booking.id)
+        booking.status = "CANCELLED"
+        # no queries to check the old status; just the update
+        with self.assertNumQueries(1):
+            booking.save()
+        assert booking.date_cancelled is not None
+
+        # reopening counts spaces left, then updates
+        booking.status = "OPEN"
+        with self.assertNumQueries(2):
+            booking.save()
+        assert booking.date_rebooked is not None
+
+    def test_booking_state_updated_on_refresh_from_db(self):
+        booking = baker.make_recipe("booking.booking", event=self.event_with_cost)
+        Booking.objects.filter(id=booking.id).update(status="CANCELLED")
+        booking.refresh_from_db()
+        booking.status = "OPEN"
+        booking.save()
+        assert booking.date_rebooked is not None
+
 
 @pytest.mark.django_db
 def test_membership_type_model():
@@ -500,6 +544,130 @@ def test_total_voucher_uses():
     assert voucher.uses() == 3
 
 
+def _usage_counts(voucher, user=None):
+    usage = voucher.usage(user)
+    return usage.paid_uses, usage.reserved_uses
+
+
+@pytest.mark.django_db
+def test_voucher_usage_updated_when_items_change():
+    voucher = baker.make(ItemVoucher, discount=10, event_types=["private"])
+    user = baker.make(User)
+    other_user = baker.make(User)
+
+    booking = baker.make(Booking, user=user, voucher=voucher, paid=False)
+    membership = baker.make(Membership, user=user, voucher=voucher, paid=False)
+    assert _usage_counts(voucher) == (0, 2)
+    assert _usage_counts(voucher, user) == (0, 2)
+
+    booking.paid = True
+    booking.save()
+    assert _usage_counts(voucher) == (1, 1)
+    assert _usage_counts(voucher, user) == (1, 1)
+
+    # changing the user moves the use between users
+    booking = Booking.objects.get(id=booking.id)
+    booking.user = other_user
+    booking.save()
+    assert _usage_counts(voucher) == (1, 1)
+    assert _usage_counts(voucher, user) == (0, 1)
+    assert _usage_counts(voucher, other_user) == (1, 0)
+
+    membership.voucher = None
+    membership.save()
+    assert _usage_counts(voucher) == (1, 0)
+
+    booking.delete()
+    assert _usage_counts(voucher) == (0, 0)
+    assert _usage_counts(voucher, other_user) == (0, 0)
+
+
+@pytest.mark.django_db
+def test_voucher_usage_updated_when_user_deleted():
+    voucher = baker.make(ItemVoucher, discount=10, event_types=["private"])
+    user = baker.make(User)
+    baker.make(Booking, user=user, voucher=voucher, paid=True, _quantity=2)
+    baker.make(Booking, voucher=voucher, paid=True)
+    assert _usage_counts(voucher) == (3, 0)
+
+    user.delete()
+    assert _usage_counts(voucher) == (1, 0)
+
+
+@pytest.mark.django_db
+def test_voucher_usage_updated_when_expired_bookings_deleted():
+    voucher = baker.make(ItemVoucher, discount=10, event_types=["private"])
+    user = baker.make(User)
+    for event in baker.make_recipe("booking.future_PV", _quantity=2):
+        baker.make(
+            Booking,
+            user=user,
+            event=event,
+            voucher=voucher,
+            paid=False,
+            date_booked=timezone.now() - timedelta(hours=1),
+        )
+    assert _usage_counts(voucher, user) == (0, 2)
+
+    Booking.cleanup_expired_bookings(use_cache=False)
+    assert not Booking.objects.exists()
+    assert _usage_counts(voucher) == (0, 0)
+    assert _usage_counts(voucher, user) == (0, 0)
+
+
+@pytest.mark.django_db
+def test_total_voucher_usage_updated_when_invoice_paid():
+    voucher = baker.make(TotalVoucher, code="test", discount=10)
+    user = baker.make(User, email="user@test.com")
+    invoice = baker.make(
+        Invoice, username=user.email, total_voucher_code="test", paid=False
+    )
+    assert voucher.uses() == 0
+
+    invoice.paid = True
+    invoice.save()
+    # saving again doesn't count it twice
+    invoice.save()
+    assert voucher.uses() == 1
+    assert voucher.uses(user) == 1
+
+    invoice.delete()
+    assert voucher.uses() == 0
+    assert voucher.uses(user) == 0
+
+
+@pytest.mark.django_db
+def test_voucher_usage_recalculate():
+    item_voucher = baker.make(ItemVoucher, discount=10, event_types=["private"])
+    total_voucher = baker.make(TotalVoucher, code="test", discount=10)
+    user = baker.make(User, email="user@test.com")
+    Booking.objects.bulk_create(
+        [
+            Booking(
+                user=user,
+                event=baker.make_recipe("booking.future_PV"),
+                voucher=item_voucher,
+                paid=paid,
+            )
+            for paid in [True, True, False]
+        ]
+    )
+    Invoice.objects.bulk_create(
+        [
+            Invoice(
+                username=user.email, amount=10, total_voucher_code="test", paid=True
+            )
+        ]
+    )
+    assert _usage_counts(item_voucher) == (0, 0)
+    assert _usage_counts(total_voucher) == (0, 0)
+
+    VoucherUsage.recalculate()
+    assert _usage_counts(item_voucher) == (2, 1)
+    assert _usage_counts(item_voucher, user) == (2, 1)
+    assert _usage_counts(total_voucher, user) == (1, 0)
+
+
 @pytest.mark.django_db
 def test_membership(membership_type):
     now = timezone.now()
@@ -955,3 +1123,20 @@ def test_gift_voucher_cost(gift_voucher_types):
     gift_voucher = baker.make(GiftVoucher, gift_voucher_type=gvt)
     assert gift_voucher.voucher.discount_amount == 10
     assert gift_voucher.gift_voucher_type.cost == 40
+
+
+@pytest.mark.django_db
+def test_voucher_usage_updated_when_deferred_item_saved():
+    voucher = baker.make(ItemVoucher, code="test", discount=10, event_types=["private"])
+    user = baker.make(User)
+    booking = baker.make(
+        Booking, user=user, event=baker.make_recipe("booking.future_PV"), paid=False
+    )
+    # the voucher use wasn't loaded, so it's fetched to compare on save
+    booking = Booking.objects.only("id", "status").get(id=booking.id)
+    booking.voucher = voucher
+    booking.save()
+    assert _usage_counts(voucher, user) == (0, 1)
+    assert str(VoucherUsage.objects.get(voucher=voucher, user=None)) == (
+        "test - all users"
+    )
@@ -1,13 +1,17 @@
 # -*- coding: utf-8 -*-
 from datetime import timedelta
+from decimal import Decimal
 from model_bakery import baker
 from unittest.mock import Mock, patch
 
 from django.contrib.sites.models import Site
+from django.db import connection
 from django.urls import reverse
 from django.test import TestCase
+from django.test.utils import CaptureQueriesContext
 from django.utils import timezone
 
+import pytest
 from stripe import InvalidRequestError
 
 from booking.models import (
@@ -18,6 +22,10 @@ from booking.models import (
     MembershipType,
     Membership,
 )
+from booking.views.voucher_utils import (
+    VoucherValidationError,
+    validate_voucher_for_unpaid_item,
+)
 from conftest import (
     make_disclaimer_content,
     make_data_privacy_agreement,
@@ -173,11 +181,11 @@ class ShoppingBasketViewTests(ShoppingBasketMixin, TestCase):
         assert list(resp.context_data["applied_voucher_codes_and_discount"]) == []
         assert resp.context_data["total_cost"] == 80
 
-    def test_cleans_up_expired_bookings(self):
+    def test_does_not_clean_up_expired_bookings(self):
         now = timezone.now()
         event_date = now + timedelta(1)
         # booked > 15 mins ago
-        baker.make(
+        expired = baker.make(
             "booking.booking",
             event__date=event_date,
             paid=False,
@@ -203,12 +211,12 @@ class ShoppingBasketViewTests(ShoppingBasketMixin, TestCase):
             user=self.user,
         )
         assert self.user.bookings.count() == 3
+        # expired bookings are cleaned up by the delete_unpaid_bookings sweeper
         resp = self.client.get(self.url)
-        self.user.refresh_from_db()
-        assert self.user.bookings.count() == 2
+        assert self.user.bookings.count() == 3
         assert {
             unpaid["booking"] for unpaid in resp.context_data["unpaid_booking_info"]
-        } == {rebooking, checkedout_booking}
+        } == {expired, rebooking, checkedout_booking}
 
     def test_voucher_application(self):
         voucher = baker.make(ItemVoucher, code="test", discount=50)
@@ -583,6 +591,82 @@ class ShoppingBasketViewTests(ShoppingBasketMixin, TestCase):
         # total == 20 (full price membership) + 5 (discounted class) + 15 (full price private)
         assert resp.context_data["total_cost"] == 40
 
+    def test_voucher_validation_reads_usage_counts(self):
+        voucher = baker.make(
+            ItemVoucher,
+            code="test",
+            discount=50,
+            max_vouchers=10,
+            max_per_user=5,
+            event_types=["regular_session", "workshop"],
+        )
+        baker.make(Booking, voucher=voucher, paid=True, _quantity=4)
+        booking = baker.make(
+            Booking, event=self.regular_class, user=self.user, voucher=voucher
+        )
+        baker.make(Booking, event=self.workshop, user=self.user, voucher=voucher)
+
+        # validation doesn't count items, so queries don't increase with uses
+        with self.assertNumQueries(4):
+            validate_voucher_for_unpaid_item("booking", booking)
+
+        # this booking is already counted in the reserved uses
+        voucher.max_vouchers = 6
+        voucher.max_per_user = 2
+        validate_voucher_for_unpaid_item("booking", booking)
+
+        voucher.max_per_user = 1
+        with pytest.raises(VoucherValidationError, match="per user"):
+            validate_voucher_for_unpaid_item("booking", booking)
+
+        voucher.max_vouchers = 5
+        with pytest.raises(VoucherValidationError, match="total uses"):
+            validate_voucher_for_unpaid_item("booking", booking)
+
+    def test_basket_queries_dont_increase_with_items(self):
+        def query_count():
+            with CaptureQueriesContext(connection) as queries:
+                resp = self.client.get(self.url)
+            assert resp.status_code == 200
+            return len(queries)
+
+        baker.make(Booking, event=self.private, user=self.user)
+        baker.make_recipe(
+            "booking.membership", membership_type=self.membership_type, user=self.user
+        )
+        self.client.get(self.url)
+        initial_count = query_count()
+        for event in baker.make(
+            Event, event_type="regular_session", cost=10, _quantity=5
+        ):
+            event.date = timezone.now() + timedelta(2)
+            event.save()
+            baker.make(Booking, event=event, user=self.user)
+        # new events invalidate cached context data
+        self.client.get(self.url)
+        assert query_count() == initial_count
+
+    def test_voucher_discounts_use_exact_decimals(self):
+        event = baker.make(
+            Event,
+            event_type="regular_session",
+            cost="12.50",
+            date=timezone.now() + timedelta(2),
+        )
+        voucher = baker.make(
+            ItemVoucher, code="third", discount=33, event_types=["regular_session"]
+        )
+        baker.make(Booking, event=event, user=self.user, voucher=voucher)
+        baker.make(Booking, event=self.regular_class, user=self.user, voucher=voucher)
+
+        resp = self.client.get(self.url)
+        # 12.50 * 0.67 = 8.375, rounded half even; 10 * 0.67 = 6.70
+        assert sorted(
+            info["voucher_applied"]["discounted_cost"]
+            for info in resp.context_data["unpaid_booking_info"]
+        ) == [Decimal("6.70"), Decimal("8.38")]
+        assert resp.context_data["total_cost"] == Decimal("15.08")
+
     def test_total_voucher_validation(self):
         voucher = baker.make(
             TotalVoucher, code="test_amount", discount_amount=10, activated=False
@@ -1026,6 +1110,24 @@ class StripeCheckoutTests(ShoppingBasketMixin, TestCase):
         assert resp.status_code == 302
         assert resp.url == reverse("booking:shopping_basket")
 
+    def test_expired_bookings_are_removed_at_checkout(self):
+        booking = baker.make(Booking, event=self.regular_class, user=self.user)
+        expired = baker.make(
+            Booking,
+            event=self.workshop,
+            user=self.user,
+            date_booked=timezone.now() - timedelta(minutes=20),
+        )
+        # the total included the expired booking, so the basket is shown again
+        resp = self.client.post(
+            self.url,
+            data={"cart_total": self.regular_class.cost + self.workshop.cost},
+        )
+        assert resp.status_code == 302
+        assert resp.url == reverse("booking:shopping_basket")
+        assert list(self.user.bookings.all()) == [booking]
+        assert not Booking.objects.filter(id=expired.id).exists()
+
     @patch("booking.views.shopping_basket.stripe.PaymentIntent")
     def test_creates_invoice_and_applies_to_unpaid_items(self, mock_payment_intent):
         mock_payment_intent_obj = self.get_mock_payment_intent(id="foo")
@@ -1219,6 +1321,8 @@ class StripeCheckoutTests(ShoppingBasketMixin, TestCase):
         booking = baker.make(
             Booking, event=self.private, user=self.user, invoice=invoice
         )
+        invoice.cart_fingerprint = Invoice.get_cart_fingerprint([], [booking.id], [])
+        invoice.save()
 
         # total is correct
         resp = self.client.post(self.url, data={"cart_total": 30})
@@ -1227,6 +1331,57 @@ class StripeCheckoutTests(ShoppingBasketMixin, TestCase):
         assert booking.invoice == invoice
         assert resp.context_data["cart_total"] == 30.00
 
+    @patch("booking.views.shopping_basket.stripe.PaymentIntent")
+    def test_reuses_invoice_created_for_same_cart(self, mock_payment_intent):
+        mock_payment_intent.create.return_value = self.get_mock_payment_intent(id="foo")
+        mock_payment_intent.modify.return_value = self.get_mock_payment_intent(id="foo")
+        booking = baker.make(Booking, event=self.private, user=self.user)
+        self.client.post(self.url, data={"cart_total": 30})
+        invoice = Invoice.objects.get()
+        assert invoice.cart_fingerprint == Invoice.get_cart_fingerprint(
+            [], [booking.id], []
+        )
+
+        self.client.post(self.url, data={"cart_total": 30})
+        assert Invoice.objects.count() == 1
+
+        # a different cart gets a new invoice, and the items move to it
+        booking1 = baker.make(Booking, event=self.regular_class, user=self.user)
+        self.client.post(self.url, data={"cart_total": 40})
+        assert Invoice.objects.count() == 2
+        new_invoice = Invoice.objects.latest("id")
+        booking.refresh_from_db()
+        booking1.refresh_from_db()
+        assert booking.invoice == new_invoice
+        assert booking1.invoice == new_invoice
+
+        # back to the original cart; its invoice is reused and the booking moves
+        # back to it
+        booking1.delete()
+        self.client.post(self.url, data={"cart_total": 30})
+        assert Invoice.objects.count() == 2
+        booking.refresh_from_db()
+        assert booking.invoice == invoice
+
+    @patch("booking.views.shopping_basket.stripe.PaymentIntent")
+    def test_abandoned_invoices_dont_add_queries(self, mock_payment_intent):
+        mock_payment_intent.create.return_value = self.get_mock_payment_intent(id="foo")
+        mock_payment_intent.modify.return_value = self.get_mock_payment_intent(id="foo")
+        baker.make(Booking, event=self.private, user=self.user)
+
+        def query_count():
+            with CaptureQueriesContext(connection) as queries:
+                self.client.post(self.url, data={"cart_total": 30})
+            return len(queries)
+
+        self.client.post(self.url, data={"cart_total": 30})
+        initial_count = query_count()
+        # abandoned invoices for other carts
+        for _ in range(10):
+            invoice = baker.make(Invoice, username=self.user.email, paid=False)
+            baker.make(Booking, event=self.regular_class, invoice=invoice)
+        assert query_count() == initial_count
+
     def test_no_seller(self):
         Seller.objects.all().delete()
         baker.make(Booking, event=self.private, user=self.user)
@@ -1250,7 +1405,11 @@ class StripeCheckoutTests(ShoppingBasketMixin, TestCase):
             paid=False,
             stripe_payment_intent_id="foo",
         )
-        baker.make(Booking, event=self.private, user=self.user, invoice=invoice)
+        booking = baker.make(
+            Booking, event=self.private, user=self.user, invoice=invoice
+        )
+        invoice.cart_fingerprint = Invoice.get_cart_fingerprint([], [booking.id], [])
+        invoice.save()
         resp = self.client.post(self.url, data={"cart_total": 30})
         assert resp.context_data["preprocessing_error"] is True
 
@@ -1269,7 +1428,11 @@ class StripeCheckoutTests(ShoppingBasketMixin, TestCase):
             paid=False,
             stripe_payment_intent_id="foo",
         )
-        baker.make(Booking, event=self.private, user=self.user, invoice=invoice)
+        booking = baker.make(
+            Booking, event=self.private, user=self.user, invoice=invoice
+        )
+        invoice.cart_fingerprint = Invoice.get_cart_fingerprint([], [booking.id], [])
+        invoice.save()
 
         resp = self.client.post(self.url, data={"cart_total": 30})
         assert resp.context_data["preprocessing_error"] is True
@@ -8,8 +8,9 @@ from django.contrib.auth.models import User, AnonymousUser
 from django.urls import reverse
 from django.test import TestCase
 
-from booking.models import Membership
-from booking.templatetags.bookingtags import book_button_data
+from booking.booking_state import UserBookingState
+from booking.models import Event, Membership, WaitingListUser
+from booking.templatetags.bookingtags import book_button_data, get_booking
 
 
 pytestmark = pytest.mark.django_db
@@ -76,6 +77,7 @@ def button_data(event, **kwargs):
         "can_add_to_basket": False,
         "show_cancellation_warning": False,
         "on_waiting_list": False,
+        "has_outstanding_fees": False,
     }
     data.update(**kwargs)
     return data
@@ -203,3 +205,115 @@ def test_book_button_data_booking_cancelled(
     assert book_button_data(event, configured_user, booking, "event") == button_data(
         event, can_rebook=has_membership, can_add_to_basket=not has_membership
     )
+
+
+def test_get_booking_with_booking_state(configured_user):
+    event = baker.make_recipe("booking.future_PC")
+    other_event = baker.make_recipe("booking.future_PC")
+    booking = baker.make_recipe("booking.booking", event=event, user=configured_user)
+    booking_state = UserBookingState(configured_user, [event, other_event])
+    assert get_booking(event, configured_user, booking_state) == booking
+    assert get_booking(other_event, configured_user, booking_state) is None
+
+
+def test_get_booking_without_booking_state(configured_user):
+    event = baker.make_recipe("booking.future_PC")
+    other_event = baker.make_recipe("booking.future_PC")
+    booking = baker.make_recipe("booking.booking", event=event, user=configured_user)
+    # events not in the booking state are looked up
+    booking_state = UserBookingState(configured_user, [other_event])
+    assert get_booking(event, configured_user) == booking
+    assert get_booking(event, configured_user, booking_state) == booking
+    assert get_booking(event, AnonymousUser()) is None
+
+
+def test_book_button_data_workshop_ignores_memberships(configured_user):
+    event = baker.make_recipe("booking.future_EV")
+    baker.make(
+        Membership,
+        user=configured_user,
+        paid=True,
+        month=event.date.month,
+        year=event.date.year,
+    )
+    assert not book_button_data(event, configured_user, None, "event")["can_book"]
+
+
+def test_book_button_data_with_booking_state(
+    configured_user, django_assert_num_queries
+):
+    events = baker.make_recipe("booking.future_PC", _quantity=3)
+    booking = baker.make_recipe(
+        "booking.booking", paid=True, event=events[0], user=configured_user
+    )
+    baker.make(WaitingListUser, user=configured_user, event=events[1])
+    membership = baker.make(
+        Membership,
+        user=configured_user,
+        paid=True,
+        month=events[2].date.month,
+        year=events[2].date.year,
+        membership_type__number_of_classes=2,
+    )
+    booking.membership = membership
+    booking.save()
+
+    annotated_events = Event.objects.with_open_booking_count().in_bulk(
+        [event.id for event in events]
+    )
+    events = [annotated_events[event.id] for event in events]
+    expected = book_button_data(events[0], configured_user, booking, "event")
+    booking_state = UserBookingState(configured_user, events)
+    with django_assert_num_queries(0):
+        assert (
+            book_button_data(
+                events[0], configured_user, booking, "event", booking_state
+            )
+            == expected
+        )
+        data = book_button_data(
+            events[1], configured_user, None, "event", booking_state
+        )
+        assert data["on_waiting_list"]
+        data = book_button_data(
+            events[2], configured_user, None, "event", booking_state
+        )
+        # membership has 1 of 2 uses left
+        assert data["can_book"]
+
+
+def test_book_button_data_with_booking_state_full_membership(configured_user):
+    events = baker.make_recipe("booking.future_PC", _quantity=2)
+    membership = baker.make(
+        Membership,
+        user=configured_user,
+        paid=True,
+        month=events[0].date.month,
+        year=events[0].date.year,
+        membership_type__number_of_classes=1,
+    )
+    baker.make_recipe(
+        "booking.booking",
+        paid=True,
+        event=events[0],
+        user=configured_user,
+        membership=membership,
+    )
+    booking_state = UserBookingState(configured_user, events)
+    assert booking_state.get_available_user_membership(events[1]) is None
+    data = book_button_data(events[1], configured_user, None, "event", booking_state)
+    assert not data["can_book"]
+    assert data["can_add_to_basket"]
+
+
+def test_book_button_data_with_booking_state_outstanding_fees(configured_user):
+    event = baker.make_recipe("booking.future_PC")
+    baker.make_recipe(
+        "booking.booking",
+        event=baker.make_recipe("booking.future_PC", cancellation_fee=1),
+        user=configured_user,
+        cancellation_fee_incurred=True,
+    )
+    booking_state = UserBookingState(configured_user, [event])
+    data = book_button_data(event, configured_user, None, "event", booking_state)
+    assert data["has_outstanding_fees"]
@@ -0,0 +1,205 @@
+from datetime import timedelta
+from unittest.mock import patch
+
+from django.core import mail
+from django.core.management import call_command
+from django.db import connection
+from django.test.utils import CaptureQueriesContext
+from django.utils import timezone
+
+from model_bakery import baker
+import pytest
+
+from activitylog.models import ActivityLog
+from booking.email_helpers import (
+    email_waiting_lists,
+    send_due_waiting_list_emails,
+    send_waiting_list_emails,
+)
+from booking.models import Booking, WaitingListNotification, WaitingListUser
+
+
+pytestmark = pytest.mark.django_db
+
+
+def _make_event_with_waiting_list(users=2, **kwargs):
+    event = baker.make_recipe("booking.future_EV", max_participants=2, **kwargs)
+    for i in range(users):
+        baker.make(
+            WaitingListUser, event=event, user__email=f"wl{event.id}_{i}@test.test"
+        )
+    return event
+
+
+def _make_due(notification):
+    notification.notify_at = timezone.now()
+    notification.save()
+
+
+def test_notifications_are_queued_and_coalesced(settings):
+    settings.WAITING_LIST_NOTIFICATION_WINDOW = 60
+    event = _make_event_with_waiting_list()
+
+    email_waiting_lists([event.id], host="http://example.com")
+    # another space freed within the window
+    email_waiting_lists([event.id], host="http://example.com")
+
+    notification = WaitingListNotification.objects.get()
+    assert notification.event == event
+    assert str(notification) == f"Waiting list notification for {event}"
+    assert notification.notify_at > timezone.now() + timedelta(seconds=50)
+    assert len(mail.outbox) == 0
+
+    # not due yet
+    assert send_due_waiting_list_emails() == 0
+
+    _make_due(notification)
+    assert send_due_waiting_list_emails() == 1
+    assert len(mail.outbox) == 1
+    assert sorted(mail.outbox[0].bcc) == sorted(
+        event.waitinglistusers.values_list("user__email", flat=True)
+    )
+    assert "http://example.com" in mail.outbox[0].body
+    assert not WaitingListNotification.objects.exists()
+
+    # spaces freed after the notification was sent are notified again
+    email_waiting_lists([event.id])
+    assert WaitingListNotification.objects.count() == 1
+
+
+def test_notifications_sent_straight_away_without_window(settings):
+    settings.WAITING_LIST_NOTIFICATION_WINDOW = 0
+    event = _make_event_with_waiting_list()
+    email_waiting_lists([event.id])
+    assert len(mail.outbox) == 1
+    assert not WaitingListNotification.objects.exists()
+
+
+def test_no_emails_for_cancelled_or_full_events():
+    cancelled_event = _make_event_with_waiting_list(cancelled=True)
+    full_event = _make_event_with_waiting_list()
+    baker.make_recipe("booking.booking", event=full_event, _quantity=2)
+    event_without_waiting_list = baker.make_recipe("booking.future_EV")
+
+    send_waiting_list_emails(
+        {cancelled_event.id, full_event.id, event_without_waiting_list.id}
+    )
+    assert len(mail.outbox) == 0
+
+
+def test_waiting_lists_fetched_in_batch():
+    def query_count(events, users):
+        event_ids = [_make_event_with_waiting_list(users).id for _ in range(events)]
+        mail.outbox = []
+        with CaptureQueriesContext(connection) as queries:
+            send_waiting_list_emails(event_ids)
+        assert len(mail.outbox) == events
+        return len(queries)
+
+    # waiting list users and events are fetched up front; each event that's
+    # notified then only logs the email sent, in its own savepoint
+    assert query_count(events=1, users=10) == query_count(events=1, users=1)
+    assert query_count(events=3, users=2) == query_count(events=1, users=2) + 2 * 3
+
+
+@patch("booking.email_helpers.send_waiting_list_email")
+def test_error_for_one_event_does_not_stop_the_others(mock_send, settings):
+    settings.WAITING_LIST_NOTIFICATION_WINDOW = 60
+    failing_event = _make_event_with_waiting_list()
+    event = _make_event_with_waiting_list()
+
+    def send(event_to_send, *args):
+        baker.make_recipe("booking.booking", event=event_to_send)
+        if event_to_send == failing_event:
+            raise ValueError("Oops")
+
+    mock_send.side_effect = send
+    email_waiting_lists([failing_event.id, event.id])
+    for notification in WaitingListNotification.objects.all():
+        _make_due(notification)
+
+    with patch("booking.email_helpers.logger.error") as mock_error:
+        assert send_due_waiting_list_emails() == 2
+    assert mock_send.call_count == 2
+    mock_error.assert_called_once()
+    # the failing event's changes are rolled back, and its notification doesn't
+    # block the queue
+    assert not failing_event.bookings.exists()
+    assert event.bookings.count() == 1
+    assert not WaitingListNotification.objects.exists()
+
+
+def test_auto_book_from_queued_notification(
+    settings, django_capture_on_commit_callbacks
+):
+    settings.WAITING_LIST_NOTIFICATION_WINDOW = 60
+    event = _make_event_with_waiting_list(users=0)
+    auto_book_user = baker.make(
+        WaitingListUser, event=event, user__email="autobook@test.test"
+    ).user
+    other_user = baker.make(
+        WaitingListUser, event=event, user__email="other@test.test"
+    ).user
+    settings.AUTO_BOOK_EMAILS = [auto_book_user.email]
+    baker.make_recipe("booking.booking", event=event)
+
+    email_waiting_lists([event.id])
+    _make_due(WaitingListNotification.objects.get())
+    # the job's logs are written when it commits
+    with django_capture_on_commit_callbacks(execute=True):
+        call_command("send_waiting_list_emails")
+
+    booking = Booking.objects.get(event=event, user=auto_book_user, status="OPEN")
+    assert ActivityLog.objects.filter(
+        action="booking_autocreated", object_id=booking.id
+    ).exists()
+    # the autobooked user took the last space, so the rest aren't emailed
+    assert [email.to for email in mail.outbox] == [[auto_book_user.email]]
+    assert list(event.waitinglistusers.values_list("user", flat=True)) == [
+        other_user.id
+    ]
+
+
+def test_no_auto_book_if_space_taken_again(settings):
+    event = _make_event_with_waiting_list(users=1)
+    auto_book_user = baker.make(
+        WaitingListUser, event=event, user__email="autobook@test.test"
+    ).user
+    settings.AUTO_BOOK_EMAILS = [auto_book_user.email]
+    # the freed space has been booked again before the waiting list is notified
+    baker.make_recipe("booking.booking", event=event, _quantity=2)
+
+    send_waiting_list_emails([event.id])
+
+    assert not Booking.objects.filter(user=auto_book_user).exists()
+    assert event.waitinglistusers.filter(user=auto_book_user).exists()
+    assert len(mail.outbox) == 0
+
+
+@patch("booking.management.commands.send_waiting_list_emails.time.sleep")
+def test_interval_runs_until_stopped(mock_sleep, settings):
+    settings.WAITING_LIST_NOTIFICATION_WINDOW = 60
+    event = _make_event_with_waiting_list()
+    email_waiting_lists([event.id])
+    _make_due(WaitingListNotification.objects.get())
+
+    mock_sleep.side_effect = [None, KeyboardInterrupt]
+    with pytest.raises(KeyboardInterrupt):
+        call_command("send_waiting_list_emails", interval=60)
+    assert mock_sleep.call_count == 2
+    assert len(mail.outbox) == 1
+    assert not WaitingListNotification.objects.exists()
+
+
+@patch("booking.management.commands.send_waiting_list_emails.logger.error")
+@patch("booking.management.commands.send_waiting_list_emails.time.sleep")
+@patch(
+    "booking.management.commands.send_waiting_list_emails.send_due_waiting_list_emails"
+)
+def test_interval_keeps_running_after_errors(mock_send, mock_sleep, mock_error):
+    mock_send.side_effect = [ValueError("Oops"), 0]
+    mock_sleep.side_effect = [None, KeyboardInterrupt]
+    with pytest.raises(KeyboardInterrupt):
+        call_command("send_waiting_list_emails", interval=60)
+    assert mock_send.call_count == 2
+    mock_error.assert_called_once()
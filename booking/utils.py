@@ -3,36 +3,18 @@ from decimal import Decimal
 from delorean import Delorean
 
 
-def calculate_user_cart_total(
-    unpaid_memberships=(),
-    unpaid_bookings=(),
-    unpaid_gift_vouchers=(),
-    total_voucher=None,
-):
-    membership_cost = sum(
-        [
-            unpaid_membership.cost_with_voucher
-            for unpaid_membership in unpaid_memberships
-        ]
-    )
-    booking_cost = sum(
-        [unpaid_booking.cost_with_voucher for unpaid_booking in unpaid_bookings]
-    )
-    gift_voucher_cost = sum(
-        [gift_voucher.gift_voucher_type.cost for gift_voucher in unpaid_gift_vouchers]
-    )
-
-    cart_total = membership_cost + booking_cost + gift_voucher_cost
-    if total_voucher:
-        if total_voucher.discount:
-            percentage_to_pay = Decimal((100 - total_voucher.discount) / 100)
-            return (cart_total * percentage_to_pay).quantize(Decimal(".01"))
-        else:
-            if total_voucher.discount_amount > cart_total:
-                cart_total = 0
-            else:
-                cart_total -= Decimal(total_voucher.discount_amount)
-    return cart_total
+PENNY = Decimal(".01")
+
+
+def apply_voucher_discount(cost, voucher):
+    """An item's cost with voucher's discount applied, in exact Decimal arithmetic"""
+    # str() so that floats (e.g. set on unsaved instances) convert exactly
+    cost = Decimal(str(cost))
+    if voucher is None:
+        return cost
+    if voucher.discount_amount:
+        return max(cost - Decimal(str(voucher.discount_amount)), Decimal(0))
+    return (cost * (100 - voucher.discount) / 100).quantize(PENNY)
 
 
 def full_name(user):
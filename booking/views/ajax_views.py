@@ -4,6 +4,7 @@ from urllib.parse import parse_qs, urlsplit, urlunsplit, urlencode
 
 from django.conf import settings
 from django.contrib.auth.decorators import login_required
+from django.db import transaction
 from django.http import HttpResponseBadRequest, JsonResponse, HttpResponse
 from django.template.response import TemplateResponse
 from django.views.decorators.http import require_http_methods
@@ -12,17 +13,12 @@ from django.shortcuts import get_object_or_404
 
 
 from activitylog.models import ActivityLog
-from booking.views.views_utils import (
-    get_unpaid_bookings,
-    get_unpaid_memberships,
-    get_unpaid_gift_vouchers,
-    get_unpaid_gift_vouchers_from_session,
-    total_unpaid_item_count,
-)
+from booking.views.cart_utils import get_cart
+from booking.views.views_utils import total_unpaid_item_count
 from .booking_helpers import cancel_booking_from_view
 from booking.models import Event, Booking, GiftVoucher, Membership, WaitingListUser
 from booking.email_helpers import send_email, email_waiting_lists
-from booking.utils import calculate_user_cart_total, host_from_request
+from booking.utils import host_from_request
 
 
 ITEM_TYPE_MODEL_MAPPING = {
@@ -74,18 +70,8 @@ def ajax_cart_item_delete(request):
     if item_type == "booking":
         event = item.event
 
-    unpaid_items = {"booking": [], "membership": [], "gift_voucher": []}
     if request.user.is_authenticated:
         item.delete()
-        unpaid_items["membership"] = get_unpaid_memberships(request.user)
-        unpaid_items["booking"] = get_unpaid_bookings(request.user)
-        unpaid_items["gift_voucher"] = get_unpaid_gift_vouchers(request.user)
-        total = calculate_user_cart_total(
-            unpaid_items["membership"],
-            unpaid_items["booking"],
-            unpaid_items["gift_voucher"],
-        )
-        unpaid_item_count = total_unpaid_item_count(request.user)
     else:
         assert item_type == "gift_voucher"
         gift_vouchers_on_session = request.session.get("purchases", {}).get(
@@ -95,11 +81,12 @@ def ajax_cart_item_delete(request):
             gift_vouchers_on_session.remove(int(item_id))
             request.session["purchases"]["gift_vouchers"] = gift_vouchers_on_session
             item.delete()
-        unpaid_items["gift_voucher"] = get_unpaid_gift_vouchers_from_session(request)
-        unpaid_item_count = unpaid_items["gift_voucher"].count()
-        total = calculate_user_cart_total(
-            unpaid_gift_vouchers=unpaid_items["gift_voucher"]
-        )
+    cart = get_cart(request)
+    unpaid_items = {
+        "membership": cart.memberships,
+        "booking": cart.bookings,
+        "gift_voucher": cart.gift_vouchers,
+    }
     if item_type == "booking":
         # send waiting list emails if necessary
         email_waiting_lists([event.id], host=host_from_request(request))
@@ -114,8 +101,8 @@ def ajax_cart_item_delete(request):
 
     return JsonResponse(
         {
-            "cart_total": total,
-            "cart_item_menu_count": unpaid_item_count,
+            "cart_total": cart.total,
+            "cart_item_menu_count": cart.item_count,
         }
     )
 
@@ -140,66 +127,65 @@ def toggle_booking(request, event_id):
         else:
             existing_booking_status = "OPEN"
 
-    # if making a new/reopening booking, make sure the event isn't full or cancelled
-    # and abort if user has outstanding fees
-    if existing_booking_status != "OPEN":  # i.e. None (new) or CANCELLED (reopening)
-        if request.user.has_outstanding_fees():
-            message = "Action forbidden until outstanding cancellation fees have been resolved"
-            return HttpResponseBadRequest(message)
-
-        if not event.spaces_left or event.cancelled:
-            message = "Sorry, this {} {}".format(
-                ev_type,
-                "is now full" if not event.spaces_left else "has been cancelled",
-            )
-            return HttpResponseBadRequest(message)
-
     if existing_booking_status == "OPEN" and not booking.paid:
         # booking already open and unpaid; user clicked on go-to-basket button
         url = reverse("booking:shopping_basket")
         return HttpResponse("", headers={"Hx-Redirect": url})
 
-    if existing_booking_status is None:
-        booking = Booking.objects.create(user=request.user, event=event)
-    new = existing_booking_status is None
-
-    context["booking"] = booking
-
     alert_message = {}
-    # CANCELLING
     if existing_booking_status == "OPEN":
+        # CANCELLING
         # cancel, process refunds etc, email users, email waiting list
         alert_message = cancel_booking_from_view(request, booking)
         action = "cancelled"
+    else:
+        # NEW BOOKING or REOPENING; abort if user has outstanding fees
+        if request.user.has_outstanding_fees():
+            message = "Action forbidden until outstanding cancellation fees have been resolved"
+            return HttpResponseBadRequest(message)
 
-    # REOPENING
-    elif existing_booking_status == "CANCELLED":
-        booking.status = "OPEN"
-        booking.no_show = False
-        action = "reopened"
-
-    # NEW BOOKING
-    elif new:
-        booking.status = "OPEN"
-        booking.no_show = False
-        action = "created"
-
-    if action in ["reopened", "created"]:
-        # assign membership if available
-        available_user_membership = booking.event.get_available_user_membership(
-            booking.user
-        )
-        if available_user_membership:
-            booking.membership = available_user_membership
-            booking.paid = True
+        # Lock the event row while the capacity is checked and the booking saved,
+        # so concurrent requests can't both take the last space
+        with transaction.atomic():
+            event = event.lock_for_booking()
+            if not event.spaces_left or event.cancelled:
+                message = "Sorry, this {} {}".format(
+                    ev_type,
+                    "is now full" if not event.spaces_left else "has been cancelled",
+                )
+                return HttpResponseBadRequest(message)
+
+            if existing_booking_status is None:
+                booking = Booking(user=request.user, event=event)
+                action = "created"
+            else:
+                booking.event = event
+                action = "reopened"
+            booking.status = "OPEN"
+            booking.no_show = False
+
+            # assign membership if available
+            available_user_membership = event.get_available_user_membership(
+                request.user, lock=True
+            )
+            if available_user_membership:
+                booking.membership = available_user_membership
+                booking.paid = True
+
+            booking.save()
+            event.open_booking_count += 1
+        context["event"] = event
 
-    booking.save()
+    context["booking"] = booking
 
     if action != "cancelled" and booking.paid:
         # ONLY SEND EMAILS IF BOOKING IS PAID (i.e. fully booked with membership)
         # Otherwise emails are sent after payment made
         ActivityLog.objects.create(
-            log=f'Booking {booking.id} {action} for "{booking.event}" by user {booking.user.username}'
+            action=f"booking_{action}",
+            actor=request.user,
+            obj=booking,
+            log=f'Booking {booking.id} {action} for "{booking.event}" by user {booking.user.username}',
         )
         # send email to user
         ctx = {
@@ -252,9 +238,12 @@ def toggle_booking(request, event_id):
         if action in ["created", "reopened"]:
             waiting_list_user.delete()
             ActivityLog.objects.create(
+                action="waiting_list_removed",
+                actor=request.user,
+                event=event,
                 log="User {} removed from waiting list for {}".format(
                     request.user.username, event
-                )
+                ),
             )
     except WaitingListUser.DoesNotExist:
         pass
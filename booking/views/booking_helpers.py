@@ -79,13 +79,16 @@ def cancel_booking_from_view(request, booking):
             if refunded:
                 alert_message["message"] += " Refund processing."
             ActivityLog.objects.create(
+                action="booking_cancelled",
+                actor=request.user,
+                obj=booking,
                 log="Booking id {} for event {}, user {}, was cancelled by user "
                 "{}".format(
                     booking.id,
                     booking.event,
                     booking.user.username,
                     request.user.username,
-                )
+                ),
             )
         elif booking.no_show:
             if not booking.event.allow_booking_cancellation:
@@ -94,12 +97,15 @@ def cancel_booking_from_view(request, booking):
                     "refunds or transfer credit."
                 )
                 ActivityLog.objects.create(
+                    action="booking_no_show",
+                    actor=request.user,
+                    obj=booking,
                     log="Booking id {} for NON-CANCELLABLE event {}, user {}, "
                     "was cancelled and set to no-show".format(
                         booking.id,
                         booking.event,
                         booking.user.username,
-                    )
+                    ),
                 )
             else:
                 alert_message["message"] += (
@@ -107,13 +113,16 @@ def cancel_booking_from_view(request, booking):
                     "refunds as the allowed cancellation period has passed."
                 )
                 ActivityLog.objects.create(
+                    action="booking_no_show",
+                    actor=request.user,
+                    obj=booking,
                     log="Booking id {} for event {}, user {}, was cancelled "
                     "after the cancellation period and set to "
                     "no-show".format(
                         booking.id,
                         booking.event,
                         booking.user.username,
-                    )
+                    ),
                 )
 
     # EMAIL USER
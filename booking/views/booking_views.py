@@ -4,36 +4,50 @@ import logging
 from django.views.generic import ListView
 from django.utils import timezone
 from braces.views import LoginRequiredMixin
-from booking.email_helpers import email_waiting_lists
+from booking.booking_state import UserBookingState
 
-from booking.models import Booking
-from booking.utils import host_from_request
+from booking.models import Booking, Event
 from .views_utils import DataPolicyAgreementRequiredMixin
 
 
 logger = logging.getLogger(__name__)
 
 
-class BookingListView(DataPolicyAgreementRequiredMixin, LoginRequiredMixin, ListView):
+class BookingStateMixin:
+    def get_context_data(self, **kwargs):
+        context = super().get_context_data(**kwargs)
+        bookings = context["bookings"]
+        # fetch the events for this page with their open booking counts, and load
+        # the user's booking state for the booking buttons
+        events = (
+            Event.objects.with_open_booking_count()
+            .select_related("venue")
+            .in_bulk([booking.event_id for booking in bookings])
+        )
+        for booking in bookings:
+            booking.event = events[booking.event_id]
+        context["user_booking_state"] = UserBookingState(
+            self.request.user, events.values()
+        )
+        return context
+
+
+class BookingListView(
+    BookingStateMixin, DataPolicyAgreementRequiredMixin, LoginRequiredMixin, ListView
+):
     model = Booking
     context_object_name = "bookings"
     template_name = "booking/bookings.html"
     paginate_by = 20
 
-    def dispatch(self, request, *args, **kwargs):
-        # Cleanup bookings so user is looking at current availability
-        event_ids_from_expired_bookings = Booking.cleanup_expired_bookings(
-            use_cache=True
-        )
-        email_waiting_lists(
-            event_ids_from_expired_bookings, host=host_from_request(request)
-        )
-        return super().dispatch(request, *args, **kwargs)
-
     def get_queryset(self):
-        return Booking.objects.filter(
-            event__date__gte=timezone.now(), user=self.request.user
-        ).order_by("event__date")
+        return (
+            Booking.objects.filter(
+                event__date__gte=timezone.now(), user=self.request.user
+            )
+            .select_related("membership")
+            .order_by("event__date")
+        )
 
     def get_context_data(self, **kwargs):
         # Call the base implementation first to get a context
@@ -45,7 +59,7 @@ class BookingListView(DataPolicyAgreementRequiredMixin, LoginRequiredMixin, List
 
 
 class BookingHistoryListView(
-    DataPolicyAgreementRequiredMixin, LoginRequiredMixin, ListView
+    BookingStateMixin, DataPolicyAgreementRequiredMixin, LoginRequiredMixin, ListView
 ):
     model = Booking
     context_object_name = "bookings"
@@ -53,9 +67,13 @@ class BookingHistoryListView(
     paginate_by = 20
 
     def get_queryset(self):
-        return Booking.objects.filter(
-            event__date__lte=timezone.now(), user=self.request.user
-        ).order_by("-event__date")
+        return (
+            Booking.objects.filter(
+                event__date__lte=timezone.now(), user=self.request.user
+            )
+            .select_related("membership")
+            .order_by("-event__date")
+        )
 
     def get_context_data(self, **kwargs):
         # Call the base implementation first to get a context
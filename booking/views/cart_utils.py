@@ -0,0 +1,160 @@
+from ..utils import apply_voucher_discount
+from .views_utils import (
+    get_unpaid_bookings,
+    get_unpaid_gift_vouchers,
+    get_unpaid_gift_vouchers_from_session,
+    get_unpaid_memberships,
+)
+from .voucher_utils import (
+    _get_and_verify_total_vouchers,
+    _verify_item_vouchers,
+    get_valid_applied_voucher_info,
+)
+
+
+class PricedCart:
+    """
+    A user's (or guest's) unpaid cart items, loaded once with everything needed to
+    validate and price them, and priced in a single pass.
+
+    Use get_cart(request) so that everything handling a request shares the same
+    cart.  Call price() again after changing the vouchers applied to items.
+    """
+
+    def __init__(
+        self, memberships=(), bookings=(), gift_vouchers=(), total_voucher=None
+    ):
+        self.memberships = list(memberships)
+        self.bookings = list(bookings)
+        self.gift_vouchers = list(gift_vouchers)
+        self.total_voucher = total_voucher
+        self.price()
+
+    @classmethod
+    def for_request(cls, request):
+        if not request.user.is_authenticated:
+            # guests can only buy gift vouchers
+            return cls(
+                gift_vouchers=get_unpaid_gift_vouchers_from_session(
+                    request
+                ).select_related("gift_voucher_type__membership_type")
+            )
+        return cls(
+            memberships=get_unpaid_memberships(request.user)
+            .select_related("membership_type", "user", "voucher")
+            .prefetch_related("voucher__membership_types"),
+            bookings=get_unpaid_bookings(request.user)
+            .select_related("event", "user", "voucher")
+            .prefetch_related("voucher__membership_types"),
+            gift_vouchers=get_unpaid_gift_vouchers(request.user).select_related(
+                "gift_voucher_type__membership_type"
+            ),
+        )
+
+    def __bool__(self):
+        return bool(self.memberships or self.bookings or self.gift_vouchers)
+
+    @property
+    def item_count(self):
+        return len(self.memberships) + len(self.bookings) + len(self.gift_vouchers)
+
+    def price(self):
+        """(Re)calculate the cost of each item and the cart totals"""
+        self.costs = {}
+        for membership in self.memberships:
+            self.costs[membership] = apply_voucher_discount(
+                membership.membership_type.cost, membership.voucher
+            )
+        for booking in self.bookings:
+            self.costs[booking] = apply_voucher_discount(
+                booking.event.cost, booking.voucher
+            )
+        for gift_voucher in self.gift_vouchers:
+            self.costs[gift_voucher] = gift_voucher.gift_voucher_type.cost
+        self.total_without_total_voucher = sum(self.costs.values())
+        self.total = self._apply_total_voucher(self.total_without_total_voucher)
+
+    def _apply_total_voucher(self, total):
+        if self.total_voucher is None:
+            return total
+        return apply_voucher_discount(total, self.total_voucher)
+
+    def set_total_voucher(self, total_voucher):
+        self.total_voucher = total_voucher
+        self.total = self._apply_total_voucher(self.total_without_total_voucher)
+
+    def verify_vouchers(self, request):
+        """
+        Remove any vouchers that are no longer valid from items, and any total
+        voucher that is no longer valid from the session, and reprice the cart
+        """
+        if request.user.is_authenticated:
+            _verify_item_vouchers(self.memberships, self.bookings)
+            self.total_voucher = _get_and_verify_total_vouchers(request)
+        self.price()
+
+    def remove_invalid_applied_vouchers(self):
+        """
+        Remove item vouchers that are no longer valid, after vouchers have been
+        added to or removed from the cart, and reprice the cart
+        """
+        for item in [*self.memberships, *self.bookings]:
+            get_valid_applied_voucher_info(item)
+        self.price()
+
+    def item_info(self):
+        """Items and their costs, for the shopping basket template"""
+
+        def _voucher_applied(item):
+            if item.voucher is None:
+                return {"code": None, "discounted_cost": None}
+            return {"code": item.voucher.code, "discounted_cost": self.costs[item]}
+
+        return {
+            "unpaid_membership_info": [
+                {
+                    "membership": membership,
+                    "original_cost": membership.membership_type.cost,
+                    "voucher_applied": _voucher_applied(membership),
+                }
+                for membership in self.memberships
+            ],
+            "unpaid_booking_info": [
+                {
+                    "booking": booking,
+                    "original_cost": booking.event.cost,
+                    "voucher_applied": _voucher_applied(booking),
+                }
+                for booking in self.bookings
+            ],
+            "unpaid_gift_voucher_info": [
+                {
+                    "gift_voucher": gift_voucher,
+                    "cost": self.costs[gift_voucher],
+                }
+                for gift_voucher in self.gift_vouchers
+            ],
+        }
+
+    def applied_voucher_codes_and_discount(self):
+        applied = {
+            (item.voucher.code, item.voucher.discount, item.voucher.discount_amount)
+            for item in [*self.memberships, *self.bookings]
+            if item.voucher is not None
+        }
+        if self.total_voucher is not None:
+            applied.add(
+                (
+                    self.total_voucher.code,
+                    self.total_voucher.discount,
+                    self.total_voucher.discount_amount,
+                )
+            )
+        return applied
+
+
+def get_cart(request, reload=False):
+    """The PricedCart for this request, loaded on first use"""
+    if reload or not hasattr(request, "_priced_cart"):
+        request._priced_cart = PricedCart.for_request(request)
+    return request._priced_cart
@@ -1,5 +1,4 @@
 import logging
-import pytz
 
 from collections import OrderedDict
 
@@ -10,11 +9,10 @@ from django.urls import reverse
 from django.utils import timezone
 from django.utils.safestring import mark_safe
 from django.http import Http404
-from booking.email_helpers import email_waiting_lists
+from booking.booking_state import UserBookingState
 
 from booking.forms import EventsFilter
 from booking.models import Booking, Event, WaitingListUser
-from booking.utils import host_from_request
 from timetable.models import Venue
 
 
@@ -40,16 +38,6 @@ class BaseEventListView(ListView):
     template_name = "booking/events_list.html"
     paginate_by = 20
 
-    def dispatch(self, request, *args, **kwargs):
-        # Cleanup bookings so user is looking at current availability
-        event_ids_from_expired_bookings = Booking.cleanup_expired_bookings(
-            use_cache=True
-        )
-        email_waiting_lists(
-            event_ids_from_expired_bookings, host=host_from_request(request)
-        )
-        return super().dispatch(request, *args, **kwargs)
-
     def get_queryset(self):
         name = self.request.GET.get("name", "all").strip()
         level = self.request.GET.get("level")
@@ -61,12 +49,13 @@ class BaseEventListView(ListView):
         self.event_time = self.request.GET.get("time", "").strip()
 
         # show all future events for staff users
+        events = Event.objects.with_open_booking_count().select_related("venue")
         if self.request.user.is_staff:
-            events = Event.objects.filter(
+            events = events.filter(
                 event_type=self.event_type, date__gte=timezone.now()
             ).order_by("date")
         else:
-            events = Event.objects.filter(
+            events = events.filter(
                 event_type=self.event_type, date__gte=timezone.now(), show_on_site=True
             ).order_by("date")
 
@@ -83,16 +72,7 @@ class BaseEventListView(ListView):
             except (ValueError, IndexError):
                 self.event_time = None
             else:
-                localtz = pytz.timezone("Europe/London")
-                event_ids = [
-                    event.id
-                    for event in events
-                    if event.date.weekday() == weekday
-                    and event.date.minute == min
-                    and event.date.hour
-                    == hour - (event.date.astimezone(localtz).dst().seconds / 3600)
-                ]
-                events = events.filter(id__in=event_ids)
+                events = events.on_local_weekday_and_time(weekday, hour, min)
         return events
 
     def paginate_queryset(self, queryset, page_size):
@@ -205,6 +185,12 @@ class BaseEventListView(ListView):
             )
 
         context["location_events"] = location_events
+        # load the user's bookings, waiting lists and memberships for all events on
+        # the page at once, for the booking buttons
+        context["user_booking_state"] = UserBookingState(
+            self.request.user,
+            [event for location in location_events for event in location["queryset"]],
+        )
         context["title"] = f"Book {self.event_type_plural}"
         return context
 
@@ -257,9 +243,10 @@ class EventDetailView(DetailView):
     template_name = "booking/event.html"
 
     def get_object(self):
+        events = Event.objects.with_open_booking_count()
         if self.request.user.is_staff:
-            return get_object_or_404(Event, slug=self.kwargs["slug"])
-        return get_object_or_404(Event, slug=self.kwargs["slug"], show_on_site=True)
+            return get_object_or_404(events, slug=self.kwargs["slug"])
+        return get_object_or_404(events, slug=self.kwargs["slug"], show_on_site=True)
 
     def get_context_data(self, **kwargs):
         # Call the base implementation first to get a context
@@ -4,7 +4,6 @@ import logging
 
 from django.conf import settings
 from django.contrib.auth.decorators import login_required
-from django.contrib.sites.models import Site
 from django.contrib import messages
 from django.template.response import TemplateResponse
 from django.shortcuts import HttpResponseRedirect
@@ -13,29 +12,21 @@ from django.http import JsonResponse
 from django.urls import reverse
 
 import stripe
-from booking.email_helpers import send_gift_voucher_email
-
-from stripe_payments.models import Invoice, Seller, StripePaymentIntent
-
-from ..models import Booking, ItemVoucher, Membership, TotalVoucher
-from ..utils import calculate_user_cart_total, full_name
-from .views_utils import (
-    data_privacy_required,
-    get_unpaid_bookings,
-    get_unpaid_memberships,
-    get_unpaid_gift_vouchers,
-    redirect_to_voucher_cart,
-    get_unpaid_gift_vouchers_from_session,
-)
+from booking.email_helpers import email_waiting_lists, send_gift_voucher_email
+
+from stripe_payments.models import Invoice, StripePaymentIntent, get_site_seller
+from stripe_payments.utils import settle_invoice
+
+from ..models import Booking, ItemVoucher, TotalVoucher
+from ..utils import full_name, host_from_request
+from .cart_utils import get_cart
+from .views_utils import data_privacy_required, redirect_to_voucher_cart
 from .voucher_utils import (
     validate_voucher_for_user,
     validate_total_voucher_for_checkout_user,
     validate_voucher_for_unpaid_item,
     validate_voucher_for_items_in_cart,
     validate_voucher_properties,
-    get_valid_applied_voucher_info,
-    _verify_item_vouchers,
-    _get_and_verify_total_vouchers,
     VoucherValidationError,
 )
 
@@ -48,25 +39,17 @@ def guest_shopping_basket(request):
         return HttpResponseRedirect(reverse("booking:shopping_basket"))
 
     template_name = "booking/shopping_basket.html"
-    gift_vouchers = get_unpaid_gift_vouchers_from_session(request)
-    unpaid_gift_voucher_info = [
-        {
-            "gift_voucher": gift_voucher,
-            "cost": gift_voucher.gift_voucher_type.cost,
-        }
-        for gift_voucher in gift_vouchers
-    ]
-    total = calculate_user_cart_total(unpaid_gift_vouchers=gift_vouchers)
+    cart = get_cart(request)
 
     context = {
-        "unpaid_items": bool(unpaid_gift_voucher_info),
+        **cart.item_info(),
+        "unpaid_items": bool(cart),
         "unpaid_block_info": [],
         "applied_voucher_codes_and_discount": [],
         "unpaid_subscription_info": [],
-        "unpaid_gift_voucher_info": unpaid_gift_voucher_info,
         "unpaid_merchandise": [],
-        "total_cost_without_total_voucher": total,
-        "total_cost": total,
+        "total_cost_without_total_voucher": cart.total,
+        "total_cost": cart.total,
     }
 
     return TemplateResponse(request, template_name, context)
@@ -79,11 +62,9 @@ def shopping_basket_view(request):
     template_name = "booking/shopping_basket.html"
 
     context = {}
-    unpaid_memberships = get_unpaid_memberships(request.user)
-    unpaid_membership_ids = unpaid_memberships.values_list("id", flat=True)
-    unpaid_bookings = get_unpaid_bookings(request.user)
-    unpaid_booking_ids = unpaid_bookings.values_list("id", flat=True)
-    unpaid_gift_vouchers = get_unpaid_gift_vouchers(request.user)
+    cart = get_cart(request)
+    unpaid_memberships = cart.memberships
+    unpaid_bookings = cart.bookings
 
     if request.method == "POST":
         code = request.POST.get("code")
@@ -173,82 +154,24 @@ def shopping_basket_view(request):
                         if item.voucher and item.voucher.code == code:
                             item.voucher = None
                             item.save()
+        # validate vouchers already applied to items, after any changes
+        cart.remove_invalid_applied_vouchers()
     else:
-        _verify_item_vouchers(unpaid_memberships, unpaid_bookings)
-
-    # calculate the unpaid membership costs after making any new updates and adding new used_vouchers
-    unpaid_membership_info = [
-        {
-            "membership": membership,
-            "original_cost": membership.membership_type.cost,
-            "voucher_applied": get_valid_applied_voucher_info(membership),
-        }
-        for membership in unpaid_memberships
-    ]
-    # calculate the unpaid booking costs
-    unpaid_booking_info = [
-        {
-            "booking": booking,
-            "original_cost": booking.event.cost,
-            "voucher_applied": get_valid_applied_voucher_info(booking),
-        }
-        for booking in unpaid_bookings
-    ]
-
-    unpaid_gift_voucher_info = [
-        {
-            "gift_voucher": gift_voucher,
-            "cost": gift_voucher.gift_voucher_type.cost,
-        }
-        for gift_voucher in unpaid_gift_vouchers
-    ]
-
-    # We do this AFTER generating the voucher applied costs, as that may have modified some used vouchers if they weren't valid
-    applied_voucher_codes_and_discount = set(
-        list(
-            Membership.objects.filter(
-                id__in=unpaid_membership_ids, voucher__isnull=False
-            )
-            .order_by("voucher__code")
-            .distinct("voucher__code")
-            .values_list(
-                "voucher__code", "voucher__discount", "voucher__discount_amount"
-            )
-        )
-        + list(
-            Booking.objects.filter(id__in=unpaid_booking_ids, voucher__isnull=False)
-            .order_by("voucher__code")
-            .distinct("voucher__code")
-            .values_list(
-                "voucher__code", "voucher__discount", "voucher__discount_amount"
-            )
-        )
-    )
+        cart.verify_vouchers(request)
 
     total_voucher_code = request.session.get("total_voucher_code")
     if total_voucher_code:
-        total_voucher = TotalVoucher.objects.get(code=total_voucher_code)
-        applied_voucher_codes_and_discount.add(
-            (total_voucher.code, total_voucher.discount, total_voucher.discount_amount)
-        )
+        cart.set_total_voucher(TotalVoucher.objects.get(code=total_voucher_code))
     else:
-        total_voucher = None
+        cart.set_total_voucher(None)
 
     context.update(
         {
-            "unpaid_items": unpaid_booking_info
-            or unpaid_membership_info
-            or unpaid_gift_voucher_info,
-            "unpaid_booking_info": unpaid_booking_info,
-            "applied_voucher_codes_and_discount": applied_voucher_codes_and_discount,
-            "unpaid_membership_info": unpaid_membership_info,
-            "unpaid_gift_voucher_info": unpaid_gift_voucher_info,
-            "total_cost_without_total_voucher": calculate_user_cart_total(
-                unpaid_memberships, unpaid_bookings, unpaid_gift_vouchers
-            ),
-            "total_cost": calculate_user_cart_total(
-                unpaid_memberships, unpaid_bookings, unpaid_gift_vouchers, total_voucher
-            ),
+            **cart.item_info(),
+            "unpaid_items": bool(cart),
+            "applied_voucher_codes_and_discount": cart.applied_voucher_codes_and_discount(),
+            "total_cost_without_total_voucher": cart.total_without_total_voucher,
+            "total_cost": cart.total,
         }
     )
 
@@ -261,40 +184,28 @@ def _check_items_and_get_updated_invoice(request):
     checked = {"total": total, "invoice": None, "redirect": False, "redirect_url": None}
 
     if request.user.is_authenticated:
-        unpaid_memberships = get_unpaid_memberships(request.user)
-        unpaid_bookings = get_unpaid_bookings(request.user)
-        unpaid_gift_vouchers = get_unpaid_gift_vouchers(request.user)
-
-        if not (unpaid_memberships or unpaid_bookings or unpaid_gift_vouchers):
-            messages.warning(request, "Your cart is empty")
-            checked.update(
-                {"redirect": True, "redirect_url": reverse("booking:shopping_basket")}
-            )
-            return checked
-
-        _verify_item_vouchers(unpaid_memberships, unpaid_bookings)
-        total_voucher = _get_and_verify_total_vouchers(request)
-    else:
-        # guest checkout
-        unpaid_memberships = unpaid_bookings = []
-        total_voucher = None
-        unpaid_gift_vouchers = get_unpaid_gift_vouchers_from_session(request)
-        if not unpaid_gift_vouchers:
-            messages.warning(request, "Your cart is empty")
-            checked.update(
-                {
-                    "redirect": True,
-                    "redirect_url": reverse("booking:guest_shopping_basket"),
-                }
-            )
-            return checked
-
-    checked_total = calculate_user_cart_total(
-        unpaid_memberships=unpaid_memberships,
-        unpaid_bookings=unpaid_bookings,
-        unpaid_gift_vouchers=unpaid_gift_vouchers,
-        total_voucher=total_voucher,
-    )
+        # expired bookings are deleted by the delete_unpaid_bookings sweeper, but it
+        # may not have run since this user's expired, so check before paying
+        event_ids_from_cleanup = Booking.cleanup_expired_bookings(user=request.user)
+        email_waiting_lists(event_ids_from_cleanup, host=host_from_request(request))
+
+    cart = get_cart(request)
+    if not cart:
+        messages.warning(request, "Your cart is empty")
+        if request.user.is_authenticated:
+            redirect_url = reverse("booking:shopping_basket")
+        else:
+            # guest checkout
+            redirect_url = reverse("booking:guest_shopping_basket")
+        checked.update({"redirect": True, "redirect_url": redirect_url})
+        return checked
+
+    cart.verify_vouchers(request)
+    unpaid_memberships = cart.memberships
+    unpaid_bookings = cart.bookings
+    unpaid_gift_vouchers = cart.gift_vouchers
+    total_voucher = cart.total_voucher
+    checked_total = cart.total
 
     if total != checked_total:
         messages.error(
@@ -315,30 +226,25 @@ def _check_items_and_get_updated_invoice(request):
 
     # NOTE: invoice user will always be the request.user, not any attached sub-user
     # May be different to the user on the purchased blocks
-    unpaid_membership_ids = {membership.id for membership in unpaid_memberships}
-    unpaid_booking_ids = {booking.id for booking in unpaid_bookings}
-    unpaid_gift_voucher_ids = {gift_voucher.id for gift_voucher in unpaid_gift_vouchers}
-
-    def _get_matching_invoice(invoices):
-        for invoice in invoices:
-            if (
-                {membership.id for membership in invoice.memberships.all()}
-                == unpaid_membership_ids
-                and {booking.id for booking in invoice.bookings.all()}
-                == unpaid_booking_ids
-                and {gift_voucher.id for gift_voucher in invoice.gift_vouchers.all()}
-                == unpaid_gift_voucher_ids
-            ):
-                return invoice
+    cart_fingerprint = Invoice.get_cart_fingerprint(
+        [membership.id for membership in unpaid_memberships],
+        [booking.id for booking in unpaid_bookings],
+        [gift_voucher.id for gift_voucher in unpaid_gift_vouchers],
+        total_voucher.code if total_voucher is not None else None,
+    )
 
     if request.user.is_authenticated:
         username = request.user.email
     else:
         username = ""
-    # check for an existing unpaid invoice for this user
-    invoices = Invoice.objects.filter(username=username, paid=False)
-    # if any exist, check for one where the items are the same
-    invoice = _get_matching_invoice(invoices)
+    # check for an existing unpaid invoice for this user with the same items
+    invoice = (
+        Invoice.objects.filter(
+            username=username, paid=False, cart_fingerprint=cart_fingerprint
+        )
+        .order_by("-id")
+        .first()
+    )
 
     if invoice is None:
         invoice = Invoice.objects.create(
@@ -348,43 +254,30 @@ def _check_items_and_get_updated_invoice(request):
             total_voucher_code=total_voucher.code
             if total_voucher is not None
             else None,
+            cart_fingerprint=cart_fingerprint,
         )
-        for membership in unpaid_memberships:
-            membership.invoice = invoice
-            membership.save()
-        for booking in unpaid_bookings:
-            booking.invoice = invoice
-            booking.save()
-        for gift_voucher in unpaid_gift_vouchers:
-            gift_voucher.invoice = invoice
-            gift_voucher.save()
     else:
-        # If an invoice with the expected items is found, make sure its total is current and any total voucher
-        # is updated
+        # If an invoice with the expected items is found, make sure its total is current
         invoice.amount = Decimal(total)
-        invoice.total_voucher_code = (
-            total_voucher.code if total_voucher is not None else None
-        )
         invoice.save()
 
+    # make sure all items point to the invoice; they may have been moved to a
+    # later invoice since this one was created
+    for item in [*unpaid_memberships, *unpaid_bookings, *unpaid_gift_vouchers]:
+        if item.invoice_id != invoice.id:
+            item.invoice = invoice
+            item.save()
+
     checked.update({"invoice": invoice})
 
     if total == 0:
         # if the total in the cart is 0, then a voucher has been applied to all blocks/checkout total
         # and we can mark everything as paid now
-        for membership in unpaid_memberships:
-            membership.paid = True
-            membership.save()
-        for booking in unpaid_bookings:
-            booking.paid = True
-            booking.save()
-        for gift_voucher in unpaid_gift_vouchers:
-            gift_voucher.paid = True
-            gift_voucher.save()
-            gift_voucher.activate()
+        settle_invoice(invoice)
+        for gift_voucher in invoice.gift_vouchers.select_related(
+            "gift_voucher_type", "item_voucher", "total_voucher"
+        ):
             send_gift_voucher_email(gift_voucher)
-        invoice.paid = True
-        invoice.save()
         msg = []
         if unpaid_memberships:
             msg.append("Membership(s) now ready to use.")
@@ -415,7 +308,7 @@ def stripe_checkout(request):
     logger.info("Stripe checkout for invoice id %s", invoice.invoice_id)
     # Create the Stripe PaymentIntent
     stripe.api_key = settings.STRIPE_SECRET_KEY
-    seller = Seller.objects.filter(site=Site.objects.get_current(request)).first()
+    seller = get_site_seller(request)
 
     context = {}
     if seller is None:
@@ -506,21 +399,6 @@ def stripe_checkout(request):
 
 
 def check_total(request):
-    if request.user.is_authenticated:
-        unpaid_memberships = get_unpaid_memberships(request.user)
-        unpaid_bookings = get_unpaid_bookings(request.user)
-        unpaid_gift_vouchers = get_unpaid_gift_vouchers(request.user)
-        total_voucher = _get_and_verify_total_vouchers(request)
-        _verify_item_vouchers(unpaid_memberships, unpaid_bookings)
-    else:
-        unpaid_memberships = unpaid_bookings = []
-        total_voucher = None
-        unpaid_gift_vouchers = get_unpaid_gift_vouchers_from_session(request)
-
-    checked = calculate_user_cart_total(
-        unpaid_memberships=unpaid_memberships,
-        unpaid_bookings=unpaid_bookings,
-        unpaid_gift_vouchers=unpaid_gift_vouchers,
-        total_voucher=total_voucher,
-    )
-    return JsonResponse({"total": checked})
+    cart = get_cart(request)
+    cart.verify_vouchers(request)
+    return JsonResponse({"total": cart.total})
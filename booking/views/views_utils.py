@@ -1,13 +1,12 @@
+from django.db.models import Q
 from django.urls import reverse
 from django.utils import timezone
 from django.shortcuts import HttpResponseRedirect
 
 from accounts.models import DataPrivacyPolicy
 from accounts.utils import has_active_data_privacy_agreement
-from booking.email_helpers import email_waiting_lists
-from booking.utils import host_from_request
 
-from ..models import Booking, GiftVoucher
+from ..models import BaseVoucher, GiftVoucher
 
 
 class DataPolicyAgreementRequiredMixin:
@@ -60,22 +59,21 @@ def get_unpaid_memberships(user):
     return this_year | future_years
 
 
-def get_unpaid_bookings(user, request=None):
-    event_ids_from_cleanup = Booking.cleanup_expired_bookings(user=user)
-    host = host_from_request(request) if request else None
-    email_waiting_lists(event_ids_from_cleanup, host=host)
+def get_unpaid_bookings(user):
+    # expired bookings are deleted by the delete_unpaid_bookings sweeper, not here
     return user.bookings.filter(
         status="OPEN", no_show=False, event__date__gt=timezone.now(), paid=False
     )
 
 
 def get_unpaid_gift_vouchers(user):
-    voucher_ids = [
-        gift_voucher.id
-        for gift_voucher in GiftVoucher.objects.filter(paid=False)
-        if gift_voucher.purchaser_email == user.email
-    ]
-    return GiftVoucher.objects.filter(id__in=voucher_ids)
+    # the purchaser is stored on the gift voucher's item or total voucher (both
+    # BaseVouchers); look them up by the indexed purchaser_email
+    voucher_ids = BaseVoucher.objects.filter(purchaser_email=user.email).values("id")
+    return GiftVoucher.objects.filter(
+        Q(item_voucher_id__in=voucher_ids) | Q(total_voucher_id__in=voucher_ids),
+        paid=False,
+    )
 
 
 def get_unpaid_gift_vouchers_from_session(request):
@@ -1,6 +1,5 @@
 import logging
 
-from stripe_payments.models import Invoice
 from ..models import ItemVoucher, Membership, TotalVoucher
 
 logger = logging.getLogger(__name__)
@@ -10,40 +9,33 @@ class VoucherValidationError(Exception):
     pass
 
 
+def _saved_with_voucher(item, voucher):
+    """Whether item is saved with voucher applied, so is already counted in its usage"""
+    saved_voucher_use = item.saved_voucher_use() if item is not None else None
+    return saved_voucher_use is not None and saved_voucher_use.voucher_id == voucher.id
+
+
 def validate_voucher_max_total_uses(
-    voucher, paid_only=True, user=None, item_to_exclude=()
+    voucher, paid_only=True, user=None, item_to_exclude=None
 ):
     assert isinstance(voucher, ItemVoucher)
     if voucher.max_vouchers is not None:
-        # find all items that have used the voucher
-        # This is PAID items only
-        all_used_items = voucher.used_items()
-
+        # count PAID uses by all users
+        used_voucher_count = voucher.usage().paid_uses
         if not paid_only:
             # We're counting unpaid uses for THIS USER too
-            # Find all unpaid voucher items for this user
-            user_unpaid_items = {
-                k: v.filter(user=user, paid=False)
-                for k, v in voucher.paid_and_unpaid_items().items()
-            }
-            # we count used items plus user unpaid
-            used_items_to_count = {
-                k: all_used_items[k] | user_unpaid_items[k]
-                for k, v in all_used_items.items()
-            }
-        else:
-            used_items_to_count = all_used_items
+            used_voucher_count += voucher.usage(user).reserved_uses
+
+        # exclude the current item if it's already counted
+        if item_to_exclude is not None and _saved_with_voucher(
+            item_to_exclude, voucher
+        ):
+            saved_voucher_use = item_to_exclude.saved_voucher_use()
+            if saved_voucher_use.paid or (
+                not paid_only and saved_voucher_use.user_id == user.id
+            ):
+                used_voucher_count -= 1
 
-        # exclude the current item if necessary
-        if item_to_exclude:
-            item_type, item_id = item_to_exclude
-            used_items_to_count[item_type] = used_items_to_count[item_type].exclude(
-                id=item_id
-            )
-
-        used_voucher_count = sum(
-            [item.count() for item in used_items_to_count.values()]
-        )
         if used_voucher_count >= voucher.max_vouchers:
             raise VoucherValidationError(
                 f"Voucher code {voucher.code} has limited number of total uses and expired before it could be used for all applicable items"
@@ -53,11 +45,8 @@ def validate_voucher_max_total_uses(
 def validate_total_voucher_max_total(voucher):
     assert isinstance(voucher, TotalVoucher)
     if voucher.max_vouchers is not None:
-        used_voucher_invoices = Invoice.objects.filter(
-            total_voucher_code=voucher.code, paid=True
-        )
-        # exclude any uses associated with unpaid invoices
-        if used_voucher_invoices.count() >= voucher.max_vouchers:
+        # uses are counted for paid invoices only
+        if voucher.uses() >= voucher.max_vouchers:
             raise VoucherValidationError(
                 f"Voucher code {voucher.code} has limited number of total uses and has expired"
             )
@@ -105,10 +94,7 @@ def validate_total_voucher_for_checkout_user(voucher, user):
     validate_voucher_properties(voucher)
     if (
         voucher.max_per_user is not None
-        and Invoice.objects.filter(
-            username=user.email, paid=True, total_voucher_code=voucher.code
-        ).count()
-        >= voucher.max_per_user
+        and voucher.uses(user=user) >= voucher.max_per_user
     ):
         raise VoucherValidationError(
             f"You have already used voucher code {voucher.code} the maximum number of times ({voucher.max_per_user})"
@@ -144,20 +130,18 @@ def validate_voucher_for_unpaid_item(
     if check_voucher_properties:
         # raise exceptions for all the voucher-related things
         validate_voucher_properties(voucher)
-    validate_unpaid_voucher_max_total_uses(
-        item.user, voucher, item_to_exclude=(item_type, item.id)
-    )
+    validate_unpaid_voucher_max_total_uses(item.user, voucher, item_to_exclude=item)
     # raise exception if voucher not valid specifically for this user
     if voucher.max_per_user is not None:
-        user_items = voucher.paid_and_unpaid_items(user=item.user)
-        users_used_vouchers_excluding_this_one = 0
-        for voucher_item_type, voucher_items in user_items.items():
-            if voucher_item_type != item_type:
-                users_used_vouchers_excluding_this_one += voucher_items.count()
-            else:
-                users_used_vouchers_excluding_this_one += voucher_items.exclude(
-                    id=item.id
-                ).count()
+        user_usage = voucher.usage(item.user)
+        users_used_vouchers_excluding_this_one = (
+            user_usage.paid_uses + user_usage.reserved_uses
+        )
+        if (
+            _saved_with_voucher(item, voucher)
+            and item.saved_voucher_use().user_id == item.user_id
+        ):
+            users_used_vouchers_excluding_this_one -= 1
 
         if users_used_vouchers_excluding_this_one >= voucher.max_per_user:
             raise VoucherValidationError(
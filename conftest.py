@@ -7,6 +7,7 @@ import pytest
 
 from django.contrib.auth.models import User
 from django.contrib.sites.models import Site
+from django.core.cache import cache
 from django.utils import timezone
 
 from accounts.models import (
@@ -85,6 +86,8 @@ def make_data_privacy_agreement(user):
 @pytest.fixture(autouse=True)
 def use_dummy_cache_backend(settings):
     settings.SKIP_NEW_ACCOUNT_EMAIL = True
+    # cached values can refer to objects from previous tests' rolled back data
+    cache.clear()
 
 
 def configure_user(user):
@@ -3,7 +3,13 @@ from django.urls import reverse
 from django.utils.safestring import mark_safe
 
 from booking.models import Booking, Membership, GiftVoucher
-from stripe_payments.models import Invoice, Seller, StripeRefund, StripePaymentIntent
+from stripe_payments.models import (
+    Invoice,
+    Seller,
+    StripeRefund,
+    StripePaymentIntent,
+    StripeWebhookEvent,
+)
 
 
 class BookingInline(admin.TabularInline):
@@ -202,3 +208,40 @@ class StripeRefundAdmin(admin.ModelAdmin):
 
 @admin.register(Seller)
 class SellerAdmin(admin.ModelAdmin): ...
+
+
+@admin.register(StripeWebhookEvent)
+class StripeWebhookEventAdmin(admin.ModelAdmin):
+    list_display = (
+        "event_id",
+        "event_type",
+        "status",
+        "attempts",
+        "received_at",
+        "processed_at",
+        "result",
+    )
+    fields = (
+        "event_id",
+        "event_type",
+        "status",
+        "attempts",
+        "received_at",
+        "next_attempt_at",
+        "processed_at",
+        "result",
+        "payload",
+    )
+    readonly_fields = fields
+    search_fields = ("event_id", "result")
+    list_filter = ("status", "event_type")
+    actions = ["replay"]
+
+    def replay(self, request, queryset):
+        for webhook_event in queryset:
+            webhook_event.requeue()
+        self.message_user(
+            request, f"{queryset.count()} event(s) queued to be processed again"
+        )
+
+    replay.short_description = "Replay selected events"
@@ -1,6 +1,18 @@
 from django.apps import AppConfig
+from django.conf import settings
 
 
 class StripePaymentsConfig(AppConfig):
     default_auto_field = "django.db.models.BigAutoField"
     name = "stripe_payments"
+
+    def ready(self):
+        if settings.STRIPE_FAKE_BACKEND:  # pragma: no cover
+            import stripe
+
+            from .fake_stripe import FakeStripeClient
+
+            stripe.default_http_client = FakeStripeClient(
+                latency=settings.STRIPE_FAKE_LATENCY,
+                failure_rate=settings.STRIPE_FAKE_FAILURE_RATE,
+            )
@@ -1,7 +1,7 @@
 from urllib.parse import urlencode
 import logging
 
-import requests
+import stripe
 
 from django.conf import settings
 from django.contrib.admin.views.decorators import staff_member_required
@@ -47,16 +47,12 @@ class StripeAuthorizeCallbackView(View):
     def get(self, request):
         code = request.GET.get("code")
         if code:
-            data = {
-                "client_secret": settings.STRIPE_SECRET_KEY,
-                "grant_type": "authorization_code",
-                "client_id": settings.STRIPE_CONNECT_CLIENT_ID,
-                "code": code,
-            }
-            url = "https://connect.stripe.com/oauth/token"
-            resp = requests.post(url, params=data)
+            resp_data = stripe.OAuth.token(
+                api_key=settings.STRIPE_SECRET_KEY,
+                grant_type="authorization_code",
+                code=code,
+            )
             # add stripe info to the seller
-            resp_data = resp.json()
             stripe_user_id = resp_data["stripe_user_id"]
             stripe_access_token = resp_data["access_token"]
             stripe_refresh_token = resp_data["refresh_token"]
@@ -68,6 +64,9 @@ class StripeAuthorizeCallbackView(View):
             seller.save()
             logger.info("Stripe account connected: %s", seller.stripe_user_id)
             ActivityLog.objects.create(
-                log=f"Stripe account connected: {seller.stripe_user_id}"
+                action="stripe_account_connected",
+                actor=self.request.user,
+                obj=seller,
+                log=f"Stripe account connected: {seller.stripe_user_id}",
             )
         return redirect(reverse("stripe_payments:connect_stripe"))
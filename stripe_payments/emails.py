@@ -1,9 +1,11 @@
 from django.conf import settings
-from django.core.mail import send_mail
+from django.core.mail import EmailMessage, send_mail
 from django.contrib.auth.models import User
 from django.contrib.sites.models import Site
 from django.template.loader import get_template
 
+from booking.email_outbox import send_now
+
 
 def _get_user_from_invoice(invoice):
     try:
@@ -71,15 +73,17 @@ def send_processed_refund_emails(invoice):
 
 
 def send_failed_payment_emails(payment_intent=None, error=None):
-    # send email to support only for checking;
-    send_mail(
-        "WARNING: Something went wrong with a payment!",
-        get_template("stripe_payments/email/payment_error.txt").render(
-            {"payment_intent": payment_intent, "error": error}
-        ),
-        settings.DEFAULT_FROM_EMAIL,
-        [settings.SUPPORT_EMAIL],
-        fail_silently=False,
+    # send email to support only for checking; it's an error report, so it's sent
+    # straight away rather than queued in the outbox
+    send_now(
+        EmailMessage(
+            "WARNING: Something went wrong with a payment!",
+            get_template("stripe_payments/email/payment_error.txt").render(
+                {"payment_intent": payment_intent, "error": error}
+            ),
+            settings.DEFAULT_FROM_EMAIL,
+            [settings.SUPPORT_EMAIL],
+        )
     )
 
 
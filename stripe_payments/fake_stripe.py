@@ -0,0 +1,291 @@
+"""
+An offline stand-in for the parts of the Stripe API that we use, for load testing
+checkout, webhooks and refunds without a Stripe account.
+
+FakeStripeClient is a stripe HTTP client, so the stripe library (and our code)
+works as normal while requests are answered locally.  It's installed when
+settings.STRIPE_FAKE_BACKEND is set (see StripePaymentsConfig.ready), and
+implements:
+    - PaymentIntent create, retrieve, modify and confirm
+    - Refund create
+    - Account list, and the Connect OAuth token exchange
+Objects are stored in the Django cache, so they are shared between processes if
+the cache is (e.g. the file based cache), and webhook events can be signed with
+settings.STRIPE_ENDPOINT_SECRET and posted to the stripe_webhook view.
+
+STRIPE_FAKE_LATENCY adds a delay (in seconds) to each request, and
+STRIPE_FAKE_FAILURE_RATE is the fraction of requests that fail with a Stripe API
+error.  Injected failures aren't retried by the stripe library, so each one
+reaches our code.
+"""
+
+import json
+import random
+import re
+import time
+from urllib.parse import parse_qsl, urlsplit
+
+from django.conf import settings
+from django.core.cache import cache
+from shortuuid import ShortUUID
+
+from .stripe_compat import HTTPClient, webhook_signature_header
+
+
+CACHE_PREFIX = "fake_stripe"
+
+
+def _new_id(prefix):
+    return f"{prefix}_fake_{ShortUUID().random(length=24)}"
+
+
+def _decode_params(encoded):
+    """Decode stripe's form encoding, e.g. metadata[invoice_id]=foo"""
+    params = {}
+    for key, value in parse_qsl(encoded or "", keep_blank_values=True):
+        *parents, name = re.findall(r"[^\[\]]+", key)
+        target = params
+        for parent in parents:
+            target = target.setdefault(parent, {})
+        target[name] = value
+    return params
+
+
+def _as_list(value):
+    # lists are encoded as payment_method_types[0]=card
+    if isinstance(value, dict):
+        return [value[key] for key in sorted(value, key=int)]
+    return value or []
+
+
+class FakeStripeError(Exception):
+    def __init__(self, status, message, error_type="invalid_request_error", code=None):
+        super().__init__(message)
+        self.status = status
+        self.body = {"error": {"type": error_type, "message": message, "code": code}}
+
+
+class FakeStripeClient(HTTPClient):
+    name = "fake_stripe"
+
+    def __init__(self, latency=0, failure_rate=0, **kwargs):
+        super().__init__(**kwargs)
+        self.latency = latency
+        self.failure_rate = failure_rate
+        self.routes = [
+            ("post", r"/v1/payment_intents", self.create_payment_intent),
+            ("get", r"/v1/payment_intents/(?P<id>[^/]+)", self.retrieve_payment_intent),
+            ("post", r"/v1/payment_intents/(?P<id>[^/]+)", self.modify_payment_intent),
+            (
+                "post",
+                r"/v1/payment_intents/(?P<id>[^/]+)/confirm",
+                self.confirm_payment_intent,
+            ),
+            ("post", r"/v1/refunds", self.create_refund),
+            ("get", r"/v1/accounts", self.list_accounts),
+            ("post", r"/oauth/token", self.oauth_token),
+        ]
+
+    def request(self, method, url, headers, post_data=None, *, _usage=None):
+        if self.latency:
+            time.sleep(self.latency)
+        url = urlsplit(url)
+        headers = {key.lower(): value for key, value in (headers or {}).items()}
+        response_headers = {"request-id": _new_id("req")}
+        try:
+            if self.failure_rate and random.random() < self.failure_rate:
+                response_headers["stripe-should-retry"] = "false"
+                raise FakeStripeError(500, "Injected failure", error_type="api_error")
+            for route_method, pattern, view in self.routes:
+                match = re.fullmatch(pattern, url.path)
+                if route_method == method.lower() and match:
+                    params = _decode_params(
+                        post_data if method == "post" else url.query
+                    )
+                    body = view(
+                        params,
+                        account=headers.get("stripe-account"),
+                        **match.groupdict(),
+                    )
+                    return json.dumps(body), 200, response_headers
+            raise FakeStripeError(
+                404, f"Unrecognized request URL ({method}: {url.path})"
+            )
+        except FakeStripeError as error:
+            return json.dumps(error.body), error.status, response_headers
+
+    def close(self):
+        pass
+
+    # Storage
+    def _get(self, object_type, object_id):
+        obj = cache.get(f"{CACHE_PREFIX}:{object_type}:{object_id}")
+        if obj is None:
+            raise FakeStripeError(
+                404, f"No such {object_type}: '{object_id}'", code="resource_missing"
+            )
+        return obj
+
+    def _save(self, obj):
+        cache.set(f"{CACHE_PREFIX}:{obj['object']}:{obj['id']}", obj, timeout=None)
+        return obj
+
+    # PaymentIntents
+    def create_payment_intent(self, params, account=None):
+        payment_intent_id = _new_id("pi")
+        return self._save(
+            {
+                "id": payment_intent_id,
+                "object": "payment_intent",
+                "amount": int(params["amount"]),
+                "amount_refunded": 0,
+                "currency": params.get("currency", "gbp"),
+                "description": params.get("description", ""),
+                "metadata": params.get("metadata", {}),
+                "payment_method_types": _as_list(params.get("payment_method_types")),
+                "status": "requires_payment_method",
+                "client_secret": f"{payment_intent_id}_secret_{ShortUUID().random(length=24)}",
+                "charges": {"object": "list", "data": []},
+                "last_payment_error": None,
+                "account": account,
+            }
+        )
+
+    def retrieve_payment_intent(self, params, id, account=None):
+        return self._get("payment_intent", id)
+
+    def modify_payment_intent(self, params, id, account=None):
+        payment_intent = self._get("payment_intent", id)
+        if payment_intent["status"] == "succeeded":
+            raise FakeStripeError(
+                400,
+                "This PaymentIntent's amount could not be updated because it has a "
+                "status of succeeded.",
+                code="payment_intent_unexpected_state",
+            )
+        metadata = {**payment_intent["metadata"], **params.pop("metadata", {})}
+        # setting a metadata key to an empty string removes it
+        payment_intent["metadata"] = {
+            key: value for key, value in metadata.items() if value != ""
+        }
+        if "amount" in params:
+            payment_intent["amount"] = int(params.pop("amount"))
+        if "payment_method_types" in params:
+            payment_intent["payment_method_types"] = _as_list(
+                params.pop("payment_method_types")
+            )
+        payment_intent.update(
+            {
+                key: value
+                for key, value in params.items()
+                if key in ["currency", "description"]
+            }
+        )
+        return self._save(payment_intent)
+
+    def confirm_payment_intent(self, params, id, account=None):
+        """Pay a payment intent, as Stripe.js does in the browser"""
+        payment_intent = self._get("payment_intent", id)
+        payment_intent["status"] = "succeeded"
+        payment_intent["charges"]["data"] = [
+            {
+                "id": _new_id("ch"),
+                "object": "charge",
+                "amount": payment_intent["amount"],
+                "billing_details": {"email": params.get("receipt_email", "")},
+            }
+        ]
+        return self._save(payment_intent)
+
+    # Refunds
+    def create_refund(self, params, account=None):
+        payment_intent = self._get("payment_intent", params["payment_intent"])
+        amount = int(params.get("amount", payment_intent["amount"]))
+        if payment_intent["status"] != "succeeded":
+            raise FakeStripeError(
+                400,
+                f"PaymentIntent {payment_intent['id']} does not have a successful charge to refund.",
+                code="charge_not_refundable",
+            )
+        if amount > payment_intent["amount"] - payment_intent["amount_refunded"]:
+            raise FakeStripeError(
+                400,
+                f"Refund amount ({amount}) is greater than unrefunded amount on charge",
+                code="amount_too_large",
+            )
+        payment_intent["amount_refunded"] += amount
+        self._save(payment_intent)
+        return self._save(
+            {
+                "id": _new_id("re"),
+                "object": "refund",
+                "amount": amount,
+                "currency": payment_intent["currency"],
+                "metadata": params.get("metadata", {}),
+                "payment_intent": payment_intent["id"],
+                "reason": params.get("reason"),
+                "status": "succeeded",
+            }
+        )
+
+    # Accounts
+    def _account_ids(self):
+        return cache.get(f"{CACHE_PREFIX}:account_ids", [])
+
+    def add_account(self, account_id=None):
+        account_id = account_id or _new_id("acct")
+        account_ids = self._account_ids()
+        if account_id not in account_ids:
+            cache.set(
+                f"{CACHE_PREFIX}:account_ids", [*account_ids, account_id], timeout=None
+            )
+        return {"id": account_id, "object": "account"}
+
+    def list_accounts(self, params, account=None):
+        return {
+            "object": "list",
+            "url": "/v1/accounts",
+            "has_more": False,
+            "data": [
+                {"id": account_id, "object": "account"}
+                for account_id in self._account_ids()
+            ],
+        }
+
+    def oauth_token(self, params, account=None):
+        # any authorization code connects a new account
+        account = self.add_account()
+        return {
+            "stripe_user_id": account["id"],
+            "access_token": _new_id("sk"),
+            "refresh_token": _new_id("rt"),
+            "token_type": "bearer",
+            "scope": params.get("scope", "read_write"),
+            "livemode": False,
+        }
+
+    # Webhooks
+    def signed_webhook(self, event_type, object_type, object_id, account=None):
+        """A signed webhook event for a stored object, e.g. a paid payment intent"""
+        return signed_webhook(event_type, self._get(object_type, object_id), account)
+
+
+def signed_webhook(event_type, data_object, account=None, event_id=None):
+    """
+    Returns the body and Stripe-Signature header for a webhook event, signed with
+    settings.STRIPE_ENDPOINT_SECRET as Stripe would
+    """
+    payload = json.dumps(
+        {
+            "id": event_id or _new_id("evt"),
+            "object": "event",
+            "type": event_type,
+            "created": int(time.time()),
+            "livemode": False,
+            "data": {"object": data_object},
+            **({"account": account} if account else {}),
+        }
+    )
+    return payload, webhook_signature_header(
+        payload, settings.STRIPE_ENDPOINT_SECRET, int(time.time())
+    )
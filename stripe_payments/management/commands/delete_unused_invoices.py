@@ -18,7 +18,7 @@ class Command(BaseCommand):
             for invoice in unused_invoices:
                 StripePaymentIntent.objects.filter(invoice_id=invoice.id).delete()
                 invoice.delete()
-            ActivityLog.objects.create(log=log)
+            ActivityLog.objects.create(action="invoices_deleted", log=log)
             self.stdout.write(log)
         else:
             self.stdout.write("No unpaid unused invoices to delete")
@@ -0,0 +1,74 @@
+"""
+Process Stripe webhook events received by the stripe_webhook view.
+
+Events that fail with an unexpected error (database or mail server errors etc) are
+retried with exponential backoff; after StripeWebhookEvent.MAX_ATTEMPTS, or
+straight away if the event's data can't be processed, they are marked as failed and
+support is emailed.
+
+Run with --interval to keep running as a worker process, checking for new events
+every <interval> seconds.  Use --replay to process specific events again (e.g.
+after fixing the cause of a failure), or --replay-failed to replay all failed events.
+"""
+
+import logging
+import time
+
+from django.core.management.base import BaseCommand
+
+from stripe_payments.models import StripeWebhookEvent
+from stripe_payments.utils import process_due_webhook_events
+
+
+logger = logging.getLogger(__name__)
+
+
+class Command(BaseCommand):
+    help = "Process received Stripe webhook events"
+
+    def add_arguments(self, parser):
+        parser.add_argument(
+            "--interval",
+            type=int,
+            help="Keep running, processing new events every INTERVAL seconds",
+        )
+        parser.add_argument(
+            "--replay",
+            nargs="+",
+            metavar="EVENT_ID",
+            help="Stripe event ids to process again",
+        )
+        parser.add_argument(
+            "--replay-failed",
+            action="store_true",
+            help="Process all failed events again",
+        )
+
+    def handle(self, *args, **options):
+        to_replay = StripeWebhookEvent.objects.none()
+        if options.get("replay"):
+            to_replay = StripeWebhookEvent.objects.filter(
+                event_id__in=options["replay"]
+            )
+        elif options.get("replay_failed"):
+            to_replay = StripeWebhookEvent.objects.filter(status="failed")
+        for webhook_event in to_replay:
+            webhook_event.requeue()
+
+        interval = options.get("interval")
+        if not interval:
+            self.process()
+            return
+
+        while True:
+            try:
+                self.process()
+            except Exception as e:
+                # keep the worker running; unprocessed events will be picked up again
+                logger.error(e)
+            time.sleep(interval)
+
+    def process(self):
+        processed = process_due_webhook_events()
+        if processed:
+            self.stdout.write(f"{processed} Stripe webhook event(s) processed")
@@ -0,0 +1,57 @@
+# Generated by Django 6.1 on 2026-10-18 05:33
+
+from hashlib import sha256
+
+from django.db import migrations, models
+
+
+def _cart_fingerprint(membership_ids, booking_ids, gift_voucher_ids, voucher_code):
+    # as Invoice.get_cart_fingerprint
+    cart = "|".join(
+        [
+            ",".join(str(item_id) for item_id in sorted(item_ids))
+            for item_ids in [membership_ids, booking_ids, gift_voucher_ids]
+        ]
+        + [voucher_code or ""]
+    )
+    return sha256(cart.encode("utf-8")).hexdigest()
+
+
+def add_cart_fingerprints(apps, schema_editor):
+    Invoice = apps.get_model("stripe_payments", "Invoice")
+
+    invoices = Invoice.objects.filter(paid=False).prefetch_related(
+        "memberships", "bookings", "gift_vouchers"
+    )
+    for invoice in invoices:
+        invoice.cart_fingerprint = _cart_fingerprint(
+            [membership.id for membership in invoice.memberships.all()],
+            [booking.id for booking in invoice.bookings.all()],
+            [gift_voucher.id for gift_voucher in invoice.gift_vouchers.all()],
+            invoice.total_voucher_code,
+        )
+        invoice.save(update_fields=["cart_fingerprint"])
+
+
+class Migration(migrations.Migration):
+    dependencies = [
+        ("stripe_payments", "0002_stripe_refund_and_more"),
+        ("booking", "0010_event_local_weekday_time_idx"),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name="invoice",
+            name="cart_fingerprint",
+            field=models.CharField(blank=True, max_length=64, null=True),
+        ),
+        migrations.AddIndex(
+            model_name="invoice",
+            index=models.Index(
+                condition=models.Q(("paid", False)),
+                fields=["username", "cart_fingerprint"],
+                name="unpaid_invoice_cart_idx",
+            ),
+        ),
+        migrations.RunPython(add_cart_fingerprints, migrations.RunPython.noop),
+    ]
@@ -1,14 +1,22 @@
+from datetime import timedelta
 from os import environ
 
 from django.contrib.auth.models import User
 from django.contrib.sites.models import Site
-from django.db import models
+from django.core.cache import cache
+from django.db import models, transaction
+from django.db.models.signals import post_delete, post_save
+from django.dispatch import Signal
 from django.utils import timezone
 
-from hashlib import sha512
+from hashlib import sha256, sha512
 from shortuuid import ShortUUID
 
 
+# sent when an invoice is first marked as paid, with the invoice
+invoice_paid = Signal()
+
+
 class Invoice(models.Model):
     # username(email address) rather than FK; in case we delete the user later, we want to keep financial info
     username = models.CharField(max_length=255, verbose_name="Purchaser email")
@@ -26,9 +34,19 @@ class Invoice(models.Model):
         blank=True,
         help_text="Voucher applied to invoice total",
     )
+    # hash of the items and total voucher in the cart this invoice was created for,
+    # so checkout can find a matching unpaid invoice with one indexed lookup
+    cart_fingerprint = models.CharField(max_length=64, null=True, blank=True)
 
     class Meta:
         ordering = ("-date_paid",)
+        indexes = [
+            models.Index(
+                fields=["username", "cart_fingerprint"],
+                condition=models.Q(paid=False),
+                name="unpaid_invoice_cart_idx",
+            )
+        ]
 
     def __str__(self):
         return f"{self.invoice_id} - {self.username} - £{self.amount}{' (paid)' if self.paid else ''}"
@@ -40,6 +58,19 @@ class Invoice(models.Model):
             invoice_id = ShortUUID().random(length=22)
         return invoice_id
 
+    @classmethod
+    def get_cart_fingerprint(
+        cls, membership_ids, booking_ids, gift_voucher_ids, total_voucher_code=None
+    ):
+        cart = "|".join(
+            [
+                ",".join(str(item_id) for item_id in sorted(item_ids))
+                for item_ids in [membership_ids, booking_ids, gift_voucher_ids]
+            ]
+            + [total_voucher_code or ""]
+        )
+        return sha256(cart.encode("utf-8")).hexdigest()
+
     def signature(self):
         return sha512(
             (self.invoice_id + environ["INVOICE_KEY"]).encode("utf-8")
@@ -129,9 +160,12 @@ class Invoice(models.Model):
         return {**metadata, **items_summary}
 
     def save(self, *args, **kwargs):
-        if self.paid and not self.date_paid:
+        newly_paid = self.paid and not self.date_paid
+        if newly_paid:
             self.date_paid = timezone.now()
         super().save()
+        if newly_paid:
+            invoice_paid.send(sender=Invoice, invoice=self)
 
 
 class Seller(models.Model):
@@ -223,3 +257,132 @@ class StripeRefund(models.Model):
             reason=refund.reason,
             booking_id=booking_id,
         )
+
+
+class RetryQueueItem(models.Model):
+    """
+    Base for queued work (e.g. StripeWebhookEvent, booking.OutboxEmail) that's
+    done by a worker, and retried with exponential backoff if it fails.  Items are
+    "pending" until they're done, or "failed" once they run out of attempts.
+    """
+
+    # after this many attempts an item is marked as failed
+    MAX_ATTEMPTS = 5
+    # retries back off exponentially, starting at RETRY_BACKOFF_SECONDS
+    RETRY_BACKOFF_SECONDS = 60
+
+    attempts = models.PositiveIntegerField(default=0)
+    next_attempt_at = models.DateTimeField(default=timezone.now)
+
+    class Meta:
+        abstract = True
+
+    @classmethod
+    def due(cls):
+        return cls.objects.filter(
+            status="pending", next_attempt_at__lte=timezone.now()
+        ).order_by("next_attempt_at")
+
+    def schedule_retry(self):
+        """
+        Schedule a retry after a failed attempt if there are any attempts left;
+        otherwise mark the item as failed.
+        """
+        if self.attempts >= self.MAX_ATTEMPTS:
+            self.status = "failed"
+        else:
+            delay = self.RETRY_BACKOFF_SECONDS * 2 ** (self.attempts - 1)
+            self.next_attempt_at = timezone.now() + timedelta(seconds=delay)
+
+    def requeue(self):
+        """Queue the item to be tried again, with a fresh set of attempts"""
+        self.status = "pending"
+        self.attempts = 0
+        self.next_attempt_at = timezone.now()
+        self.save()
+
+
+class StripeWebhookEvent(RetryQueueItem):
+    """
+    A Stripe webhook event, stored when it is received so the webhook can respond
+    straight away; events are processed by the process_stripe_webhooks worker.
+    Stripe event ids are unique, so repeat deliveries of an event are only stored
+    (and processed) once.  Events that fail are retried, and support is emailed
+    once they run out of attempts.
+    """
+
+    STATUS_CHOICES = (
+        ("pending", "Pending"),
+        ("processed", "Processed"),
+        ("failed", "Failed"),
+    )
+
+    event_id = models.CharField(max_length=255, unique=True)
+    event_type = models.CharField(max_length=255)
+    payload = models.JSONField()
+    status = models.CharField(max_length=20, choices=STATUS_CHOICES, default="pending")
+    received_at = models.DateTimeField(default=timezone.now)
+    processed_at = models.DateTimeField(null=True, blank=True)
+    result = models.TextField(blank=True)
+
+    class Meta:
+        ordering = ("-received_at",)
+        indexes = [
+            models.Index(
+                fields=["next_attempt_at"],
+                condition=models.Q(status="pending"),
+                name="pending_webhook_event_idx",
+            )
+        ]
+
+    def __str__(self):
+        return f"{self.event_id} - {self.event_type} ({self.status})"
+
+
+# CACHING
+
+SELLER_REGISTRY_CACHE_KEY = "stripe_seller_registry"
+
+
+def _seller_registry():
+    """
+    All sellers, by site id and by Stripe account id; there are only ever a few.
+    Cached until a seller is saved or deleted.
+    """
+    registry = cache.get(SELLER_REGISTRY_CACHE_KEY)
+    if registry is None:
+        sellers = list(Seller.objects.select_related("user"))
+        registry = {
+            "by_site": {seller.site_id: seller for seller in sellers if seller.site_id},
+            "by_account": {
+                seller.stripe_user_id: seller
+                for seller in sellers
+                if seller.stripe_user_id
+            },
+        }
+        cache.set(SELLER_REGISTRY_CACHE_KEY, registry, None)
+    return registry
+
+
+def get_site_seller(request=None):
+    """The seller connected to the current site, or None"""
+    return _seller_registry()["by_site"].get(Site.objects.get_current(request).id)
+
+
+def get_account_seller(stripe_user_id):
+    """The seller for a Stripe connected account id, or None"""
+    return _seller_registry()["by_account"].get(stripe_user_id)
+
+
+def get_seller_account_ids():
+    return list(_seller_registry()["by_account"])
+
+
+def invalidate_seller_registry(sender=None, **kwargs):
+    # once the change is committed, so a request reading the old sellers before
+    # then can't cache them again
+    transaction.on_commit(lambda: cache.delete(SELLER_REGISTRY_CACHE_KEY))
+
+
+post_save.connect(invalidate_seller_registry, sender=Seller)
+post_delete.connect(invalidate_seller_registry, sender=Seller)
@@ -0,0 +1,22 @@
+"""
+The parts of the stripe library used by the fake Stripe backend (fake_stripe.py)
+that aren't part of its public API, kept in one place so that a stripe upgrade
+that changes them only needs fixing here (see tests/test_stripe_compat.py).
+"""
+
+from hashlib import sha256
+import hmac
+
+# the base class for stripe HTTP clients, which isn't exported by the stripe package
+from stripe._http_client import HTTPClient  # noqa: F401
+
+
+def webhook_signature_header(payload, secret, timestamp):
+    """
+    The Stripe-Signature header for a webhook payload, as documented at
+    https://docs.stripe.com/webhooks#verify-manually
+    """
+    signature = hmac.new(
+        secret.encode("utf-8"), f"{timestamp}.{payload}".encode("utf-8"), sha256
+    ).hexdigest()
+    return f"t={timestamp},v1={signature}"
@@ -88,20 +88,16 @@ def test_stripe_authorize_view_superuser_required(client, configured_user, super
 authorize_callback_url = reverse("stripe_payments:authorize_stripe_callback")
 
 
-@patch("stripe_payments.connection_views.requests")
-def test_stripe_authorize_callback_view(mock_requests, client, superuser):
+@patch("stripe_payments.connection_views.stripe.OAuth")
+def test_stripe_authorize_callback_view(mock_oauth, client, superuser):
     client.force_login(superuser)
     assert not Seller.objects.exists()
 
-    class MockJsonResponse:
-        def json(self):
-            return {
-                "stripe_user_id": "test-id",
-                "access_token": "token-1",
-                "refresh_token": "token-2",
-            }
-
-    mock_requests.post.return_value = MockJsonResponse()
+    mock_oauth.token.return_value = {
+        "stripe_user_id": "test-id",
+        "access_token": "token-1",
+        "refresh_token": "token-2",
+    }
     resp = client.get(authorize_callback_url + "?code=foo", follow=True)
     assert Seller.objects.exists()
     # redirects to connect view
@@ -111,8 +107,8 @@ def test_stripe_authorize_callback_view(mock_requests, client, superuser):
     )
 
 
-@patch("stripe_payments.connection_views.requests")
-def test_stripe_authorize_callback_view_no_code(mock_requests, client, superuser):
+@patch("stripe_payments.connection_views.stripe.OAuth")
+def test_stripe_authorize_callback_view_no_code(mock_oauth, client, superuser):
     client.force_login(superuser)
     assert not Seller.objects.exists()
     resp = client.get(authorize_callback_url, follow=True)
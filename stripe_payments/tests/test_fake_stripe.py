@@ -0,0 +1,167 @@
+from unittest.mock import Mock, patch
+
+from django.shortcuts import reverse
+
+from model_bakery import baker
+import pytest
+import stripe
+
+from booking.models import Booking
+from stripe_payments.models import Invoice, Seller, StripeRefund, StripeWebhookEvent
+
+from ..fake_stripe import FakeStripeClient
+from ..utils import process_due_webhook_events, process_refund
+
+
+pytestmark = pytest.mark.django_db
+
+
+@pytest.fixture
+def fake_stripe(settings, monkeypatch):
+    settings.STRIPE_ENDPOINT_SECRET = "whsec_test"
+    settings.STRIPE_SECRET_KEY = "sk_test_fake"
+    client = FakeStripeClient()
+    monkeypatch.setattr(stripe, "default_http_client", client)
+    monkeypatch.setattr(stripe, "api_key", settings.STRIPE_SECRET_KEY)
+    yield client
+
+
+def test_payment_intent_create_retrieve_modify(fake_stripe):
+    payment_intent = stripe.PaymentIntent.create(
+        amount=1000,
+        currency="gbp",
+        payment_method_types=["card"],
+        metadata={"invoice_id": "foo", "booking_1": "1000"},
+        stripe_account="acct_1",
+    )
+    assert payment_intent.id.startswith("pi_fake_")
+    assert payment_intent.status == "requires_payment_method"
+    assert payment_intent.payment_method_types == ["card"]
+
+    # empty metadata values unset the key
+    stripe.PaymentIntent.modify(
+        payment_intent.id, amount=800, metadata={"booking_1": ""}
+    )
+    payment_intent = stripe.PaymentIntent.retrieve(payment_intent.id)
+    assert payment_intent.amount == 800
+    assert payment_intent.metadata == {"invoice_id": "foo"}
+
+    stripe.PaymentIntent.confirm(payment_intent.id)
+    with pytest.raises(stripe.InvalidRequestError):
+        stripe.PaymentIntent.modify(payment_intent.id, amount=1000)
+
+
+def test_payment_intent_not_found(fake_stripe):
+    with pytest.raises(stripe.InvalidRequestError, match="No such payment_intent"):
+        stripe.PaymentIntent.retrieve("pi_unknown")
+
+
+def test_payment_method_types_modified(fake_stripe):
+    payment_intent = stripe.PaymentIntent.create(amount=1000, currency="gbp")
+    assert payment_intent.payment_method_types == []
+    payment_intent = stripe.PaymentIntent.modify(
+        payment_intent.id, payment_method_types=["card"]
+    )
+    assert payment_intent.payment_method_types == ["card"]
+
+
+def test_unrecognized_request(fake_stripe):
+    body, status, _ = fake_stripe.request(
+        "get", "https://api.stripe.com/v1/customers", {}
+    )
+    assert status == 404
+    assert "Unrecognized request URL" in body
+    fake_stripe.close()
+
+
+@patch("stripe_payments.fake_stripe.time.sleep")
+def test_latency(mock_sleep, fake_stripe):
+    fake_stripe.latency = 0.2
+    stripe.Account.list()
+    mock_sleep.assert_called_once_with(0.2)
+
+
+def test_failure_injection(fake_stripe):
+    fake_stripe.failure_rate = 1
+    with pytest.raises(stripe.APIError, match="Injected failure"):
+        stripe.PaymentIntent.create(amount=1000, currency="gbp")
+
+
+def test_checkout_and_webhook(fake_stripe, client, configured_user, seller):
+    client.force_login(configured_user)
+    booking = baker.make(
+        Booking,
+        event=baker.make_recipe("booking.future_EV", cost=10),
+        user=configured_user,
+        paid=False,
+    )
+
+    resp = client.post(reverse("booking:stripe_checkout"), data={"cart_total": 10})
+    assert resp.status_code == 200
+    invoice = Invoice.objects.get()
+    payment_intent = stripe.PaymentIntent.retrieve(invoice.stripe_payment_intent_id)
+    assert payment_intent.amount == 1000
+    assert payment_intent.metadata["invoice_id"] == invoice.invoice_id
+
+    # the customer pays, and Stripe sends a signed webhook
+    stripe.PaymentIntent.confirm(payment_intent.id, receipt_email=configured_user.email)
+    payload, signature = fake_stripe.signed_webhook(
+        "payment_intent.succeeded",
+        "payment_intent",
+        payment_intent.id,
+        account=seller.stripe_user_id,
+    )
+    resp = client.post(
+        reverse("stripe_payments:stripe_webhook"),
+        data=payload,
+        content_type="application/json",
+        HTTP_STRIPE_SIGNATURE=signature,
+    )
+    assert resp.status_code == 200
+    assert StripeWebhookEvent.objects.count() == 1
+
+    process_due_webhook_events()
+    booking.refresh_from_db()
+    invoice.refresh_from_db()
+    assert invoice.paid is True
+    assert booking.paid is True
+
+
+def test_refund(fake_stripe, client, configured_user, seller):
+    client.force_login(configured_user)
+    booking = baker.make(
+        Booking,
+        event=baker.make_recipe("booking.future_EV", cost=8),
+        user=configured_user,
+        paid=False,
+    )
+    client.post(reverse("booking:stripe_checkout"), data={"cart_total": 8})
+    invoice = Invoice.objects.get()
+    stripe.PaymentIntent.confirm(invoice.stripe_payment_intent_id)
+    booking.refresh_from_db()
+    booking.paid = True
+    booking.save()
+
+    assert process_refund(Mock(user=configured_user), booking) is True
+    refund = StripeRefund.objects.get()
+    assert refund.amount == 800
+    assert refund.refund_id.startswith("re_fake_")
+
+    # can't refund more than was paid
+    assert process_refund(Mock(user=configured_user), booking) is False
+
+
+def test_refund_unpaid_payment_intent(fake_stripe):
+    payment_intent = stripe.PaymentIntent.create(amount=1000, currency="gbp")
+    with pytest.raises(stripe.InvalidRequestError, match="does not have a successful"):
+        stripe.Refund.create(payment_intent=payment_intent.id)
+
+
+def test_connect_account(fake_stripe, client, superuser):
+    client.force_login(superuser)
+    client.get(reverse("stripe_payments:authorize_stripe_callback") + "?code=foo")
+    seller = Seller.objects.get()
+    assert seller.stripe_user_id.startswith("acct_fake_")
+    assert [account.id for account in stripe.Account.list().data] == [
+        seller.stripe_user_id
+    ]
@@ -7,7 +7,16 @@ import pytest
 from model_bakery import baker
 
 from booking.models import Membership, Booking, GiftVoucher
-from ..models import Invoice, Seller, StripePaymentIntent, StripeRefund
+from django.contrib.sites.models import Site
+
+from ..models import (
+    Invoice,
+    Seller,
+    StripePaymentIntent,
+    StripeRefund,
+    get_account_seller,
+    get_site_seller,
+)
 
 pytestmark = pytest.mark.django_db
 
@@ -127,6 +136,32 @@ def test_seller_str():
     assert str(seller) == "testuser@test.com"
 
 
+def test_seller_registry(django_assert_num_queries, django_capture_on_commit_callbacks):
+    seller = baker.make(
+        Seller, site=Site.objects.get_current(), stripe_user_id="stripe-account-1"
+    )
+    assert get_site_seller() == seller
+    # cached after the first lookup
+    with django_assert_num_queries(0):
+        assert get_site_seller() == seller
+        assert get_account_seller("stripe-account-1") == seller
+        assert get_account_seller("stripe-account-2") is None
+
+    # invalidated when a change to a seller is committed
+    with django_capture_on_commit_callbacks() as callbacks:
+        seller.stripe_user_id = "stripe-account-2"
+        seller.save()
+    assert get_account_seller("stripe-account-1") == seller
+    for callback in callbacks:
+        callback()
+    assert get_account_seller("stripe-account-1") is None
+    assert get_account_seller("stripe-account-2") == seller
+
+    with django_capture_on_commit_callbacks(execute=True):
+        seller.delete()
+    assert get_site_seller() is None
+
+
 def test_create_stripe_payment_intent_instance_from_pi(get_mock_payment_intent):
     payment_intent = get_mock_payment_intent()
     invoice = baker.make(Invoice, invoice_id="foo123")
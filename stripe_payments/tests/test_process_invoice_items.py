@@ -0,0 +1,80 @@
+from django.core import mail
+from django.db import connection
+from django.test.utils import CaptureQueriesContext
+
+from model_bakery import baker
+import pytest
+
+from activitylog.models import ActivityLog
+from booking.models import Booking, ItemVoucher
+from stripe_payments.models import Invoice
+
+
+from ..utils import process_invoice_items, settle_invoice
+
+
+pytestmark = pytest.mark.django_db
+
+
+def _make_unpaid_bookings(invoice, user, count, **kwargs):
+    return [
+        baker.make_recipe(
+            "booking.booking", user=user, invoice=invoice, paid=False, **kwargs
+        )
+        for _ in range(count)
+    ]
+
+
+def test_settle_invoice(invoice, membership, configured_user):
+    voucher = baker.make(ItemVoucher, discount=10, event_types=["regular_session"])
+    bookings = _make_unpaid_bookings(invoice, configured_user, 2, voucher=voucher)
+    assert voucher.usage().reserved_uses == 2
+
+    assert settle_invoice(invoice) is True
+
+    invoice.refresh_from_db()
+    membership.refresh_from_db()
+    assert invoice.paid is True
+    assert invoice.date_paid is not None
+    assert membership.paid is True
+    assert all(
+        Booking.objects.filter(id__in=[booking.id for booking in bookings]).values_list(
+            "paid", flat=True
+        )
+    )
+    # voucher uses are moved from reserved to paid
+    usage = voucher.usage(configured_user)
+    assert (usage.paid_uses, usage.reserved_uses) == (2, 0)
+
+
+def test_settle_invoice_queries_dont_increase_with_items(configured_user):
+    def settle_query_count(item_count):
+        invoice = baker.make(
+            Invoice, username=configured_user.email, amount=10, paid=False
+        )
+        _make_unpaid_bookings(invoice, configured_user, item_count)
+        with CaptureQueriesContext(connection) as queries:
+            settle_invoice(invoice)
+        return len(queries)
+
+    assert settle_query_count(10) == settle_query_count(1)
+
+
+def test_process_invoice_items_only_once(invoice, membership):
+    # an invoice loaded before it was processed, e.g. by a webhook retry racing
+    # with the payment complete view
+    stale_invoice = Invoice.objects.get(id=invoice.id)
+
+    assert process_invoice_items(invoice, payment_method="Stripe") is True
+    email_count = len(mail.outbox)
+    assert email_count > 0
+
+    assert stale_invoice.paid is False
+    assert process_invoice_items(stale_invoice, payment_method="Stripe") is False
+    assert len(mail.outbox) == email_count
+    assert (
+        ActivityLog.objects.filter(
+            log__contains=f"Invoice {invoice.invoice_id}"
+        ).count()
+        == 1
+    )
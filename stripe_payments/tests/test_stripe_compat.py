@@ -0,0 +1,32 @@
+import json
+import time
+
+import pytest
+import stripe
+
+from ..stripe_compat import HTTPClient, webhook_signature_header
+
+
+def test_http_client_subclass_answers_requests(monkeypatch):
+    class Client(HTTPClient):
+        name = "test"
+
+        def request(self, method, url, headers, post_data=None, *, _usage=None):
+            return json.dumps({"id": "acct_1", "object": "account"}), 200, {}
+
+        def close(self):
+            pass
+
+    monkeypatch.setattr(stripe, "default_http_client", Client())
+    monkeypatch.setattr(stripe, "api_key", "sk_test_fake")
+    assert stripe.Account.retrieve("acct_1").id == "acct_1"
+
+
+def test_webhook_signature_header_is_verified_by_stripe():
+    payload = json.dumps({"id": "evt_1", "object": "event"})
+    header = webhook_signature_header(payload, "whsec_test", int(time.time()))
+    event = stripe.Webhook.construct_event(payload, header, "whsec_test")
+    assert event.id == "evt_1"
+
+    with pytest.raises(stripe.SignatureVerificationError):
+        stripe.Webhook.construct_event(payload, header, "whsec_other")
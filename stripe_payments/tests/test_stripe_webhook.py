@@ -1,15 +1,20 @@
+from datetime import timedelta
 from unittest.mock import patch, Mock
 import json
 import pytest
 
 from django.conf import settings
+from django.contrib.admin import AdminSite
 from django.contrib.sites.models import Site
-from django.core import mail
+from django.core import mail, management
 from django.shortcuts import reverse
+from django.utils import timezone
 
 from model_bakery import baker
 
-from ..models import Seller, StripePaymentIntent
+from ..admin import StripeWebhookEventAdmin
+from ..models import Seller, StripePaymentIntent, StripeWebhookEvent
+from ..utils import process_due_webhook_events
 
 
 pytestmark = pytest.mark.django_db
@@ -82,13 +87,17 @@ def mock_stripe_payload(seller):
     return _mock_stripe_payload
 
 
-def post_to_webhook(client, payload):
-    return client.post(
+def post_to_webhook(client, payload, process=True):
+    resp = client.post(
         webhook_url,
         data=json.dumps(payload),
         content_type="application/json",
         HTTP_STRIPE_SIGNATURE="t=1234,v1=absjfdjfeiof",
     )
+    if process:
+        # run the worker that processes the stored events
+        process_due_webhook_events()
+    return resp
 
 
 def test_webhook_with_matching_invoice_and_membership(
@@ -383,42 +392,301 @@ def test_webhook_payment_requires_action(
     assert len(mail.outbox) == 0
 
 
-@patch("stripe_payments.views.stripe.Account")
+@patch("stripe_payments.utils.stripe.Account")
 def test_webhook_authorized_account(
     mock_account, mock_stripe_verify_header, mock_stripe_payload, client
 ):
     # mock the seller that should have been created in the StripeAuthorizeCallbackView
     baker.make(Seller, stripe_user_id="stripe-account-1")
-    mock_account.list.return_value = Mock(data=[Mock(id="stripe-account-1")])
 
     payload = mock_stripe_payload("account.application.authorized")
+    payload["account"] = "stripe-account-1"
     resp = post_to_webhook(client, payload)
     assert resp.status_code == 200
+    webhook_event = StripeWebhookEvent.objects.get(event_id="evt_test123")
+    assert webhook_event.status == "processed"
+    assert webhook_event.result == ""
+    # the event identifies the connected account, no need to ask Stripe
+    mock_account.list.assert_not_called()
 
 
-@patch("stripe_payments.views.stripe.Account")
+@patch("stripe_payments.utils.stripe.Account")
 def test_webhook_authorized_account_no_seller(
     mock_account, mock_stripe_verify_header, mock_stripe_payload, client
 ):
-    mock_account.list.return_value = Mock(data=[Mock(id="stripe-account-1")])
-
     payload = mock_stripe_payload("account.application.authorized")
+    payload["account"] = "stripe-account-1"
     resp = post_to_webhook(client, payload)
     assert resp.status_code == 200
+    webhook_event = StripeWebhookEvent.objects.get(event_id="evt_test123")
+    assert webhook_event.status == "processed"
+    assert (
+        webhook_event.result == "Stripe account has no associated seller on this site"
+    )
+
+
+@patch("stripe_payments.utils.stripe.Account")
+def test_webhook_authorized_account_no_account_on_event(
+    mock_account, mock_stripe_verify_header, mock_stripe_payload, client
+):
+    # without an account on the event, check all connected accounts
+    mock_account.list.return_value = Mock(data=[Mock(id="stripe-account-1")])
+
+    payload = mock_stripe_payload("account.application.authorized")
+    del payload["account"]
+    post_to_webhook(client, payload)
+    webhook_event = StripeWebhookEvent.objects.get(event_id="evt_test123")
     assert (
-        resp.content.decode() == "Stripe account has no associated seller on this site"
+        webhook_event.result == "Stripe account has no associated seller on this site"
     )
 
 
-@patch("stripe_payments.views.stripe.Account")
+@patch("stripe_payments.utils.stripe.Account")
 def test_webhook_deauthorized_account(
     mock_account, mock_stripe_verify_header, mock_stripe_payload, seller, client
+):
+    other_seller = baker.make(
+        Seller, site=baker.make(Site), stripe_user_id="stripe-account-2"
+    )
+    assert seller.site == Site.objects.get_current()
+
+    payload = mock_stripe_payload("account.application.deauthorized")
+    resp = post_to_webhook(client, payload)
+    assert resp.status_code == 200
+    seller.refresh_from_db()
+    other_seller.refresh_from_db()
+    assert seller.site is None
+    assert other_seller.site is not None
+    mock_account.list.assert_not_called()
+
+
+@patch("stripe_payments.utils.stripe.Account")
+def test_webhook_deauthorized_account_no_account_on_event(
+    mock_account, mock_stripe_verify_header, mock_stripe_payload, seller, client
 ):
     assert seller.site == Site.objects.get_current()
     mock_account.list.return_value = Mock(data=[])
 
     payload = mock_stripe_payload("account.application.deauthorized")
+    del payload["account"]
     resp = post_to_webhook(client, payload)
     assert resp.status_code == 200
     seller.refresh_from_db()
     assert seller.site is None
+
+
+@pytest.fixture
+def succeeded_payload(mock_stripe_payload, invoice):
+    metadata = {
+        "invoice_id": "foo",
+        "invoice_signature": invoice.signature(),
+        **invoice.items_metadata(),
+    }
+    return mock_stripe_payload("payment_intent.succeeded", metadata=metadata)
+
+
+def test_webhook_stores_event_and_responds_before_processing(
+    mock_stripe_verify_header, succeeded_payload, client, invoice, membership
+):
+    resp = post_to_webhook(client, succeeded_payload, process=False)
+    assert resp.status_code == 200
+
+    webhook_event = StripeWebhookEvent.objects.get(event_id="evt_test123")
+    assert webhook_event.status == "pending"
+    assert webhook_event.event_type == "payment_intent.succeeded"
+    assert webhook_event.payload == succeeded_payload
+    # nothing is processed until the worker runs
+    invoice.refresh_from_db()
+    assert invoice.paid is False
+    assert len(mail.outbox) == 0
+
+    assert process_due_webhook_events() == 1
+    invoice.refresh_from_db()
+    webhook_event.refresh_from_db()
+    assert invoice.paid is True
+    assert webhook_event.status == "processed"
+    assert webhook_event.attempts == 1
+    assert webhook_event.processed_at is not None
+
+
+def test_webhook_duplicate_event_delivery(
+    mock_stripe_verify_header, succeeded_payload, client, invoice, membership
+):
+    post_to_webhook(client, succeeded_payload, process=False)
+    resp = post_to_webhook(client, succeeded_payload, process=False)
+    assert resp.status_code == 200
+    assert StripeWebhookEvent.objects.count() == 1
+
+    assert process_due_webhook_events() == 1
+    email_count = len(mail.outbox)
+    # a repeat delivery after processing is acknowledged, but not processed again
+    resp = post_to_webhook(client, succeeded_payload)
+    assert resp.status_code == 200
+    assert StripeWebhookEvent.objects.count() == 1
+    assert len(mail.outbox) == email_count
+
+
+def test_webhook_event_retried_with_backoff(
+    mock_stripe_verify_header, succeeded_payload, client, invoice, membership
+):
+    post_to_webhook(client, succeeded_payload, process=False)
+    with patch(
+        "stripe_payments.utils.send_processed_payment_emails",
+        side_effect=ConnectionError("Mail server unavailable"),
+    ):
+        assert process_due_webhook_events() == 1
+
+    webhook_event = StripeWebhookEvent.objects.get(event_id="evt_test123")
+    assert webhook_event.status == "pending"
+    assert webhook_event.attempts == 1
+    assert webhook_event.result == "Mail server unavailable"
+    assert webhook_event.next_attempt_at > timezone.now() + timedelta(seconds=50)
+    # the transaction was rolled back, so the invoice can be processed on retry
+    invoice.refresh_from_db()
+    assert invoice.paid is False
+    # not due yet
+    assert process_due_webhook_events() == 0
+
+    webhook_event.next_attempt_at = timezone.now()
+    webhook_event.save()
+    assert process_due_webhook_events() == 1
+    webhook_event.refresh_from_db()
+    invoice.refresh_from_db()
+    assert webhook_event.status == "processed"
+    assert webhook_event.attempts == 2
+    assert invoice.paid is True
+
+
+def test_webhook_event_fails_after_max_attempts(
+    mock_stripe_verify_header, succeeded_payload, client, invoice, membership
+):
+    post_to_webhook(client, succeeded_payload, process=False)
+    webhook_event = StripeWebhookEvent.objects.get(event_id="evt_test123")
+    webhook_event.attempts = StripeWebhookEvent.MAX_ATTEMPTS - 1
+    webhook_event.save()
+    with patch(
+        "stripe_payments.utils.send_processed_payment_emails",
+        side_effect=ConnectionError("Mail server unavailable"),
+    ):
+        process_due_webhook_events()
+
+    webhook_event.refresh_from_db()
+    assert webhook_event.status == "failed"
+    assert len(mail.outbox) == 1
+    assert mail.outbox[0].to == [settings.SUPPORT_EMAIL]
+
+
+def test_replay_failed_webhook_event(
+    mock_stripe_verify_header, mock_stripe_payload, client, invoice, membership
+):
+    # invalid invoice signature
+    metadata = {
+        "invoice_id": "foo",
+        "invoice_signature": "foo",
+        **invoice.items_metadata(),
+    }
+    payload = mock_stripe_payload("payment_intent.succeeded", metadata=metadata)
+    post_to_webhook(client, payload)
+    webhook_event = StripeWebhookEvent.objects.get(event_id="evt_test123")
+    # processing errors aren't retried
+    assert webhook_event.status == "failed"
+    assert webhook_event.attempts == 1
+
+    # fix the payload and replay
+    webhook_event.payload["data"]["object"]["metadata"]["invoice_signature"] = (
+        invoice.signature()
+    )
+    webhook_event.save()
+    management.call_command("process_stripe_webhooks", "--replay", "evt_test123")
+
+    webhook_event.refresh_from_db()
+    invoice.refresh_from_db()
+    assert webhook_event.status == "processed"
+    assert invoice.paid is True
+
+
+def test_failed_webhook_event_report_mail_fails(
+    mock_stripe_verify_header, succeeded_payload, client, invoice, membership
+):
+    post_to_webhook(client, succeeded_payload, process=False)
+    StripeWebhookEvent.objects.update(attempts=StripeWebhookEvent.MAX_ATTEMPTS - 1)
+    with (
+        patch(
+            "stripe_payments.utils.send_processed_payment_emails",
+            side_effect=ConnectionError("Mail server unavailable"),
+        ),
+        patch(
+            "stripe_payments.utils.send_failed_payment_emails",
+            side_effect=ConnectionError("Mail server unavailable"),
+        ),
+        patch("stripe_payments.utils.logger.error") as mock_error,
+    ):
+        # the report failing doesn't stop the worker
+        assert process_due_webhook_events() == 1
+
+    webhook_event = StripeWebhookEvent.objects.get()
+    assert webhook_event.status == "failed"
+    assert mock_error.call_count == 2
+
+
+def test_replay_all_failed_webhook_events(
+    mock_stripe_verify_header, succeeded_payload, client, invoice, membership
+):
+    post_to_webhook(client, succeeded_payload, process=False)
+    webhook_event = StripeWebhookEvent.objects.get()
+    webhook_event.status = "failed"
+    webhook_event.attempts = StripeWebhookEvent.MAX_ATTEMPTS
+    webhook_event.save()
+    assert str(webhook_event) == "evt_test123 - payment_intent.succeeded (failed)"
+
+    management.call_command("process_stripe_webhooks", "--replay-failed")
+    webhook_event.refresh_from_db()
+    assert webhook_event.status == "processed"
+    assert webhook_event.attempts == 1
+
+
+def test_admin_replay(
+    mock_stripe_verify_header, succeeded_payload, client, invoice, membership
+):
+    post_to_webhook(client, succeeded_payload)
+    webhook_event_admin = StripeWebhookEventAdmin(StripeWebhookEvent, AdminSite())
+    with patch.object(webhook_event_admin, "message_user") as mock_message_user:
+        webhook_event_admin.replay(Mock(), StripeWebhookEvent.objects.all())
+    assert mock_message_user.call_args.args[1] == (
+        "1 event(s) queued to be processed again"
+    )
+    webhook_event = StripeWebhookEvent.objects.get()
+    assert webhook_event.status == "pending"
+    assert webhook_event.attempts == 0
+
+
+@patch("stripe_payments.management.commands.process_stripe_webhooks.time.sleep")
+def test_interval_runs_until_stopped(
+    mock_sleep,
+    mock_stripe_verify_header,
+    succeeded_payload,
+    client,
+    invoice,
+    membership,
+):
+    post_to_webhook(client, succeeded_payload, process=False)
+    mock_sleep.side_effect = [None, KeyboardInterrupt]
+    with pytest.raises(KeyboardInterrupt):
+        management.call_command("process_stripe_webhooks", interval=60)
+    assert mock_sleep.call_count == 2
+    assert StripeWebhookEvent.objects.get().status == "processed"
+
+
+@patch("stripe_payments.management.commands.process_stripe_webhooks.logger.error")
+@patch("stripe_payments.management.commands.process_stripe_webhooks.time.sleep")
+@patch(
+    "stripe_payments.management.commands.process_stripe_webhooks."
+    "process_due_webhook_events"
+)
+def test_interval_keeps_running_after_errors(mock_process, mock_sleep, mock_error):
+    mock_process.side_effect = [Exception("Error"), 1]
+    mock_sleep.side_effect = [None, KeyboardInterrupt]
+    with pytest.raises(KeyboardInterrupt):
+        management.call_command("process_stripe_webhooks", interval=60)
+    assert mock_process.call_count == 2
+    mock_error.assert_called_once()
@@ -1,13 +1,34 @@
 import logging
 from django.conf import settings
-from django.contrib.sites.models import Site
+from django.db import transaction
+from django.db.models import prefetch_related_objects
+from django.utils import timezone
 import stripe
 
-from activitylog.models import ActivityLog
+from activitylog.models import ActivityLog, buffered_activity_logs
 from booking.email_helpers import send_gift_voucher_email
-from .emails import send_processed_payment_emails, send_invalid_request_email
+from booking.models import (
+    VoucherUse,
+    invalidate_cart_item_count_cache,
+    update_voucher_usage,
+)
+from .emails import (
+    send_failed_payment_emails,
+    send_invalid_request_email,
+    send_processed_payment_emails,
+    send_processed_refund_emails,
+)
 from .exceptions import StripeProcessingError
-from .models import Invoice, StripeRefund, StripePaymentIntent, Seller
+from .models import (
+    Invoice,
+    StripeRefund,
+    StripePaymentIntent,
+    StripeWebhookEvent,
+    Seller,
+    get_account_seller,
+    get_seller_account_ids,
+    get_site_seller,
+)
 
 
 logger = logging.getLogger(__name__)
@@ -54,31 +75,274 @@ def check_stripe_data(payment_intent, invoice):
         )
 
 
+def settle_invoice(invoice):
+    """
+    Mark an invoice and all its items as paid, in a single transaction with bulk
+    updates.  The invoice row is locked first, so if the same invoice is settled
+    concurrently (e.g. a webhook retry racing with stripe_payment_complete), only
+    the first one settles it.  Returns False if the invoice was already paid.
+    """
+    with transaction.atomic():
+        already_paid = (
+            Invoice.objects.select_for_update()
+            .filter(pk=invoice.pk)
+            .values_list("paid", flat=True)
+            .get()
+        )
+        if already_paid:
+            return False
+
+        # bulk updates don't call save() or send signals, so update the voucher
+        # usage counts and cart caches here
+        paid_items = []
+        for unpaid_items in [
+            invoice.bookings.filter(paid=False),
+            invoice.memberships.filter(paid=False),
+        ]:
+            paid_items += unpaid_items.values_list("voucher_id", "user_id")
+            unpaid_items.update(paid=True)
+        update_voucher_usage(
+            removed=[VoucherUse(*use, False) for use in paid_items],
+            added=[VoucherUse(*use, True) for use in paid_items],
+        )
+
+        unpaid_gift_vouchers = invoice.gift_vouchers.filter(paid=False)
+        gift_vouchers = list(
+            unpaid_gift_vouchers.select_related(
+                "gift_voucher_type", "item_voucher", "total_voucher"
+            )
+        )
+        unpaid_gift_vouchers.update(paid=True)
+        for gift_voucher in gift_vouchers:
+            gift_voucher.paid = True
+            gift_voucher.activate()
+
+        invoice.paid = True
+        invoice.save()
+    invalidate_cart_item_count_cache({user_id for _, user_id in paid_items})
+    return True
+
+
 def process_invoice_items(invoice, payment_method, transaction_id=None, request=None):
-    for booking in invoice.bookings.all():
-        booking.paid = True
-        booking.save()
-    for membership in invoice.memberships.all():
-        membership.paid = True
-        membership.save()
-    for gift_voucher in invoice.gift_vouchers.all():
-        gift_voucher.paid = True
-        gift_voucher.save()
-        gift_voucher.activate()
+    """
+    Settle a paid invoice, then send the emails once its items are all paid.
+    Returns False if the invoice had already been processed.
+    """
+    if not settle_invoice(invoice):
+        logger.info("Invoice %s has already been processed", invoice.invoice_id)
+        return False
 
-    invoice.paid = True
-    invoice.save()
-    # SEND EMAILS
+    # SEND EMAILS; load the items once for all the email templates
+    prefetch_related_objects(
+        [invoice],
+        "memberships__membership_type",
+        "memberships__user",
+        "memberships__voucher",
+        "bookings__event",
+        "bookings__user",
+        "bookings__voucher",
+        "gift_vouchers__gift_voucher_type__membership_type",
+        "gift_vouchers__item_voucher",
+        "gift_vouchers__total_voucher",
+    )
     send_processed_payment_emails(invoice)
     for gift_voucher in invoice.gift_vouchers.all():
         send_gift_voucher_email(gift_voucher, request=request)
     ActivityLog.objects.create(
-        log=f"Invoice {invoice.invoice_id} (user {invoice.username}) paid by {payment_method}"
+        action="invoice_paid",
+        obj=invoice,
+        log=f"Invoice {invoice.invoice_id} (user {invoice.username}) paid by {payment_method}",
     )
+    return True
+
+
+def process_completed_stripe_payment(
+    payment_intent, invoice, seller=None, request=None
+):
+    if not invoice.paid:
+        logger.info("Updating items to paid for invoice %s", invoice.invoice_id)
+        check_stripe_data(payment_intent, invoice)
+        logger.info("Stripe check OK")
+        if process_invoice_items(invoice, payment_method="Stripe", request=request):
+            # update/create the django model PaymentIntent - this is just for records
+            StripePaymentIntent.update_or_create_payment_intent_instance(
+                payment_intent, invoice, seller
+            )
+    else:
+        logger.info(
+            "Payment Intents signal received for invoice %s; already processed",
+            invoice.invoice_id,
+        )
+
+
+# payment_failed and requires_action happen when a user does something wrong - either
+# their card is declined, has insufficient funds etc. There's no error in the system,
+# so just log it and continue
+# https://docs.stripe.com/declines/codes
+# The following are unusual and not the standard user/card error (entering the wrong
+# cvv, insufficient funds etc) and might need more investigation
+UNEXPECTED_DECLINE_CODES = [
+    "authentication_not_handled",
+    "approve_with_id",
+    "fraudulent",
+    "invalid_amount",
+    "merchant_blacklist",
+    "processing_error",
+    "reenter_transaction",
+    "testmode_decline",
+]
+
+
+def _event_account_ids(event):
+    """
+    The connected account ids an account.application event relates to.  Events
+    sent from a connected account identify it, so we only need to ask Stripe for
+    all the connected accounts if there's no account on the event.
+    """
+    if event.get("account"):
+        return [event.account]
+    return [account.id for account in stripe.Account.list().data]
+
+
+def handle_stripe_event(event):
+    """
+    Act on a Stripe webhook event.  Returns a message describing the outcome, to
+    record on the stored event.
+    """
+    if event.type == "account.application.authorized":
+        for account_id in _event_account_ids(event):
+            if get_account_seller(account_id) is None:
+                logger.error(
+                    "Stripe account has no associated seller on this site %s",
+                    account_id,
+                )
+                # not retried; the error log will trigger an email to support.
+                return "Stripe account has no associated seller on this site"
+        return ""
+
+    elif event.type == "account.application.deauthorized":
+        if event.get("account"):
+            disconnected_account_ids = [event.account]
+        else:
+            connected_account_ids = _event_account_ids(event)
+            disconnected_account_ids = [
+                account_id
+                for account_id in get_seller_account_ids()
+                if account_id not in connected_account_ids
+            ]
+        for seller in Seller.objects.filter(
+            stripe_user_id__in=disconnected_account_ids, site__isnull=False
+        ):
+            seller.site = None
+            seller.save()
+            logger.info("Stripe account disconnected: %s", seller.stripe_user_id)
+            ActivityLog.objects.create(
+                action="stripe_account_disconnected",
+                obj=seller,
+                log=f"Stripe account disconnected: {seller.stripe_user_id}",
+            )
+        return ""
+
+    payment_intent = event.data.object
+    invoice = get_invoice_from_payment_intent(payment_intent, raise_immediately=True)
+    # invoice can be None; this means there was no invoice info in the payment intent
+    # metadata, which isn't an error; it's probably a transaction that happened outside
+    # of the system. If we got invoice info but couldn't find a matching invoice, this IS
+    # raised as an exception
+    if invoice is None:
+        return "No invoice"
+
+    if event.type == "payment_intent.succeeded":
+        process_completed_stripe_payment(payment_intent, invoice)
+    elif event.type == "payment_intent.refunded":
+        send_processed_refund_emails(invoice)
+    elif event.type == "payment_intent.payment_failed":
+        msg = (
+            f"Failed payment intent id: {payment_intent.id}; invoice id {invoice.invoice_id}; "
+            f"error: {payment_intent.last_payment_error.type}; decline code: {payment_intent.last_payment_error.decline_code}"
+        )
+        if payment_intent.last_payment_error.decline_code in UNEXPECTED_DECLINE_CODES:
+            logger.error(msg)
+            send_failed_payment_emails(error=msg)
+        else:
+            logger.info(msg)
+        return msg
+    elif event.type == "payment_intent.requires_action":
+        logger.info(
+            f"Payment intent requires action: id {payment_intent.id}; invoice id {invoice.invoice_id}"
+        )
+    return f"Invoice {invoice.invoice_id}"
+
+
+def _report_failed_webhook_event(webhook_event, error):
+    logger.error("Error processing Stripe event %s: %s", webhook_event.event_id, error)
+    try:
+        send_failed_payment_emails(error=error)
+    except Exception as e:
+        # don't let a mail failure stop the worker; the log above notifies support
+        logger.error(e)
+
+
+@buffered_activity_logs()
+def process_webhook_event(webhook_event):
+    """
+    Process a stored webhook event and record the outcome.  Processing runs in a
+    transaction, so an event that errors part way through leaves nothing half done
+    and can safely be retried.  StripeProcessingErrors (bad invoice data etc) won't
+    be fixed by trying again, so those events fail straight away; anything else
+    (database or mail server errors) is retried with backoff.
+    """
+    stripe.api_key = settings.STRIPE_SECRET_KEY
+    event = stripe.Event.construct_from(webhook_event.payload, stripe.api_key)
+    webhook_event.attempts += 1
+    try:
+        with transaction.atomic():
+            result = handle_stripe_event(event)
+    except StripeProcessingError as e:
+        webhook_event.status = "failed"
+        webhook_event.result = str(e)
+        _report_failed_webhook_event(webhook_event, e)
+    except Exception as e:
+        webhook_event.result = str(e)
+        webhook_event.schedule_retry()
+        if webhook_event.status == "failed":
+            _report_failed_webhook_event(webhook_event, e)
+        else:
+            logger.warning(
+                "Error processing Stripe event %s (attempt %s), will retry: %s",
+                webhook_event.event_id,
+                webhook_event.attempts,
+                e,
+            )
+    else:
+        webhook_event.status = "processed"
+        webhook_event.processed_at = timezone.now()
+        webhook_event.result = result
+    webhook_event.save()
+
+
+def process_due_webhook_events(limit=None):
+    """
+    Process pending webhook events that are due, oldest first.  Each event is
+    locked while it's processed, so concurrent workers skip it.  Returns the
+    number of events processed.
+    """
+    processed = 0
+    while limit is None or processed < limit:
+        with transaction.atomic():
+            webhook_event = (
+                StripeWebhookEvent.due().select_for_update(skip_locked=True).first()
+            )
+            if webhook_event is None:
+                break
+            process_webhook_event(webhook_event)
+        processed += 1
+    return processed
 
 
-def process_refund(request, booking):
-    # process refund
+def process_refund(request, booking, cancelled_by=None):
+    # process refund; request can be None when refunding outside a request (e.g.
+    # from a background job), with the email of the user cancelling in cancelled_by
     refunded = False
     try:
         try:
@@ -90,9 +354,7 @@ def process_refund(request, booking):
             send_invalid_request_email(request, booking, "Payment intent not found")
         else:
             stripe.api_key = settings.STRIPE_SECRET_KEY
-            seller = Seller.objects.filter(
-                site=Site.objects.get_current(request)
-            ).first()
+            seller = get_site_seller(request)
 
             # get the amount to refund from the metadata (in) pence)
             amount = payment_intent.metadata.get(f"booking_{booking.id}_cost_in_p")
@@ -107,7 +369,7 @@ def process_refund(request, booking):
                         amount=int(amount),
                         metadata={
                             "booking_id": booking.id,
-                            "cancelled_by": request.user.email,
+                            "cancelled_by": cancelled_by or request.user.email,
                         },
                         payment_intent=payment_intent.payment_intent_id,
                         reason="requested_by_customer",
@@ -118,7 +380,9 @@ def process_refund(request, booking):
                     )
                     refunded = True
                     ActivityLog.objects.create(
-                        log=f"Refund for booking {booking.id} (user {booking.user.username}) processed"
+                        action="booking_refunded",
+                        obj=booking,
+                        log=f"Refund for booking {booking.id} (user {booking.user.username}) processed",
                     )
                 except stripe.error.InvalidRequestError as error:
                     # send warning email to tech support
@@ -4,43 +4,21 @@ import logging
 import stripe
 
 from django.conf import settings
-from django.contrib.sites.models import Site
 from django.views.decorators.csrf import csrf_exempt
 from django.views.decorators.http import require_POST
 from django.shortcuts import render, HttpResponse
 
-from activitylog.models import ActivityLog
-from .emails import send_failed_payment_emails, send_processed_refund_emails
+from .emails import send_failed_payment_emails
 from .exceptions import StripeProcessingError
-from .models import Seller, StripePaymentIntent
+from .models import StripeWebhookEvent, get_site_seller
 from .utils import (
     get_invoice_from_payment_intent,
-    check_stripe_data,
-    process_invoice_items,
+    process_completed_stripe_payment,
 )
 
 logger = logging.getLogger(__name__)
 
 
-def _process_completed_stripe_payment(
-    payment_intent, invoice, seller=None, request=None
-):
-    if not invoice.paid:
-        logger.info("Updating items to paid for invoice %s", invoice.invoice_id)
-        check_stripe_data(payment_intent, invoice)
-        logger.info("Stripe check OK")
-        process_invoice_items(invoice, payment_method="Stripe", request=request)
-        # update/create the django model PaymentIntent - this is just for records
-        StripePaymentIntent.update_or_create_payment_intent_instance(
-            payment_intent, invoice, seller
-        )
-    else:
-        logger.info(
-            "Payment Intents signal received for invoice %s; already processed",
-            invoice.invoice_id,
-        )
-
-
 @require_POST
 def stripe_payment_complete(request):
     payload = request.POST.get("payload")
@@ -54,7 +32,7 @@ def stripe_payment_complete(request):
     payload = json.loads(payload)
     logger.info("Processing payment intent from payload %s", payload)
     stripe.api_key = settings.STRIPE_SECRET_KEY
-    seller = Seller.objects.filter(site=Site.objects.get_current(request)).first()
+    seller = get_site_seller(request)
     stripe_account = seller.stripe_user_id
     payment_intent = stripe.PaymentIntent.retrieve(
         payload["id"], stripe_account=stripe_account
@@ -67,7 +45,7 @@ def stripe_payment_complete(request):
         )
         if invoice is not None:
             try:
-                _process_completed_stripe_payment(
+                process_completed_stripe_payment(
                     payment_intent, invoice, seller, request=request
                 )
             except StripeProcessingError as e:
@@ -120,102 +98,31 @@ def stripe_webhook(request):
         logger.error(e)
         return HttpResponse("Unable to contruct webhook event", status=400)
 
-    event_object = event.data.object
-    if event.type == "account.application.authorized":
-        connected_accounts = stripe.Account.list().data
-        for connected_account in connected_accounts:
-            seller = Seller.objects.filter(stripe_user_id=connected_account.id)
-            if not seller.exists():
-                logger.error(
-                    "Stripe account has no associated seller on this site %s",
-                    connected_account.id,
-                )
-                # return 200 so we don't keep trying. The error log will trigger an email to support.
-                return HttpResponse(
-                    "Stripe account has no associated seller on this site", status=200
-                )
-        return HttpResponse(status=200)
-
-    elif event.type == "account.application.deauthorized":
-        connected_accounts = stripe.Account.list().data
-        connected_account_ids = [account.id for account in connected_accounts]
-        for seller in Seller.objects.all():
-            if seller.stripe_user_id not in connected_account_ids:
-                seller.site = None
-                seller.save()
-                logger.info("Stripe account disconnected: %s", seller.stripe_user_id)
-                ActivityLog.objects.create(
-                    log=f"Stripe account disconnected: {seller.stripe_user_id}"
-                )
-        return HttpResponse(status=200)
-
-    try:
-        site_seller = Seller.objects.filter(
-            site=Site.objects.get_current(request)
-        ).first()
+    if not event.type.startswith("account.application."):
         try:
             # account is only present on the event if it originated from a connected account
             # All events we're interested in are related to a connected account, but potentially
             # a refund or other event that occurred outside of the system could be relevant, so
             # if this raises an AttributeError, we log and proceed
             account = event.account
-        except Exception as e:
+        except AttributeError as e:
             logger.error(e)
         else:
-            if account != site_seller.stripe_user_id:
+            site_seller = get_site_seller(request)
+            if site_seller is None or account != site_seller.stripe_user_id:
                 # relates to a different seller, just return and let the next webhook manage it
                 logger.info("Mismatched seller account %s", account)
                 return HttpResponse("Ignored: Mismatched seller account", status=200)
 
-        payment_intent = event_object
-        invoice = get_invoice_from_payment_intent(
-            payment_intent, raise_immediately=True
-        )
-        # invoice can be None; this means there was no invoice info in the payment intent
-        # metadata, which isn't an error; it's probably a transaction that happened outside
-        # of the system. If we got invoice info but couldn't find a matching invoice, this IS
-        # raised as an exception and will be handles bellow
-        # payment_failed and requires_action happend when a user does something wrong - either
-        # their card is declined, has insufficient funds etc. There's no error in the system,
-        # so just log it and continue
-        # https://docs.stripe.com/declines/codes
-        # The following are unusual and not the standard user/card error (entering the wrong
-        # cvv, insufficient funds etc) and might need more investigation
-        unexpected_decline_codes = [
-            "authentication_not_handled",
-            "approve_with_id",
-            "fraudulent",
-            "invalid_amount",
-            "merchant_blacklist",
-            "processing_error",
-            "reenter_transaction",
-            "testmode_decline",
-        ]
-        if invoice is not None:
-            if event.type == "payment_intent.succeeded":
-                _process_completed_stripe_payment(
-                    payment_intent, invoice, request=request
-                )
-            elif event.type == "payment_intent.refunded":
-                send_processed_refund_emails(invoice)
-            elif event.type == "payment_intent.payment_failed":
-                msg = (
-                    f"Failed payment intent id: {payment_intent.id}; invoice id {invoice.invoice_id}; "
-                    f"error: {payment_intent.last_payment_error.type}; decline code: {payment_intent.last_payment_error.decline_code}"
-                )
-                if (
-                    payment_intent.last_payment_error.decline_code
-                    in unexpected_decline_codes
-                ):
-                    logger.error(msg)
-                    send_failed_payment_emails(error=msg)
-                else:
-                    logger.info(msg)
-            elif event.type == "payment_intent.requires_action":
-                logger.info(
-                    f"Payment intent requires action: id {payment_intent.id}; invoice id {invoice.invoice_id}"
-                )
-    except Exception as e:  # log anything else and send error emails
-        logger.error(e)
-        send_failed_payment_emails(error=e)
+    # Store the event and acknowledge it straight away; it's processed by the
+    # process_stripe_webhooks worker.  Stripe can deliver the same event more than
+    # once, so events that have already been received are ignored
+    StripeWebhookEvent.objects.bulk_create(
+        [
+            StripeWebhookEvent(
+                event_id=event.id, event_type=event.type, payload=json.loads(payload)
+            )
+        ],
+        ignore_conflicts=True,
+    )
     return HttpResponse(status=200)
@@ -57,8 +57,11 @@ def ajax_toggle_cancellation_fee_payment(request, booking_id):
             booking.cancellation_fee_paid = True
             new_payment_status = "paid"
         ActivityLog.objects.create(
+            action=f"cancellation_fee_{new_payment_status}",
+            actor=request.user,
+            obj=booking,
             log=f"Cancellation fee marked as {new_payment_status} for booking {booking.id} ({booking.user.username})"
-            f"by admin user {request.user.username}"
+            f"by admin user {request.user.username}",
         )
         booking.save()
 
@@ -100,8 +103,11 @@ def ajax_toggle_remove_cancellation_fee(request, booking_id):
         new_fee_status = "added"
         new_status_log_text = "added to"
     ActivityLog.objects.create(
+        action=f"cancellation_fee_{new_fee_status}",
+        actor=request.user,
+        obj=booking,
         log=f"Cancellation fee {new_status_log_text} booking {booking.id} for {booking.user.username}"
-        f"by admin user {request.user.username}"
+        f"by admin user {request.user.username}",
     )
     booking.save()
 
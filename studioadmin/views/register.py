@@ -19,7 +19,7 @@ from django.views.decorators.http import require_http_methods
 
 from braces.views import LoginRequiredMixin
 
-from booking.email_helpers import send_waiting_list_email
+from booking.email_helpers import email_waiting_lists
 from booking.models import Event, Booking, WaitingListUser
 
 from ..forms import AddRegisterBookingForm, StatusFilter
@@ -66,13 +66,14 @@ class EventRegisterListView(LoginRequiredMixin, ListView):
         today = timezone.now().replace(hour=0, minute=0)
         event_type = self.kwargs["event_type"]
         show_all = self.request.GET.get("show_all", False)
+        events = Event.objects.with_open_booking_count()
         if show_all:
-            return Event.objects.filter(
-                event_type=event_type, date__gte=today
-            ).order_by("date")
+            return events.filter(event_type=event_type, date__gte=today).order_by(
+                "date"
+            )
         else:
             end_date = timezone.now() + timedelta(7)
-            return Event.objects.filter(
+            return events.filter(
                 event_type=event_type, date__gte=today, date__lte=end_date
             ).order_by("date")
 
@@ -136,6 +137,9 @@ def process_event_booking_updates(form, event, request):
     )
 
     ActivityLog.objects.create(
+        action=f"booking_{action}",
+        actor=request.user,
+        obj=booking,
         log='Booking id {} (user {}) for "{}" {} by admin user {}. {}'.format(
             booking.id,
             booking.user.username,
@@ -143,7 +147,7 @@ def process_event_booking_updates(form, event, request):
             action,
             request.user.username,
             extra_msg,
-        )
+        ),
     )
 
     try:
@@ -152,9 +156,12 @@ def process_event_booking_updates(form, event, request):
         )
         waiting_list_user.delete()
         ActivityLog.objects.create(
+            action="waiting_list_removed",
+            actor=request.user,
+            event=booking.event,
             log="User {} has been removed from the waiting list for {}".format(
                 booking.user.username, booking.event
-            )
+            ),
         )
     except WaitingListUser.DoesNotExist:
         pass
@@ -188,8 +195,11 @@ def ajax_toggle_attended(request, booking_id):
         booking.no_show = True
 
     ActivityLog.objects.create(
+        action="attendance_marked",
+        actor=request.user,
+        obj=booking,
         log=f"User {booking.user.username} marked as {attendance} for {booking.event} "
-        f"by admin user {request.user.username}"
+        f"by admin user {request.user.username}",
     )
     booking.save()
 
@@ -199,19 +209,9 @@ def ajax_toggle_attended(request, booking_id):
         and booking.event.date > (timezone.now() + timedelta(minutes=30))
     ):
         # Only send waiting list emails if marking booking as no-show more than 30 mins before the event start
-        waiting_list_users = WaitingListUser.objects.filter(event=booking.event)
-        if waiting_list_users:
-            send_waiting_list_email(
-                booking.event,
-                [wluser.user for wluser in waiting_list_users],
-                host="http://{}".format(request.get_host()),
-            )
-            ActivityLog.objects.create(
-                log="Waiting list email sent to user(s) {} for event {}".format(
-                    ",  ".join([wluser.user.username for wluser in waiting_list_users]),
-                    booking.event,
-                )
-            )
+        email_waiting_lists(
+            [booking.event_id], host="http://{}".format(request.get_host())
+        )
 
     spaces_left = f"{booking.event.spaces_left} / {booking.event.max_participants}"
 
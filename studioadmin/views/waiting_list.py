@@ -42,12 +42,15 @@ def event_waiting_list_view(request, event_slug):
             ),
         )
         ActivityLog.objects.create(
+            action="waiting_list_removed",
+            actor=request.user,
+            event=event,
             log="{} {} ({}) removed from the waiting list by admin user {}".format(
                 user_to_remove.first_name,
                 user_to_remove.last_name,
                 user_to_remove.username,
                 request.user.username,
-            )
+            ),
         )
 
     return TemplateResponse(
@@ -117,6 +117,7 @@ MIDDLEWARE = [
     "django.contrib.messages.middleware.MessageMiddleware",
     "django.middleware.clickjacking.XFrameOptionsMiddleware",
     "allauth.account.middleware.AccountMiddleware",
+    "activitylog.middleware.ActivityLogBufferMiddleware",
 ]
 
 
@@ -324,6 +325,18 @@ if env("USE_MAILCATCHER"):  # pragma: no cover
     EMAIL_PORT = 1025
     EMAIL_USE_TLS = False
 
+# Emails are queued in the outbox, and sent with EMAIL_DELIVERY_BACKEND by the
+# send_outbox_emails worker (see booking/email_outbox.py)
+EMAIL_DELIVERY_BACKEND = EMAIL_BACKEND
+if TESTING:
+    # emails sent straight away (e.g. error reports) go to django.core.mail.outbox
+    EMAIL_DELIVERY_BACKEND = "django.core.mail.backends.locmem.EmailBackend"
+if env.bool("EMAIL_OUTBOX", default=True):
+    EMAIL_BACKEND = "booking.email_outbox.OutboxEmailBackend"
+EMAIL_OUTBOX_BATCH_SIZE = env.int("EMAIL_OUTBOX_BATCH_SIZE", default=50)
+# the provider's sending quota; SES's default is 14 emails per second
+EMAIL_OUTBOX_MAX_PER_SECOND = env.float("EMAIL_OUTBOX_MAX_PER_SECOND", default=14)
+
 
 LOG_FOLDER = env("LOG_FOLDER")
 
@@ -421,6 +434,9 @@ else:  # pragma: no cover
                 "level": "ERROR",
                 "class": "django.utils.log.AdminEmailHandler",
                 "include_html": True,
+                # send error emails straight away, not via the outbox; they need
+                # to get through when the database is the problem
+                "email_backend": EMAIL_DELIVERY_BACKEND,
             },
         },
         "loggers": {
@@ -501,7 +517,19 @@ EMPTY_JOB_TEXT = [
     "CRON: auto cancel bookings run; nothing to cancel",
 ]
 
-S3_LOG_BACKUP_PATH = "s3://backups.polefitstarlet.co.uk/sunshine_activitylogs"
+# old activitylogs are backed up here by delete_old_activitylogs before they're deleted
+STORAGES["activitylog_backups"] = {
+    "BACKEND": "storages.backends.s3.S3Storage",
+    "OPTIONS": {
+        "bucket_name": "backups.polefitstarlet.co.uk",
+        "location": "sunshine_activitylogs",
+    },
+}
+if TESTING or (env("LOCAL") and not env("LOCAL_S3", default=False)):
+    STORAGES["activitylog_backups"] = {
+        "BACKEND": "django.core.files.storage.FileSystemStorage",
+        "OPTIONS": {"location": os.path.join(LOG_FOLDER, "activitylogs_backup")},
+    }
 S3_LOG_BACKUP_ROOT_FILENAME = "sunshine_activity_logs_backup"
 
 # for crispy forms
@@ -516,10 +544,30 @@ STRIPE_PUBLISHABLE_KEY = env("STRIPE_PUBLISHABLE_KEY")
 STRIPE_SECRET_KEY = env("STRIPE_SECRET_KEY")
 STRIPE_CONNECT_CLIENT_ID = env("STRIPE_CONNECT_CLIENT_ID")
 STRIPE_ENDPOINT_SECRET = env("STRIPE_ENDPOINT_SECRET")
+# Answer Stripe API requests locally instead, for load testing (see
+# stripe_payments/fake_stripe.py); never set this in production
+STRIPE_FAKE_BACKEND = env.bool("STRIPE_FAKE_BACKEND", default=False)
+STRIPE_FAKE_LATENCY = env.float("STRIPE_FAKE_LATENCY", default=0)
+STRIPE_FAKE_FAILURE_RATE = env.float("STRIPE_FAKE_FAILURE_RATE", default=0)
 INVOICE_KEY = env("INVOICE_KEY")
 
 CART_TIMEOUT_MINUTES = env("CART_TIMEOUT_MINUTES", default=15)
 MEMBERSHIP_AVAILABLE_EARLY_DAYS = env.int("MEMBERSHIP_AVAILABLE_EARLY_DAYS", default=10)
+# Threads used to cancel (refund and email) a cancelled event's bookings; tests
+# run inline, as other threads can't see the test transaction's data
+EVENT_CANCELLATION_THREADS = env.int(
+    "EVENT_CANCELLATION_THREADS", default=1 if TESTING else 4
+)
+# Waiting list emails for an event are sent this many seconds after a space is
+# freed, so spaces freed together are notified once; 0 sends them straight away
+WAITING_LIST_NOTIFICATION_WINDOW = env.int(
+    "WAITING_LIST_NOTIFICATION_WINDOW", default=0 if TESTING else 30
+)
+# Write the ActivityLogs from a request or background job in one query at the end
+# (see activitylog.models.buffered_activity_logs).  The buffer is written on
+# commit, so tests that check the logs run on_commit callbacks (TestCase never
+# commits)
+ACTIVITYLOG_BUFFERED = env.bool("ACTIVITYLOG_BUFFERED", default=True)
 
 # Feature flag for legacy homepage
 LEGACY_HOMEPAGE = env.bool("LEGACY_HOMEPAGE", default=True)
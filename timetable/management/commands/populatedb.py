@@ -1,12 +1,82 @@
 import datetime
+import math
+import random
+import time
+from bisect import bisect
+from decimal import Decimal
+from itertools import accumulate
 
+import pytz
+
+from django.contrib.auth.hashers import make_password
+from django.contrib.auth.models import User
 from django.core.management.base import BaseCommand
+from django.db import connection, transaction
+from django.utils import timezone
+from django.utils.text import slugify
+
+from activitylog.models import ActivityLog
+from activitylog.partitions import (
+    create_partition,
+    month_start,
+    next_month,
+    partitions,
+)
+from booking.models import (
+    Booking,
+    Event,
+    GiftVoucher,
+    GiftVoucherType,
+    ItemVoucher,
+    Membership,
+    MembershipType,
+    TotalVoucher,
+    VoucherUsage,
+    WaitingListUser,
+    invalidate_booking_context_cache,
+)
+from stripe_payments.models import Invoice, Seller, StripePaymentIntent
 
 from ...models import Category, Location, Venue, SessionType, TimetableSession
 
 
 class Command(BaseCommand):
+    help = (
+        "Create a small development timetable; with --scale N, also generate a "
+        "production-sized dataset for N users"
+    )
+
+    def add_arguments(self, parser):
+        parser.add_argument(
+            "--scale",
+            type=int,
+            help="Number of users to generate a year of bookings, memberships, "
+            "vouchers, invoices, waiting lists and activity logs for",
+        )
+        parser.add_argument(
+            "--batch-size",
+            type=int,
+            default=2000,
+            help="Number of rows per insert (default 2000)",
+        )
+        parser.add_argument(
+            "--seed", type=int, help="Random seed, for a reproducible dataset"
+        )
+
     def handle(self, *args, **options):
+        location, session_types, category = self.create_timetable()
+        if options["scale"]:
+            ScaleDataGenerator(
+                location,
+                session_types,
+                category,
+                users=options["scale"],
+                batch_size=options["batch_size"],
+                seed=options["seed"],
+                stdout=self.stdout,
+            ).generate()
+
+    def create_timetable(self):
         location, _ = Location.objects.get_or_create(
             name="Sunshine Fitness Studio",
             address="Moray Institute, Kelty",
@@ -102,3 +172,532 @@ class Command(BaseCommand):
                 cost=cost,
                 level="All levels",
             )
+
+        return location, [polefit, stretch, general_fitness], cat
+
+
+# Scale mode: sizes and distributions.  Each user makes BOOKINGS_PER_USER bookings
+# a year on average, but activity is skewed, so some users book far more than others
+BOOKINGS_PER_USER = 20
+CLASS_CAPACITY = 12
+AVERAGE_FILL = 0.75
+CANCELLATION_RATE = 0.1
+MEMBER_RATE = 0.25
+VOUCHER_USE_RATE = 0.03
+CLASS_NAMES = [
+    "Pole Fitness",
+    "Pole Tricks",
+    "Stretch",
+    "Flexibility",
+    "Kettle Bells",
+    "Circuits",
+    "Legs, Bums and Tums",
+]
+# hourly classes from 7am to 9pm
+TIME_SLOTS = [datetime.time(hour=hour) for hour in range(7, 22)]
+REFERENCE_CHARS = "23456789ABCDEFGHJKLMNPQRSTUVWXYZabcdefghijkmnopqrstuvwxyz"
+
+
+class ScaleDataGenerator:
+    """
+    Bulk creates a production-sized dataset: users, a year of timetable events
+    (9 months past, 3 months future), bookings, memberships, vouchers, invoices,
+    payment intents, waiting lists and activity logs.
+    Rows are built in memory a chunk of events at a time and inserted with
+    bulk_create, so memory use stays flat however many users are requested.
+    """
+
+    def __init__(
+        self,
+        location,
+        session_types,
+        category,
+        users,
+        batch_size=2000,
+        seed=None,
+        stdout=None,
+    ):
+        self.location = location
+        self.session_types = session_types
+        self.category = category
+        self.user_count = users
+        self.batch_size = batch_size
+        self.rng = random.Random(seed)
+        self.stdout = stdout
+        # identifies rows from this run, so generating again doesn't clash
+        self.run_id = "".join(self.rng.choices("abcdefghjkmnpqrstuvwxyz", k=6))
+        self.now = timezone.now()
+        self.start_date = (self.now - datetime.timedelta(days=273)).date()
+        self.end_date = self.start_date + datetime.timedelta(days=364)
+        self.seller = Seller.objects.first()
+        self.localtz = pytz.timezone("Europe/London")
+
+    def log(self, message):
+        if self.stdout is not None:
+            self.stdout.write(message)
+
+    def create_activitylog_partitions(self):
+        """Partitions for the past months' activity logs, so they're not in the default"""
+        existing = set(partitions())
+        month = month_start(self.now - datetime.timedelta(days=273))
+        while month <= self.now:
+            if month not in existing:
+                create_partition(month)
+            month = next_month(month)
+
+    def generate(self):
+        started = time.monotonic()
+        self.create_activitylog_partitions()
+        self.create_users()
+        sessions = self.create_timetable_sessions()
+        events = self.create_events(sessions)
+        self.create_vouchers()
+        self.create_memberships()
+        self.create_gift_vouchers()
+
+        booking_count = 0
+        events_per_chunk = max(
+            1, self.batch_size // round(CLASS_CAPACITY * AVERAGE_FILL)
+        )
+        for i in range(0, len(events), events_per_chunk):
+            with transaction.atomic():
+                booking_count += self.create_bookings(events[i : i + events_per_chunk])
+        self.log(f"Created {booking_count} bookings")
+
+        # bulk_create doesn't send post_save or update voucher usage counts, so
+        # the cached booking data and counts are stale
+        invalidate_booking_context_cache()
+        VoucherUsage.recalculate()
+        if connection.vendor == "postgresql":
+            # refresh planner statistics so query plans reflect the new data
+            with connection.cursor() as cursor:
+                cursor.execute("ANALYZE")
+        self.log(f"Scale data generated in {time.monotonic() - started:.1f}s")
+
+    def _reference(self):
+        return "".join(self.rng.choices(REFERENCE_CHARS, k=22))
+
+    def _localize(self, date, start_time):
+        return self.localtz.localize(
+            datetime.datetime.combine(date, start_time)
+        ).astimezone(pytz.utc)
+
+    def create_users(self):
+        password = make_password(None)
+        users = [
+            User(
+                username=f"scale_{self.run_id}_{i}",
+                email=f"scale_{self.run_id}_{i}@example.com",
+                first_name="Scale",
+                last_name=f"User {i}",
+                password=password,
+                date_joined=self.now
+                - datetime.timedelta(days=self.rng.randint(0, 730)),
+            )
+            for i in range(self.user_count)
+        ]
+        self.users = User.objects.bulk_create(users, batch_size=self.batch_size)
+        # activity follows a long tail: most users book occasionally, a few
+        # book several times a week
+        weights = [min(self.rng.paretovariate(1.5), 20) for _ in self.users]
+        self.cum_weights = list(accumulate(weights))
+        self.log(f"Created {len(self.users)} users")
+
+    def _weighted_users(self, count, exclude=()):
+        """Pick up to count distinct users, weighted by activity"""
+        total = self.cum_weights[-1]
+        chosen = {}
+        for _ in range(count * 3):
+            if len(chosen) == count:
+                break
+            user = self.users[bisect(self.cum_weights, self.rng.random() * total)]
+            if user.id not in exclude:
+                chosen[user.id] = user
+        return list(chosen.values())
+
+    def create_timetable_sessions(self):
+        """
+        A weekly timetable big enough for the users' bookings, spread over as many
+        studios as needed to fit the hourly time slots
+        """
+        session_count = math.ceil(
+            self.user_count * BOOKINGS_PER_USER / (CLASS_CAPACITY * AVERAGE_FILL * 52)
+        )
+        private, _ = SessionType.objects.get_or_create(
+            name="Private Lessons", defaults={"display_on_site": False, "order": 900}
+        )
+        days = [day for day, _ in TimetableSession.WEEKDAY_CHOICES]
+        slots_per_venue = len(days) * len(TIME_SLOTS)
+        venues = [
+            Venue.objects.get_or_create(
+                name=f"Scale Studio {i + 1}",
+                abbreviation=f"Scale {i + 1}",
+                location=self.location,
+            )[0]
+            for i in range(math.ceil(session_count / slots_per_venue))
+        ]
+        existing = {
+            (session.venue_id, session.session_day, session.start_time): session
+            for session in TimetableSession.objects.filter(
+                venue__in=venues
+            ).select_related("session_type")
+        }
+        sessions = []
+        new_sessions = []
+        for index in range(session_count):
+            venue = venues[index // slots_per_venue]
+            slot = index % slots_per_venue
+            day = days[slot % len(days)]
+            start_time = TIME_SLOTS[slot // len(days)]
+            session = existing.get((venue.id, day, start_time))
+            if session is None:
+                is_private = index % 20 == 19
+                session = TimetableSession(
+                    session_day=day,
+                    start_time=start_time,
+                    end_time=start_time.replace(hour=start_time.hour + 1),
+                    name="Private" if is_private else self.rng.choice(CLASS_NAMES),
+                    session_type=private
+                    if is_private
+                    else self.rng.choice(self.session_types),
+                    venue=venue,
+                    category=self.category,
+                    cost=30 if is_private else self.rng.choice([7, 8, 9]),
+                    max_participants=1 if is_private else CLASS_CAPACITY,
+                    cancellation_fee=0 if is_private else 1,
+                )
+                new_sessions.append(session)
+            sessions.append(session)
+        TimetableSession.objects.bulk_create(new_sessions, batch_size=self.batch_size)
+        self.log(
+            f"Created {len(new_sessions)} timetable sessions in {len(venues)} venues"
+        )
+        return sessions
+
+    def create_events(self, sessions):
+        """
+        The events that uploading the timetable for the year would create, with
+        their current number of open bookings.  Events already generated by an
+        earlier run are reused, so new users' bookings fill their spaces left.
+        """
+        days = [day for day, _ in TimetableSession.WEEKDAY_CHOICES]
+        sessions_by_day = {day: [] for day in days}
+        for session in sessions:
+            sessions_by_day[session.session_day].append(session)
+        existing = {
+            (event.name, event.date, event.venue_id): event
+            for event in Event.objects.filter(
+                venue_id__in={session.venue_id for session in sessions},
+                date__date__range=(self.start_date, self.end_date),
+            ).with_open_booking_count()
+        }
+
+        new_events = []
+        date = self.start_date
+        while date <= self.end_date:
+            for session in sessions_by_day[days[date.weekday()]]:
+                name = f"{session.name} ({session.level})"
+                event_date = self._localize(date, session.start_time)
+                if (name, event_date, session.venue_id) in existing:
+                    continue
+                event = Event(
+                    name=name,
+                    event_type="private"
+                    if session.session_type.name.lower().startswith("private")
+                    else "regular_session",
+                    date=event_date,
+                    venue_id=session.venue_id,
+                    max_participants=session.max_participants,
+                    cost=session.cost,
+                    show_on_site=True,
+                    cancellation_period=session.cancellation_period,
+                    cancellation_fee=session.cancellation_fee,
+                    slug=f"{slugify(name)[:16]}-{session.venue_id}-{event_date:%y%m%d%H%M}",
+                    cancelled=event_date < self.now and self.rng.random() < 0.01,
+                )
+                new_events.append(event)
+            date += datetime.timedelta(days=1)
+        # AutoSlugField regenerates slugs on add, querying once per event, and can't
+        # see clashes between events in the same insert; keep the unique slugs set
+        # above instead
+        slug_field = Event._meta.get_field("slug")
+        slug_field.overwrite_on_add = False
+        try:
+            events = Event.objects.bulk_create(new_events, batch_size=self.batch_size)
+        finally:
+            slug_field.overwrite_on_add = True
+        for event in events:
+            event.open_booking_count = 0
+        ActivityLog.objects.create(
+            action="timetable_uploaded",
+            log="Timetable uploaded for {} to {}".format(
+                self.start_date.strftime("%a %d %B %Y"),
+                self.end_date.strftime("%a %d %B %Y"),
+            ),
+        )
+        self.log(f"Created {len(events)} events")
+        return sorted([*existing.values(), *events], key=lambda event: event.date)
+
+    def create_vouchers(self):
+        # vouchers are multi-table models, so they can't be bulk created
+        self.item_vouchers = []
+        for i in range(max(5, self.user_count // 2000)):
+            self.item_vouchers.append(
+                ItemVoucher.objects.create(
+                    code=f"scale-{self.run_id}-item-{i}",
+                    discount=self.rng.choice([10, 20, 50]),
+                    event_types=["regular_session"],
+                    max_per_user=self.rng.choice([None, 1, 5]),
+                    start_date=self.now - datetime.timedelta(days=300),
+                )
+            )
+        for i in range(max(5, self.user_count // 2000)):
+            TotalVoucher.objects.create(
+                code=f"scale-{self.run_id}-total-{i}",
+                discount_amount=self.rng.choice([5, 10]),
+                max_vouchers=100,
+            )
+        self.log(f"Created {len(self.item_vouchers)} item and total vouchers")
+
+    def _invoice(self, user, amount, date_paid):
+        invoice_id = self._reference()
+        return Invoice(
+            username=user.email,
+            invoice_id=invoice_id,
+            amount=amount,
+            stripe_payment_intent_id=f"pi_{invoice_id}",
+            date_created=date_paid,
+            date_paid=date_paid,
+            paid=True,
+        )
+
+    def _create_invoices(self, invoices):
+        """Bulk create paid invoices, with their payment intents and activity logs"""
+        invoices = Invoice.objects.bulk_create(invoices, batch_size=self.batch_size)
+        StripePaymentIntent.objects.bulk_create(
+            (
+                StripePaymentIntent(
+                    payment_intent_id=invoice.stripe_payment_intent_id,
+                    amount=int(invoice.amount * 100),
+                    description="",
+                    status="succeeded",
+                    invoice=invoice,
+                    seller=self.seller,
+                    metadata={"invoice_id": invoice.invoice_id},
+                    client_secret=f"{invoice.stripe_payment_intent_id}_secret",
+                    currency="gbp",
+                )
+                for invoice in invoices
+            ),
+            batch_size=self.batch_size,
+        )
+        ActivityLog.objects.bulk_create(
+            (
+                ActivityLog(
+                    timestamp=invoice.date_paid,
+                    log=f"Invoice {invoice.invoice_id} (user {invoice.username}) paid by Stripe",
+                )
+                for invoice in invoices
+            ),
+            batch_size=self.batch_size,
+        )
+
+    def create_memberships(self):
+        """
+        A quarter of users are members, who buy a membership most months.
+        Memberships are used for the members' class bookings while they have
+        classes left.
+        """
+        membership_types = [
+            MembershipType.objects.get_or_create(
+                name=f"{classes} classes per month",
+                defaults={"number_of_classes": classes, "cost": cost},
+            )[0]
+            for classes, cost in [(4, 30), (8, 55)]
+        ]
+        months = []
+        date = self.start_date.replace(day=1)
+        while date <= self.end_date:
+            months.append((date.year, date.month))
+            date = (date + datetime.timedelta(days=32)).replace(day=1)
+
+        memberships = []
+        invoices = []
+        members = self.rng.sample(self.users, int(len(self.users) * MEMBER_RATE))
+        for user in members:
+            for year, month in months:
+                if self.rng.random() > 0.75:
+                    continue
+                purchase_date = min(
+                    self._localize(
+                        datetime.date(year, month, 1), datetime.time(hour=12)
+                    )
+                    - datetime.timedelta(days=self.rng.randint(0, 7)),
+                    self.now,
+                )
+                membership_type = self.rng.choice(membership_types)
+                # a few unpaid memberships for the coming months, left in carts
+                paid = purchase_date < self.now or self.rng.random() < 0.9
+                membership = Membership(
+                    user=user,
+                    membership_type=membership_type,
+                    month=month,
+                    year=year,
+                    paid=paid,
+                    purchase_date=purchase_date,
+                )
+                if paid:
+                    membership.invoice = self._invoice(
+                        user, membership_type.cost, purchase_date
+                    )
+                    invoices.append(membership.invoice)
+                memberships.append(membership)
+
+        self._create_invoices(invoices)
+        memberships = Membership.objects.bulk_create(
+            memberships, batch_size=self.batch_size
+        )
+        # classes left on each paid membership, by user and month
+        self.membership_classes = {
+            (membership.user_id, membership.year, membership.month): [
+                membership,
+                membership.membership_type.number_of_classes,
+            ]
+            for membership in memberships
+            if membership.paid
+        }
+        self.log(f"Created {len(memberships)} memberships")
+
+    def create_gift_vouchers(self):
+        gift_voucher_types = [
+            GiftVoucherType.objects.get_or_create(discount_amount=Decimal(25))[0],
+            GiftVoucherType.objects.get_or_create(event_type="regular_session")[0],
+        ]
+        count = max(5, self.user_count // 200)
+        purchasers = self.rng.sample(self.users, min(count, len(self.users)))
+        for user in purchasers:
+            gift_voucher_type = self.rng.choice(gift_voucher_types)
+            invoice = self._invoice(
+                user,
+                gift_voucher_type.discount_amount or Decimal(8),
+                self.now - datetime.timedelta(days=self.rng.randint(0, 270)),
+            )
+            self._create_invoices([invoice])
+            gift_voucher = GiftVoucher.objects.create(
+                gift_voucher_type=gift_voucher_type, invoice=invoice, paid=True
+            )
+            gift_voucher.voucher.purchaser_email = user.email
+            gift_voucher.voucher.name = f"{user.first_name} {user.last_name}"
+            gift_voucher.voucher.activated = True
+            gift_voucher.voucher.save()
+        self.log(f"Created {len(purchasers)} gift vouchers")
+
+    def create_bookings(self, events):
+        """Bookings, waiting lists and activity logs for a chunk of events"""
+        bookings = []
+        invoices = []
+        waiting_list_users = []
+        user_invoices = {}
+        for event in events:
+            days_ahead = (event.date - self.now).days
+            fill = self.rng.betavariate(6, 2)
+            if days_ahead > 0:
+                # future classes are still filling up
+                fill *= max(0.1, 1 - days_ahead / 120)
+            open_count = max(
+                0,
+                min(event.max_participants, round(event.max_participants * fill))
+                - event.open_booking_count,
+            )
+            cancelled_count = sum(
+                self.rng.random() < CANCELLATION_RATE for _ in range(open_count)
+            )
+            users = self._weighted_users(open_count + cancelled_count)
+            for index, user in enumerate(users):
+                cancelled = event.cancelled or index >= open_count
+                date_booked = min(
+                    event.date - datetime.timedelta(hours=self.rng.expovariate(1 / 96)),
+                    self.now,
+                )
+                booking = Booking(
+                    user=user,
+                    event=event,
+                    booking_reference=self._reference(),
+                    date_booked=date_booked,
+                    status="CANCELLED" if cancelled else "OPEN",
+                    date_cancelled=min(
+                        date_booked + datetime.timedelta(hours=self.rng.randint(1, 48)),
+                        self.now,
+                    )
+                    if cancelled
+                    else None,
+                    reminder_sent=event.date < self.now,
+                )
+                if event.date < self.now and not cancelled:
+                    attendance = self.rng.random()
+                    booking.attended = attendance < 0.85
+                    booking.no_show = 0.85 <= attendance < 0.9
+
+                membership = self.membership_classes.get(
+                    (user.id, event.date.year, event.date.month)
+                )
+                if (
+                    event.event_type == "regular_session"
+                    and not cancelled
+                    and membership is not None
+                    and membership[1] > 0
+                ):
+                    booking.membership = membership[0]
+                    booking.paid = True
+                    membership[1] -= 1
+                elif days_ahead <= 0 or self.rng.random() < 0.9:
+                    # paid by card; the remaining future bookings are in carts
+                    booking.paid = True
+                    cost = event.cost
+                    if self.rng.random() < VOUCHER_USE_RATE:
+                        booking.voucher = self.rng.choice(self.item_vouchers)
+                        cost = cost * (100 - booking.voucher.discount) / 100
+                    # users often check out several classes at once
+                    invoice = user_invoices.get(user.id)
+                    if invoice is None or self.rng.random() < 0.5:
+                        invoice = self._invoice(user, 0, date_booked)
+                        user_invoices[user.id] = invoice
+                        invoices.append(invoice)
+                    invoice.amount += cost
+                    booking.invoice = invoice
+                bookings.append(booking)
+
+            full = open_count + event.open_booking_count >= event.max_participants
+            if event.date > self.now and full:
+                waiting_list_users.extend(
+                    WaitingListUser(
+                        user=user,
+                        event=event,
+                        date_joined=min(
+                            self.now,
+                            event.date
+                            - datetime.timedelta(hours=self.rng.randint(1, 72)),
+                        ),
+                    )
+                    for user in self._weighted_users(
+                        self.rng.randint(0, 4), exclude={user.id for user in users}
+                    )
+                )
+
+        self._create_invoices(invoices)
+        bookings = Booking.objects.bulk_create(bookings, batch_size=self.batch_size)
+        WaitingListUser.objects.bulk_create(
+            waiting_list_users, batch_size=self.batch_size
+        )
+        event_names = {event.id: str(event) for event in events}
+        ActivityLog.objects.bulk_create(
+            (
+                ActivityLog(
+                    timestamp=booking.date_booked,
+                    log=f'Booking {booking.id} created for "{event_names[booking.event_id]}" by user {booking.user.username}',
+                )
+                for booking in bookings
+            ),
+            batch_size=self.batch_size,
+        )
+        return len(bookings)
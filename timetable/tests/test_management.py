@@ -1,8 +1,15 @@
 import pytest
+from datetime import timedelta
 
 
+from django.contrib.auth.models import User
 from django.core import management
 from django.test import TestCase
+from django.utils import timezone
+
+from activitylog.models import ActivityLog
+from booking.models import Booking, Event, Membership
+from stripe_payments.models import StripePaymentIntent
 
 from ..models import SessionType, TimetableSession, Venue
 
@@ -28,3 +35,52 @@ class ManagementCommands(TestCase):
         self.assertEqual(Venue.objects.count(), 2)
         self.assertEqual(SessionType.objects.count(), 3)
         self.assertEqual(TimetableSession.objects.count(), 3)
+
+    def test_populatedb_scale(self):
+        management.call_command("populatedb", scale=50, seed=1, batch_size=100)
+
+        # the base timetable is still created
+        self.assertEqual(Venue.objects.filter(name="Venue TBC").count(), 1)
+        users = User.objects.filter(username__startswith="scale_")
+        self.assertEqual(users.count(), 50)
+
+        events = Event.objects.filter(venue__name__startswith="Scale Studio")
+        self.assertTrue(events.exists())
+        # a year of events, from the past 9 months to the next 3 months
+        first, last = events.order_by("date").first(), events.order_by("date").last()
+        self.assertLess(first.date, timezone.now() - timedelta(days=260))
+        self.assertGreater(last.date, timezone.now() + timedelta(days=80))
+
+        self.assertTrue(Booking.objects.filter(user__in=users).exists())
+        self.assertTrue(Membership.objects.filter(user__in=users).exists())
+        self.assertTrue(StripePaymentIntent.objects.exists())
+        self.assertTrue(
+            ActivityLog.objects.filter(action="timetable_uploaded").exists()
+        )
+        # memberships are never used for more classes than they include
+        for membership in Membership.objects.filter(user__in=users):
+            self.assertLessEqual(
+                membership.bookings.count(),
+                membership.membership_type.number_of_classes,
+            )
+        # bookings paid by card have paid invoices
+        self.assertFalse(
+            Booking.objects.filter(
+                paid=True, membership__isnull=True, invoice__isnull=True
+            ).exists()
+        )
+
+        # running again adds another set of users, but reuses the scale timetable
+        sessions = TimetableSession.objects.count()
+        event_count = events.count()
+        # full future classes get waiting lists
+        full_event = events.filter(date__gt=timezone.now(), cancelled=False).first()
+        full_event.max_participants = 0
+        full_event.save()
+        management.call_command("populatedb", scale=50, seed=2, batch_size=100)
+        self.assertTrue(full_event.waitinglistusers.exists())
+        self.assertEqual(
+            User.objects.filter(username__startswith="scale_").count(), 100
+        )
+        self.assertEqual(TimetableSession.objects.count(), sessions)
+        self.assertEqual(events.count(), event_count)
@@ -68,11 +68,13 @@ def upload_timetable(start_date, end_date, session_ids, show_on_site, user=None)
 
     if created_classes:
         ActivityLog.objects.create(
+            action="timetable_uploaded",
+            actor=user,
             log="Timetable uploaded for {} to {} {}".format(
                 start_date.strftime("%a %d %B %Y"),
                 end_date.strftime("%a %d %B %Y"),
                 "by admin user {}".format(user.username) if user else "",
-            )
+            ),
         )
 
     return created_classes, existing_classes, duplicate_classes